@@ -0,0 +1,65 @@
+"""Add precomputed sort date to task queue
+
+Revision ID: 7f4a1c2d9e03
+Revises: 13cb230def11
+Create Date: 2023-10-02 11:24:51.392714
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7f4a1c2d9e03"
+down_revision = "13cb230def11"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("task_queue", sa.Column("sort_date", sa.DateTime(), nullable=True))
+
+    # Sort date is the created_on of the record, or of the earliest service the record
+    # is a dependency of (whichever is earlier)
+    op.execute(
+        sa.text(
+            """
+            UPDATE task_queue tq SET sort_date = br.created_on
+            FROM base_record br
+            WHERE br.id = tq.record_id
+            """
+        )
+    )
+
+    op.execute(
+        sa.text(
+            """
+            UPDATE task_queue tq SET sort_date = LEAST(tq.sort_date, svc.created_on)
+            FROM (
+                SELECT sd.record_id, MIN(br.created_on) AS created_on
+                FROM service_dependency sd
+                INNER JOIN service_queue sq ON sq.id = sd.service_id
+                INNER JOIN base_record br ON br.id = sq.record_id
+                GROUP BY sd.record_id
+            ) svc
+            WHERE svc.record_id = tq.record_id
+            """
+        )
+    )
+
+    op.alter_column("task_queue", "sort_date", nullable=False)
+
+    op.drop_index("ix_task_queue_tag", table_name="task_queue")
+    op.create_index(
+        "ix_task_queue_tag_sort",
+        "task_queue",
+        ["tag", sa.text("priority DESC"), "sort_date", "id"],
+        unique=False,
+    )
+    op.create_index("ix_task_queue_sort", "task_queue", [sa.text("priority DESC"), "sort_date", "id"], unique=False)
+
+
+def downgrade():
+    op.drop_index("ix_task_queue_sort", table_name="task_queue")
+    op.drop_index("ix_task_queue_tag_sort", table_name="task_queue")
+    op.create_index("ix_task_queue_tag", "task_queue", ["tag"], unique=False)
+    op.drop_column("task_queue", "sort_date")
@@ -0,0 +1,29 @@
+"""Add index for tasks without generated specifications
+
+Revision ID: b83e5d6a41f7
+Revises: 7f4a1c2d9e03
+Create Date: 2023-10-05 09:12:37.538104
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b83e5d6a41f7"
+down_revision = "7f4a1c2d9e03"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_task_queue_function_null",
+        "task_queue",
+        ["id"],
+        unique=False,
+        postgresql_where=sa.text("function IS NULL"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_task_queue_function_null", table_name="task_queue")
@@ -0,0 +1,33 @@
+"""Add table for staging returned task results
+
+Revision ID: 4e2b7c9a1d58
+Revises: b83e5d6a41f7
+Create Date: 2023-10-09 14:27:51.204417
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4e2b7c9a1d58"
+down_revision = "b83e5d6a41f7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "task_return_staging",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("task_id", sa.Integer(), nullable=False),
+        sa.Column("manager_name", sa.String(), nullable=False),
+        sa.Column("received_on", sa.DateTime(), nullable=False),
+        sa.Column("result_compressed", sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_task_return_staging_task_id", "task_return_staging", ["task_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index("ix_task_return_staging_task_id", table_name="task_return_staging")
+    op.drop_table("task_return_staging")
@@ -0,0 +1,39 @@
+"""Add table for chunks appended to outputs
+
+Revision ID: 9c3e5a7f2b14
+Revises: 4e2b7c9a1d58
+Create Date: 2023-10-16 10:42:17.583201
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "9c3e5a7f2b14"
+down_revision = "4e2b7c9a1d58"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "output_store_chunk",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("output_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "compression_type",
+            postgresql.ENUM("none", "lzma", "zstd", name="compressionenum", create_type=False),
+            nullable=False,
+        ),
+        sa.Column("compression_level", sa.Integer(), nullable=False),
+        sa.Column("data", sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(["output_id"], ["output_store.id"], ondelete="cascade"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_output_store_chunk_output_id", "output_store_chunk", ["output_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index("ix_output_store_chunk_output_id", table_name="output_store_chunk")
+    op.drop_table("output_store_chunk")
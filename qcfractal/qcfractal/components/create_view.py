@@ -1,11 +1,41 @@
-import os
+from __future__ import annotations
 
-from sqlalchemy import select, create_engine, Column, String, ForeignKey, LargeBinary
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import zstandard
+from sqlalchemy import (
+    select,
+    create_engine,
+    event,
+    insert,
+    func,
+    tuple_,
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    Index,
+    LargeBinary,
+    delete,
+    bindparam,
+)
 from sqlalchemy.orm import selectinload, sessionmaker, declarative_base
+from sqlalchemy.types import UserDefinedType
+
+from qcfractal.components.record_db_models import BaseRecordORM
+from qcportal.record_models import RecordStatusEnum
+from qcportal.serialization import serialize, deserialize
 
-from qcfractal.db_socket.socket import SQLAlchemySocket
-from qcportal.compression import compress, CompressionEnum
-from qcportal.serialization import serialize
+if TYPE_CHECKING:
+    from typing import Optional, List, Dict, Any, Tuple
+    from sqlalchemy.orm.session import Session
+    from qcfractal.db_socket.socket import SQLAlchemySocket
+    from qcfractal.components.internal_jobs.status import JobProgress
+
+_logger = logging.getLogger(__name__)
 
 ViewBaseORM = declarative_base()
 
@@ -29,105 +59,476 @@ class DatasetViewRecord(ViewBaseORM):
     data = Column(LargeBinary, nullable=False)
 
 
-class DatasetViewMetadata(ViewBaseORM):
-    __tablename__ = "dataset_metadata"
+class _AnyValue(UserDefinedType):
+    """
+    Column type that passes values through to sqlite unchanged (sqlite columns are dynamically typed)
+    """
 
-    key = Column(String, ForeignKey(DatasetViewEntry.name), primary_key=True)
-    value = Column(LargeBinary, nullable=False)
+    cache_ok = True
 
+    def get_col_spec(self, **kw):
+        return "BLOB"
 
-def _serialize_orm(orm, exclude=None):
-    s_data = serialize(orm.model_dict(exclude=exclude), "application/msgpack")
-    c_data, _, _ = compress(s_data, CompressionEnum.zstd, 7)
-    return c_data
 
+class DatasetViewRecordInfo(ViewBaseORM):
+    __tablename__ = "dataset_record_info"
+    entry_name = Column(String, ForeignKey(DatasetViewEntry.name), primary_key=True)
+    specification_name = Column(String, ForeignKey(DatasetViewSpecification.name), primary_key=True)
+    record_id = Column(Integer, nullable=False)
+    status = Column(String, nullable=False)
+    modified_on = Column(String, nullable=False)
 
-def create_dataset_view(dataset_id: int, socket: SQLAlchemySocket, view_file_path: str):
-
-    if os.path.exists(view_file_path):
-        raise RuntimeError(f"File {view_file_path} exists - will not overwrite")
 
-    if os.path.isdir(view_file_path):
-        raise RuntimeError(f"{view_file_path} is a directory")
+class DatasetViewRecordProperty(ViewBaseORM):
+    """
+    Properties of records, stored one value per row
 
-    uri = "sqlite:///" + view_file_path
-    engine = create_engine(uri)
-    ViewSession = sessionmaker(bind=engine)
+    Rows are stored clustered by property name (WITHOUT ROWID), so all the values of a single
+    property can be read without touching (or decompressing) the full records.
+    """
 
-    ViewBaseORM.metadata.create_all(engine)
+    __tablename__ = "dataset_record_property"
+    property_name = Column(String, primary_key=True)
+    entry_name = Column(String, primary_key=True)
+    specification_name = Column(String, primary_key=True)
 
-    view_session = ViewSession()
+    # Scalars (int, float, str) are stored as-is. Everything else is msgpack-serialized
+    value = Column(_AnyValue)
 
-    with socket.session_scope(True) as fractal_session:
-        ds_type = socket.datasets.lookup_type(dataset_id)
-        ds_socket = socket.datasets.get_socket(ds_type)
+    __table_args__ = (
+        Index("ix_dataset_record_property_record", "entry_name", "specification_name"),
+        {"sqlite_with_rowid": False},
+    )
 
-        dataset_orm = ds_socket.dataset_orm
-        entry_orm = ds_socket.entry_orm
-        specification_orm = ds_socket.specification_orm
-        record_item_orm = ds_socket.record_item_orm
 
-        stmt = select(dataset_orm).where(dataset_orm.id == dataset_id)
-        stmt = stmt.options(selectinload("*"))
-        ds_orm = fractal_session.execute(stmt).scalar_one()
+class DatasetViewMetadata(ViewBaseORM):
+    __tablename__ = "dataset_metadata"
 
-        # Metadata
-        metadata_bytes = _serialize_orm(ds_orm)
-        metadata_orm = DatasetViewMetadata(key="raw_data", value=metadata_bytes)
-        view_session.add(metadata_orm)
-        view_session.commit()
+    key = Column(String, ForeignKey(DatasetViewEntry.name), primary_key=True)
+    value = Column(LargeBinary, nullable=False)
 
-        # Entries
-        stmt = select(entry_orm)
-        stmt = stmt.options(selectinload("*"))
-        stmt = stmt.where(entry_orm.dataset_id == dataset_id)
-        entries = fractal_session.execute(stmt).scalars().all()
 
-        for entry in entries:
-            entry_bytes = _serialize_orm(entry)
-            entry_orm = DatasetViewEntry(name=entry.name, data=entry_bytes)
-            view_session.add(entry_orm)
+def _deserialize_data(data_bytes):
+    return deserialize(zstandard.decompress(data_bytes), "application/msgpack")
 
-        view_session.commit()
 
-        # Specifications
-        stmt = select(specification_orm)
-        stmt = stmt.options(selectinload("*"))
-        stmt = stmt.where(specification_orm.dataset_id == dataset_id)
-        specs = fractal_session.execute(stmt).scalars().all()
+def _serialize_data(data):
+    s_data = serialize(data, "application/msgpack")
+    return zstandard.compress(s_data, level=7)
 
-        for spec in specs:
-            spec_bytes = _serialize_orm(spec)
-            specification_orm = DatasetViewSpecification(name=spec.name, data=spec_bytes)
-            view_session.add(specification_orm)
 
-        view_session.commit()
+def _serialize_orm(orm, exclude=None):
+    return _serialize_data(orm.model_dict(exclude=exclude))
+
+
+def _serialize_property_value(value):
+    if value is None or (isinstance(value, (int, float, str)) and not isinstance(value, bool)):
+        return value
+    return serialize(value, "application/msgpack")
+
+
+def _serialize_record_items(items: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Serializes record items into rows of the record, record info, and record property tables
+    """
+
+    ret = {"records": [], "info": [], "properties": []}
+
+    for x in items:
+        entry_name = x["entry_name"]
+        specification_name = x["specification_name"]
+        record = x["record"]
+
+        ret["records"].append(
+            {"entry_name": entry_name, "specification_name": specification_name, "data": _serialize_data(x)}
+        )
+
+        ret["info"].append(
+            {
+                "entry_name": entry_name,
+                "specification_name": specification_name,
+                "record_id": x["record_id"],
+                "status": RecordStatusEnum(record["status"]).value,
+                "modified_on": record["modified_on"].isoformat(),
+            }
+        )
+
+        for property_name, value in (record.get("properties") or {}).items():
+            ret["properties"].append(
+                {
+                    "property_name": property_name,
+                    "entry_name": entry_name,
+                    "specification_name": specification_name,
+                    "value": _serialize_property_value(value),
+                }
+            )
+
+    return ret
+
+
+def _set_build_pragmas(dbapi_connection, connection_record):
+    # A new view is written in a single transaction, and a partially-written file is
+    # removed on failure anyway, so there is no need to wait on the disk
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.close()
+
+
+def _set_refresh_pragmas(dbapi_connection, connection_record):
+    # An existing view must survive a crash during a refresh. With WAL, NORMAL
+    # may lose the refresh but never corrupts the file
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def _write_view(
+    dataset_id: int,
+    socket: SQLAlchemySocket,
+    view_session: Session,
+    fractal_session: Session,
+    batch_size: int,
+    n_workers: int,
+    job_progress: Optional[JobProgress],
+) -> bool:
+    """
+    Writes (or updates) all the data for a dataset into a view file
+
+    Any data already in the view is compared against the server. Entries and specifications are
+    re-serialized and only written if they differ from what is in the view. Records are only fetched
+    and re-serialized if they are new, or their modified_on or record id differ from what is in the view.
+    Data that is in the view but no longer on the server is removed. For a new (empty) view file, this
+    just writes everything.
+
+    Returns False if the job was cancelled, True otherwise
+    """
+
+    ds_type = socket.datasets.lookup_type(dataset_id, session=fractal_session)
+    ds_socket = socket.datasets.get_socket(ds_type)
+
+    entry_orm = ds_socket.entry_orm
+    specification_orm = ds_socket.specification_orm
+    record_item_orm = ds_socket.record_item_orm
+
+    record_table = DatasetViewRecord.__table__
+    info_table = DatasetViewRecordInfo.__table__
+    property_table = DatasetViewRecordProperty.__table__
+
+    view_conn = view_session.connection()
+
+    # Metadata - the same information the client gets when retrieving the dataset
+    ds_data = ds_socket.get(dataset_id, session=fractal_session)
+    view_session.merge(DatasetViewMetadata(key="raw_data", value=_serialize_data(ds_data)))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # Entries & specifications. These are small compared to records, so always serialize them
+        # and compare with what is stored
+        for server_orm, view_orm in ((entry_orm, DatasetViewEntry), (specification_orm, DatasetViewSpecification)):
+            stmt = select(server_orm)
+            stmt = stmt.options(selectinload("*"))
+            stmt = stmt.where(server_orm.dataset_id == dataset_id)
+            server_data = fractal_session.execute(stmt).scalars().all()
+            server_bytes = dict(zip((x.name for x in server_data), executor.map(_serialize_orm, server_data)))
+
+            existing = dict(view_session.execute(select(view_orm.name, view_orm.data)).all())
+            to_delete = [{"del_name": x} for x in existing.keys() - server_bytes.keys()]
+            to_write = [{"name": k, "data": v} for k, v in server_bytes.items() if existing.get(k) != v]
+
+            if to_delete:
+                view_conn.execute(delete(view_orm).where(view_orm.name == bindparam("del_name")), to_delete)
+            if to_write:
+                view_conn.execute(insert(view_orm).prefix_with("OR REPLACE"), to_write)
+
+        # Records
+        stmt = select(func.count()).select_from(record_item_orm).where(record_item_orm.dataset_id == dataset_id)
+        total_records = fractal_session.execute(stmt).scalar_one()
+
+        # What is currently in the view. Items still left in here at the end are no longer on the server
+        stmt = select(
+            DatasetViewRecordInfo.entry_name,
+            DatasetViewRecordInfo.specification_name,
+            DatasetViewRecordInfo.record_id,
+            DatasetViewRecordInfo.modified_on,
+        )
+        existing_records: Dict[Tuple[str, str], Tuple[int, str]] = {
+            (x[0], x[1]): (x[2], x[3]) for x in view_session.execute(stmt)
+        }
+
+        key_cols = (record_item_orm.entry_name, record_item_orm.specification_name)
+        base_stmt = select(*key_cols, record_item_orm.record_id, BaseRecordORM.modified_on)
+        base_stmt = base_stmt.join(BaseRecordORM, BaseRecordORM.id == record_item_orm.record_id)
+        base_stmt = base_stmt.where(record_item_orm.dataset_id == dataset_id)
+        base_stmt = base_stmt.order_by(*key_cols).limit(batch_size)
+
+        last_key = None
+        pending = []  # futures of batches being serialized/compressed
+        to_update = []  # record items that need to be (re)written
+        n_scanned = 0
+
+        old_keys = set(existing_records.keys())
+
+        def _write_rows(rows):
+            # Remove the old properties of any records being replaced
+            replaced = [
+                {"del_entry": x["entry_name"], "del_spec": x["specification_name"]}
+                for x in rows["info"]
+                if (x["entry_name"], x["specification_name"]) in old_keys
+            ]
+            if replaced:
+                view_conn.execute(
+                    delete(property_table).where(
+                        property_table.c.entry_name == bindparam("del_entry"),
+                        property_table.c.specification_name == bindparam("del_spec"),
+                    ),
+                    replaced,
+                )
 
-        base_stmt = select(record_item_orm).where(record_item_orm.dataset_id == dataset_id)
-        base_stmt = base_stmt.options(selectinload("*"))
-        base_stmt = base_stmt.order_by(record_item_orm.record_id.asc())
+            view_conn.execute(insert(record_table).prefix_with("OR REPLACE"), rows["records"])
+            view_conn.execute(insert(info_table).prefix_with("OR REPLACE"), rows["info"])
+            if rows["properties"]:
+                view_conn.execute(insert(property_table), rows["properties"])
 
-        skip = 0
         while True:
-            stmt = base_stmt.offset(skip).limit(10)
-            batch = fractal_session.execute(stmt).scalars()
+            if job_progress is not None and job_progress.cancelled():
+                return False
+
+            stmt = base_stmt if last_key is None else base_stmt.where(tuple_(*key_cols) > tuple_(*last_key))
+            batch = fractal_session.execute(stmt).all()
+
+            if batch:
+                last_key = (batch[-1].entry_name, batch[-1].specification_name)
+                n_scanned += len(batch)
+
+                for entry_name, spec_name, record_id, modified_on in batch:
+                    existing = existing_records.pop((entry_name, spec_name), None)
+                    if existing != (record_id, modified_on.isoformat()):
+                        to_update.append((entry_name, spec_name, record_id))
+
+            # Fetch & serialize full batches of changed records (or whatever is left, if we are done)
+            while len(to_update) >= batch_size or (to_update and not batch):
+                update_batch, to_update = to_update[:batch_size], to_update[batch_size:]
+
+                # Records are stored in the same form the client gets them from the server
+                record_data = socket.records.get([x[2] for x in update_batch], session=fractal_session)
+                items = [
+                    {"entry_name": x[0], "specification_name": x[1], "record_id": x[2], "record": r}
+                    for x, r in zip(update_batch, record_data)
+                ]
+
+                # Split among the workers
+                chunk_size = max(1, len(items) // n_workers)
+                pending.append(
+                    [
+                        executor.submit(_serialize_record_items, items[i : i + chunk_size])
+                        for i in range(0, len(items), chunk_size)
+                    ]
+                )
 
-            count = 0
-            for item_orm in batch:
-                item_bytes = _serialize_orm(item_orm)
+                # Write the previous batch while this one is being compressed
+                while len(pending) > 1:
+                    for fut in pending.pop(0):
+                        _write_rows(fut.result())
 
-                view_record_orm = DatasetViewRecord(
-                    entry_name=item_orm.entry_name,
-                    specification_name=item_orm.specification_name,
-                    data=item_bytes,
-                )
+            if job_progress is not None and total_records > 0:
+                job_progress.update_progress(int(100 * n_scanned / total_records))
+
+            if not batch:
+                break
 
-                view_session.add(view_record_orm)
-                count += 1
+        # Write everything that is left
+        for futures in pending:
+            for fut in futures:
+                _write_rows(fut.result())
+
+    # Remove records no longer on the server
+    if existing_records:
+        to_delete = [{"del_entry": k[0], "del_spec": k[1]} for k in existing_records.keys()]
+        for table in (record_table, info_table, property_table):
+            view_conn.execute(
+                delete(table).where(
+                    table.c.entry_name == bindparam("del_entry"),
+                    table.c.specification_name == bindparam("del_spec"),
+                ),
+                to_delete,
+            )
+
+    return True
+
+
+def _run_view_build(
+    dataset_id: int,
+    socket: SQLAlchemySocket,
+    view_file_path: str,
+    is_new: bool,
+    batch_size: int,
+    max_compression_workers: int,
+    job_progress: Optional[JobProgress],
+    session: Optional[Session],
+) -> None:
+    """
+    Writes a view file in a single transaction, handling cleanup on cancellation/failure
+    """
 
+    uri = "sqlite:///" + view_file_path
+    engine = create_engine(uri)
+    event.listen(engine, "connect", _set_build_pragmas if is_new else _set_refresh_pragmas)
+    ViewSession = sessionmaker(bind=engine)
+
+    if is_new:
+        ViewBaseORM.metadata.create_all(engine)
+
+    view_session = ViewSession()
+    completed = False
+
+    try:
+        with socket.optional_session(session, True) as fractal_session:
+            finished = _write_view(
+                dataset_id,
+                socket,
+                view_session,
+                fractal_session,
+                batch_size,
+                max(1, max_compression_workers),
+                job_progress,
+            )
+
+        if not finished:
+            _logger.info(f"Writing of view for dataset {dataset_id} was cancelled")
+            view_session.rollback()
+        else:
             view_session.commit()
+            completed = True
+
+    finally:
+        view_session.close()
+
+        if completed or not is_new:
+            # Convert back to a single, self-contained file
+            with engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA journal_mode=DELETE")
+
+        engine.dispose()
+
+        # Remove a partially-written new file. Existing files are left as they were, since
+        # all changes were made in a single transaction
+        if not completed and is_new:
+            for f in (view_file_path, view_file_path + "-wal", view_file_path + "-shm"):
+                if os.path.exists(f):
+                    os.remove(f)
+
+
+def create_dataset_view(
+    dataset_id: int,
+    socket: SQLAlchemySocket,
+    view_file_path: str,
+    *,
+    batch_size: int = 1000,
+    max_compression_workers: int = 4,
+    job_progress: Optional[JobProgress] = None,
+    session: Optional[Session] = None,
+) -> None:
+    """
+    Creates a view of a dataset, stored in an SQLite file
+
+    Record items are read from the database using keyset pagination (on the primary key of the
+    record item table), and the entire view is written in a single SQLite transaction.
+    Serialization/compression of a batch happens in a pool of worker threads while the next batch
+    is being read from the database.
+
+    Along with the full records, the status and properties of each record are stored in separate
+    tables so that they can be read without deserializing the records.
+
+    If the job is cancelled (via `job_progress`) or an exception is raised, the partially-written
+    file is removed.
+
+    Parameters
+    ----------
+    dataset_id
+        ID of the dataset to create a view of
+    socket
+        Socket to the server database
+    view_file_path
+        Path of the file to create. Must not already exist
+    batch_size
+        Number of record items to read from the database at a time
+    max_compression_workers
+        Maximum number of threads to use to serialize/compress the data
+    job_progress
+        Object used to report progress and check for cancellation, if running as an internal job
+    session
+        An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+        is used, it will be flushed (but not committed) before returning from this function.
+    """
 
-            if count == 0:
-                break
+    if os.path.isdir(view_file_path):
+        raise RuntimeError(f"{view_file_path} is a directory")
+
+    if os.path.exists(view_file_path):
+        raise RuntimeError(f"File {view_file_path} exists - will not overwrite")
 
-            skip += count
+    _run_view_build(
+        dataset_id, socket, view_file_path, True, batch_size, max_compression_workers, job_progress, session
+    )
+
+
+def refresh_dataset_view(
+    dataset_id: int,
+    socket: SQLAlchemySocket,
+    view_file_path: str,
+    *,
+    batch_size: int = 1000,
+    max_compression_workers: int = 4,
+    job_progress: Optional[JobProgress] = None,
+    session: Optional[Session] = None,
+) -> None:
+    """
+    Updates an existing view of a dataset with the current data on the server
+
+    Only records that were added, removed, or modified (based on their modified_on) since the view
+    was created or last refreshed are re-serialized. Entries and specifications are updated in place.
+
+    All changes are made in a single SQLite transaction. If the job is cancelled (via `job_progress`)
+    or an exception is raised, the view file is left unchanged.
+
+    Parameters
+    ----------
+    dataset_id
+        ID of the dataset the view is of
+    socket
+        Socket to the server database
+    view_file_path
+        Path of the existing view file
+    batch_size
+        Number of record items to read from the database at a time
+    max_compression_workers
+        Maximum number of threads to use to serialize/compress the data
+    job_progress
+        Object used to report progress and check for cancellation, if running as an internal job
+    session
+        An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+        is used, it will be flushed (but not committed) before returning from this function.
+    """
+
+    if not os.path.isfile(view_file_path):
+        raise RuntimeError(f"View file {view_file_path} does not exist or is not a file")
+
+    # Check that the view is of this dataset, and was created with record info (containing modified_on)
+    engine = create_engine("sqlite:///" + view_file_path)
+    try:
+        with engine.connect() as conn:
+            info_columns = {x[1] for x in conn.exec_driver_sql("PRAGMA table_info(dataset_record_info)")}
+            if "modified_on" not in info_columns:
+                raise RuntimeError(f"View file {view_file_path} is from an older version and cannot be refreshed")
+
+            stmt = select(DatasetViewMetadata.value).where(DatasetViewMetadata.key == "raw_data")
+            view_dataset_id = _deserialize_data(conn.execute(stmt).scalar_one())["id"]
+            if view_dataset_id != dataset_id:
+                raise RuntimeError(f"View file {view_file_path} is of dataset {view_dataset_id}, not {dataset_id}")
+    finally:
+        engine.dispose()
+
+    _run_view_build(
+        dataset_id, socket, view_file_path, False, batch_size, max_compression_workers, job_progress, session
+    )
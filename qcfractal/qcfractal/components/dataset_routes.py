@@ -10,6 +10,7 @@ from qcportal.dataset_models import (
     DatasetAddBody,
     DatasetQueryModel,
     DatasetFetchRecordsBody,
+    DatasetFetchRecordDataBody,
     DatasetFetchEntryBody,
     DatasetSubmitBody,
     DatasetDeleteStrBody,
@@ -265,6 +266,27 @@ def fetch_dataset_records_v1(dataset_type: str, dataset_id: int, body_data: Data
     )
 
 
+@api_v1.route("/datasets/<string:dataset_type>/<int:dataset_id>/records/bulkFetchData", methods=["POST"])
+@wrap_route("READ")
+def fetch_dataset_record_data_v1(dataset_type: str, dataset_id: int, body_data: DatasetFetchRecordDataBody):
+    limit = current_app.config["QCFRACTAL_CONFIG"].api_limits.get_records
+
+    n_requested = len(body_data.entry_names) * len(body_data.specification_names)
+    if n_requested > limit:
+        raise LimitExceededError(f"Cannot get {n_requested} dataset records - limit is {limit}")
+
+    ds_socket = storage_socket.datasets.get_socket(dataset_type)
+
+    return ds_socket.fetch_record_data(
+        dataset_id,
+        entry_names=body_data.entry_names,
+        specification_names=body_data.specification_names,
+        status=body_data.status,
+        include=body_data.include,
+        exclude=body_data.exclude,
+    )
+
+
 @api_v1.route("/datasets/<string:dataset_type>/<int:dataset_id>/records/bulkDelete", methods=["POST"])
 @wrap_route("DELETE")
 def remove_dataset_records_v1(dataset_type: str, dataset_id: int, body_data: DatasetRemoveRecordsBody):
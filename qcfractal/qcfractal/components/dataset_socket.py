@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import logging
+from datetime import datetime
 from typing import TYPE_CHECKING
 
 from sqlalchemy import select, delete, func, union, text, and_
@@ -22,6 +23,7 @@ if TYPE_CHECKING:
     from qcportal.dataset_models import DatasetModifyMetadata
     from qcfractal.db_socket.socket import SQLAlchemySocket
     from qcfractal.db_socket.base_orm import BaseORM
+    from qcfractal.components.internal_jobs.status import JobProgress
     from typing import Dict, Any, Optional, Sequence, Iterable, Tuple, List, Union
 
 
@@ -991,6 +993,57 @@ class BaseDatasetSocket:
             record_items = session.execute(stmt).scalars().all()
             return [(x.entry_name, x.specification_name, x.record_id) for x in record_items]
 
+    def fetch_record_data(
+        self,
+        dataset_id: int,
+        entry_names: Optional[Iterable[str]] = None,
+        specification_names: Optional[Iterable[str]] = None,
+        status: Optional[Iterable[RecordStatusEnum]] = None,
+        include: Optional[Sequence[str]] = None,
+        exclude: Optional[Sequence[str]] = None,
+        *,
+        session: Optional[Session] = None,
+    ) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """
+        Obtain records of a dataset from the database, along with the entry and specification they belong to
+
+        This is the same as :meth:`fetch_records`, but returns the full record data (with projection)
+        rather than just the record id.
+
+        The returned list is in an indeterminant order
+
+        Parameters
+        ----------
+        dataset_id
+            ID of a dataset
+        entry_names
+            Fetch records belonging to these entries. If None, fetch records belonging to any entry.
+        specification_names
+            Fetch records belonging to these specifications. If None, fetch records belonging to any specification.
+        status
+            Fetch records whose status is in the given list (or other iterable) of statuses
+        include
+            Which fields of the records to return. Default is to return all fields.
+        exclude
+            Remove these fields from the returned records
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+
+        Returns
+        -------
+        :
+            A list of record information in the form (entry_name, specification_name, record_dict)
+        """
+
+        with self.root_socket.optional_session(session, True) as session:
+            record_items = self.fetch_records(dataset_id, entry_names, specification_names, status, session=session)
+
+            record_ids = [x[2] for x in record_items]
+            record_data = self.root_socket.records.get(record_ids, include, exclude, session=session)
+
+            return [(x[0], x[1], r) for x, r in zip(record_items, record_data)]
+
     def remove_records(
         self,
         dataset_id: int,
@@ -1546,3 +1599,75 @@ class DatasetSocket:
         with self.root_socket.optional_session(session, True) as session:
             cv = session.execute(stmt).scalars().all()
             return [x.model_dict() for x in cv]
+
+    def add_create_view_internal_job(
+        self,
+        dataset_id: int,
+        view_file_path: str,
+        user_id: Optional[int] = None,
+        *,
+        refresh: bool = False,
+        session: Optional[Session] = None,
+    ) -> int:
+        """
+        Adds an internal job that creates a view of a dataset
+
+        Parameters
+        ----------
+        dataset_id
+            ID of the dataset to create a view of
+        view_file_path
+            Path (on the server) of the view file to create. Must not already exist, unless refreshing
+        user_id
+            The user requesting the view
+        refresh
+            If True, update an existing view file rather than create a new one
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+
+        Returns
+        -------
+        :
+            ID of the internal job
+        """
+
+        with self.root_socket.optional_session(session) as session:
+            # Make sure the dataset exists
+            self.lookup_type(dataset_id, session=session)
+
+            return self.root_socket.internal_jobs.add(
+                f"create_view_{dataset_id}",
+                datetime.utcnow(),
+                "datasets.create_view",
+                {"dataset_id": dataset_id, "view_file_path": view_file_path, "refresh": refresh},
+                user_id=user_id,
+                unique_name=True,
+                session=session,
+            )
+
+    def create_view(
+        self,
+        dataset_id: int,
+        view_file_path: str,
+        *,
+        refresh: bool = False,
+        session: Session,
+        job_progress: Optional[JobProgress] = None,
+    ) -> None:
+        """
+        Creates (or refreshes) a view of a dataset, stored in an SQLite file on the server
+
+        This is meant to be run as an internal job (see :meth:`add_create_view_internal_job`)
+        """
+
+        from qcfractal.components.create_view import create_dataset_view, refresh_dataset_view
+
+        if refresh:
+            refresh_dataset_view(
+                dataset_id, self.root_socket, view_file_path, job_progress=job_progress, session=session
+            )
+        else:
+            create_dataset_view(
+                dataset_id, self.root_socket, view_file_path, job_progress=job_progress, session=session
+            )
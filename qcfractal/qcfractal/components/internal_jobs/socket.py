@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import logging
 import select as io_select
+import threading
 import traceback
 import uuid
 from datetime import datetime, timedelta
@@ -10,7 +11,7 @@ from socket import gethostname
 from typing import TYPE_CHECKING
 
 import psycopg2.extensions
-from sqlalchemy import select, delete, update, and_, or_
+from sqlalchemy import select, delete, update, and_, or_, not_, true, func
 from sqlalchemy.dialects.postgresql import insert
 
 from qcfractal.components.auth.db_models import UserIDMapSubquery
@@ -25,7 +26,8 @@ if TYPE_CHECKING:
     from typing import Optional, Dict, Any
     from sqlalchemy.orm.session import Session
     from qcfractal.db_socket.socket import SQLAlchemySocket
-    from typing import Dict, Optional, Any, List
+    from typing import Dict, Optional, Any, List, Set, Iterable
+    from sqlalchemy.sql import ColumnElement
 
 _default_error = {"error_type": "not_supplied", "error_message": "No error message found on task."}
 
@@ -41,6 +43,10 @@ class InternalJobSocket:
         # Hardcoded for now
         self._update_frequency = 5
 
+        # Lanes of job runners, and limits on how many jobs of a function can run at once
+        self._lanes = root_socket.qcf_config.internal_job_lanes
+        self._function_limits = root_socket.qcf_config.internal_job_function_limits
+
     def add(
         self,
         name: str,
@@ -326,13 +332,99 @@ class InternalJobSocket:
                 after_func(**job_orm.after_function_kwargs, session=session)
             session.commit()
 
-    def _wait_for_job(self, session: Session, logger, conn, end_event) -> Optional[InternalJobORM]:
+    @staticmethod
+    def _function_condition(functions: Iterable[str]) -> ColumnElement:
+        """
+        Creates a condition matching jobs that run any of the given functions
+
+        Entries ending in `.*` match all functions of that socket (ie, `services.*`)
+        """
+
+        conds = []
+        for f in functions:
+            if f.endswith(".*"):
+                conds.append(InternalJobORM.function.startswith(f[:-1], autoescape=True))
+            else:
+                conds.append(InternalJobORM.function == f)
+        return or_(*conds)
+
+    def _lane_condition(self, lane: Optional[str]) -> ColumnElement:
+        """
+        Creates a condition matching jobs that are to be run in the given lane
+
+        If `lane` is None, all jobs are matched
+        """
+
+        if lane is None:
+            return true()
+
+        lane_functions = self._lanes[lane].functions
+        if lane_functions is not None:
+            return self._function_condition(lane_functions)
+
+        # This lane runs everything not handled by the other lanes
+        other_functions = [f for x in self._lanes.values() if x.functions is not None for f in x.functions]
+        if not other_functions:
+            return true()
+        return not_(self._function_condition(other_functions))
+
+    def _check_function_limits(self, session: Session, job_orm: InternalJobORM, dead: datetime) -> Optional[str]:
+        """
+        Checks if another job running the same function can be started
+
+        This takes a transaction-level advisory lock for each limit that applies to the job, so
+        that runners checking the same limit at the same time do so one after another. These are held
+        until the session is committed or rolled back.
+
+        Returns
+        -------
+        :
+            None if the job can be run, otherwise the key of the limit that has been reached
+        """
+
+        for key, limit in self._function_limits.items():
+            if key.endswith(".*"):
+                applies = job_orm.function.startswith(key[:-1])
+            else:
+                applies = job_orm.function == key
+
+            if not applies:
+                continue
+
+            session.execute(select(func.pg_advisory_xact_lock(func.hashtext(f"internal_jobs:{key}"))))
+
+            stmt = select(func.count()).select_from(InternalJobORM)
+            stmt = stmt.where(self._function_condition([key]))
+            stmt = stmt.where(InternalJobORM.status == InternalJobStatusEnum.running)
+            stmt = stmt.where(InternalJobORM.last_updated >= dead)
+            stmt = stmt.where(InternalJobORM.id != job_orm.id)
+
+            if session.execute(stmt).scalar_one() >= limit:
+                return key
+
+        return None
+
+    def _wait_for_job(
+        self,
+        session: Session,
+        logger,
+        conn,
+        end_event,
+        lane: Optional[str] = None,
+        excluded_functions: Optional[Set[str]] = None,
+    ) -> Optional[InternalJobORM]:
         """
         Blocks until a job is possibly available to run
+
+        If `excluded_functions` is given, jobs running those functions are ignored (they are
+        at their limit), and this function will wait at most one update period.
         """
 
         next_job_stmt = select(InternalJobORM.scheduled_date)
         next_job_stmt = next_job_stmt.where(InternalJobORM.status == InternalJobStatusEnum.waiting)
+        next_job_stmt = next_job_stmt.where(self._lane_condition(lane))
+        if excluded_functions:
+            next_job_stmt = next_job_stmt.where(not_(self._function_condition(excluded_functions)))
         next_job_stmt = next_job_stmt.order_by(InternalJobORM.scheduled_date.asc())
 
         # Skip any that are being claimed for running right now
@@ -359,6 +451,11 @@ class InternalJobSocket:
             else:
                 total_to_wait = (next_job_time - now).total_seconds()
 
+            # Jobs that are at their limit may be able to run after another one finishes
+            # (which doesn't send a notification), so check again after a while
+            if excluded_functions:
+                total_to_wait = min(total_to_wait, self._update_frequency)
+
             session.rollback()  # Release the transaction (and row level lock)
 
             # If this is <= 0, we don't have to wait
@@ -403,7 +500,45 @@ class InternalJobSocket:
         cursor.execute("UNLISTEN check_internal_jobs;")
         cursor.close()
 
-    def run_loop(self, end_event):
+    def run_lanes(self, end_event):
+        """
+        Runs all the configured lanes of job runners, each in their own thread(s)
+
+        This function blocks until `end_event` is set. If any of the runner threads
+        exits unexpectedly, all the others are stopped and an exception is raised.
+
+        Parameters
+        ----------
+        end_event
+            An event (threading.Event, multiprocessing.Event) that, when set, will
+            stop all the runners
+        """
+
+        # Clean up engine connections after a fork
+        self.root_socket.post_fork_cleanup()
+
+        threads = []
+        for lane, lane_config in self._lanes.items():
+            for i in range(lane_config.threads):
+                th = threading.Thread(
+                    target=self._run_loop, args=(end_event, lane), name=f"internal_job_runner:{lane}:{i}"
+                )
+                th.start()
+                threads.append(th)
+
+        try:
+            while not end_event.is_set():
+                dead_threads = [th.name for th in threads if not th.is_alive()]
+                if dead_threads:
+                    raise RuntimeError("Internal job runner thread(s) died: " + ", ".join(dead_threads))
+
+                end_event.wait(2.0)
+        finally:
+            end_event.set()
+            for th in threads:
+                th.join()
+
+    def run_loop(self, end_event, lane: Optional[str] = None):
         """
         Runs in a infinite loop, checking for jobs and running them
 
@@ -412,16 +547,25 @@ class InternalJobSocket:
         end_event
             An event (threading.Event, multiprocessing.Event) that, when set, will
             stop this loop
+        lane
+            Only run jobs that belong to this lane (see the `internal_job_lanes` configuration).
+            If None, run all jobs
         """
 
         # Clean up engine connections after a fork
         self.root_socket.post_fork_cleanup()
 
+        self._run_loop(end_event, lane)
+
+    def _run_loop(self, end_event, lane: Optional[str]):
         # give this loop a unique uuid
         runner_uuid = str(uuid.uuid4())
 
         # Get a uuid-specific logger
-        logger = logging.getLogger(f"internal_job_runner:{runner_uuid}")
+        if lane is None:
+            logger = logging.getLogger(f"internal_job_runner:{runner_uuid}")
+        else:
+            logger = logging.getLogger(f"internal_job_runner:{lane}:{runner_uuid}")
 
         # Two sessions - one for the object, and one for the job status object
         session_main = self.root_socket.Session()
@@ -437,6 +581,10 @@ class InternalJobSocket:
         stmt = select(InternalJobORM)
         stmt = stmt.order_by(InternalJobORM.scheduled_date.asc()).limit(1)
         stmt = stmt.with_for_update(skip_locked=True)
+        stmt = stmt.where(self._lane_condition(lane))
+
+        # Functions whose jobs can't be run right now, because they are at their limit
+        excluded_functions = set()
 
         while True:
             if end_event.is_set():
@@ -453,13 +601,27 @@ class InternalJobSocket:
             cond2 = and_(InternalJobORM.status == InternalJobStatusEnum.running, InternalJobORM.last_updated < dead)
 
             stmt_now = stmt.where(or_(cond1, cond2))
+            if excluded_functions:
+                stmt_now = stmt_now.where(not_(self._function_condition(excluded_functions)))
+
             job_orm = session_main.execute(stmt_now).scalar_one_or_none()
 
+            # Is there a limit on how many of these can be run at once?
+            if job_orm is not None and self._function_limits:
+                limit_key = self._check_function_limits(session_main, job_orm, dead)
+                if limit_key is not None:
+                    job_id = job_orm.id
+                    session_main.rollback()  # release the transaction and the lock on the job
+                    logger.debug(f"job {job_id} not started - limit reached for {limit_key}")
+                    excluded_functions.add(limit_key)
+                    continue
+
             # If no job was found, wait for one
             if job_orm is None:
                 session_main.rollback()  # release the transaction
                 logger.debug("no jobs found")
-                self._wait_for_job(session_main, logger, conn, end_event)
+                self._wait_for_job(session_main, logger, conn, end_event, lane, excluded_functions)
+                excluded_functions.clear()
 
                 if end_event.is_set():
                     logger.info("shutting down")
@@ -487,6 +649,9 @@ class InternalJobSocket:
             # Stop the updating thread and cleanup
             job_progress.stop()
 
+            # Other jobs may have finished while this one was running
+            excluded_functions.clear()
+
         session_main.close()
         session_status.close()
         conn.close()
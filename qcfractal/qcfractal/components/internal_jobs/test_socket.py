@@ -8,6 +8,7 @@ from typing import TYPE_CHECKING
 
 from qcfractal.components.internal_jobs.db_models import InternalJobORM
 from qcfractal.components.internal_jobs.socket import InternalJobSocket
+from qcfractal.config import InternalJobLaneConfig
 from qcportal.internal_jobs import InternalJobStatusEnum
 
 if TYPE_CHECKING:
@@ -141,3 +142,73 @@ def test_internal_jobs_socket_recover(storage_socket: SQLAlchemySocket, session:
     finally:
         end_event.set()
         th.join()
+
+
+def test_internal_jobs_socket_lanes(storage_socket: SQLAlchemySocket, session: Session, monkeypatch):
+    lanes = {
+        "dummy": InternalJobLaneConfig(functions=["internal_jobs.dummy_job"]),
+        "default": InternalJobLaneConfig(),
+    }
+    monkeypatch.setattr(storage_socket.internal_jobs, "_lanes", lanes)
+
+    id_1 = storage_socket.internal_jobs.add(
+        "dummy_job", datetime.utcnow(), "internal_jobs.dummy_job", {"iterations": 2}, None, unique_name=False
+    )
+
+    # Runs in the default lane only - shouldn't pick up the job
+    end_event = threading.Event()
+    th = threading.Thread(target=storage_socket.internal_jobs.run_loop, args=(end_event, "default"))
+    th.start()
+    time.sleep(3)
+
+    try:
+        job_1 = session.get(InternalJobORM, id_1)
+        assert job_1.status == InternalJobStatusEnum.waiting
+    finally:
+        end_event.set()
+        th.join()
+
+    end_event = threading.Event()
+    th = threading.Thread(target=storage_socket.internal_jobs.run_loop, args=(end_event, "dummy"))
+    th.start()
+    time.sleep(5)
+
+    try:
+        session.expire(job_1)
+        job_1 = session.get(InternalJobORM, id_1)
+        assert job_1.status == InternalJobStatusEnum.complete
+    finally:
+        end_event.set()
+        th.join()
+
+
+def test_internal_jobs_socket_function_limits(storage_socket: SQLAlchemySocket, session: Session, monkeypatch):
+    monkeypatch.setattr(storage_socket.internal_jobs, "_function_limits", {"internal_jobs.*": 1})
+
+    id_1 = storage_socket.internal_jobs.add(
+        "dummy_job", datetime.utcnow(), "internal_jobs.dummy_job", {"iterations": 4}, None, unique_name=False
+    )
+    id_2 = storage_socket.internal_jobs.add(
+        "dummy_job", datetime.utcnow(), "internal_jobs.dummy_job", {"iterations": 4}, None, unique_name=False
+    )
+
+    end_event = threading.Event()
+    threads = [threading.Thread(target=storage_socket.internal_jobs.run_loop, args=(end_event,)) for _ in range(2)]
+    for th in threads:
+        th.start()
+
+    try:
+        # Only one of the jobs can be running at a time
+        time.sleep(2)
+        jobs = [session.get(InternalJobORM, x) for x in (id_1, id_2)]
+        assert sorted(x.status for x in jobs) == [InternalJobStatusEnum.running, InternalJobStatusEnum.waiting]
+
+        time.sleep(12)
+        for job in jobs:
+            session.expire(job)
+        jobs = [session.get(InternalJobORM, x) for x in (id_1, id_2)]
+        assert all(x.status == InternalJobStatusEnum.complete for x in jobs)
+    finally:
+        end_event.set()
+        for th in threads:
+            th.join()
@@ -5,10 +5,13 @@ from typing import TYPE_CHECKING
 
 import pytest
 from pydantic import ValidationError
+from requests.exceptions import ConnectionError
 
 from qcfractal.components.singlepoint.testing_helpers import submit_test_data
+from qcfractalcompute.compress import compress_result
 from qcportal import PortalRequestError
 from qcportal.managers import ManagerName, ManagerStatusEnum
+from qcportal.record_models import RecordStatusEnum
 
 if TYPE_CHECKING:
     from qcarchivetesting.testing_classes import QCATestingSnowflake
@@ -297,3 +300,83 @@ def test_manager_mclient_heartbeat_deactivated(snowflake: QCATestingSnowflake):
 
     with pytest.raises(PortalRequestError, match=r"is not active") as err:
         mclient1.heartbeat(total_cpu_hours=5.678, active_tasks=3, active_cores=10, active_memory=3.45)
+
+
+def test_manager_mclient_return_and_claim(snowflake: QCATestingSnowflake):
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-5678")
+    mclient1 = snowflake.manager_client(mname1)
+
+    programs = {"qcengine": ["unknown"], "psi4": ["unknown"]}
+    mclient1.activate(manager_version="v2.0", programs=programs, tags=["tag1"])
+
+    storage_socket = snowflake.get_storage_socket()
+
+    test_names = [
+        "sp_psi4_benzene_energy_1",
+        "sp_psi4_benzene_energy_2",
+        "sp_psi4_benzene_energy_3",
+        "sp_psi4_peroxide_energy_wfn",
+    ]
+    results = {}
+    for name in test_names:
+        record_id, result_data = submit_test_data(storage_socket, name, "tag1")
+        results[record_id] = compress_result(result_data.dict())
+
+    tasks = mclient1.claim(programs, ["tag1"], 3)
+    assert len(tasks) == 3
+
+    # More than the server return limit, so sent in multiple requests
+    to_return = {t.id: results[t.record_id] for t in tasks}
+    rmeta, new_tasks = mclient1.return_and_claim(to_return, programs, ["tag1"], 5)
+    assert rmeta.success
+    assert sorted(rmeta.accepted_ids) == sorted(to_return.keys())
+    assert len(new_tasks) == 1
+    assert new_tasks[0].record_id not in [t.record_id for t in tasks]
+
+    # Nothing to return, nothing left to claim
+    rmeta, new_tasks = mclient1.return_and_claim({}, programs, ["tag1"], 5)
+    assert rmeta.n_accepted == 0
+    assert new_tasks == []
+
+    records = snowflake.client().get_records([t.record_id for t in tasks])
+    assert all(r.status == RecordStatusEnum.complete for r in records)
+
+
+def test_manager_mclient_return_and_claim_error(snowflake: QCATestingSnowflake, monkeypatch):
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-5678")
+    mclient1 = snowflake.manager_client(mname1)
+
+    programs = {"qcengine": ["unknown"], "psi4": ["unknown"]}
+    mclient1.activate(manager_version="v2.0", programs=programs, tags=["tag1"])
+
+    storage_socket = snowflake.get_storage_socket()
+
+    test_names = [
+        "sp_psi4_benzene_energy_1",
+        "sp_psi4_benzene_energy_2",
+        "sp_psi4_benzene_energy_3",
+        "sp_psi4_peroxide_energy_wfn",
+    ]
+    results = {}
+    for name in test_names:
+        record_id, result_data = submit_test_data(storage_socket, name, "tag1")
+        results[record_id] = compress_result(result_data.dict())
+
+    tasks = mclient1.claim(programs, ["tag1"], 3)
+    assert len(tasks) == 3
+    to_return = {t.id: results[t.record_id] for t in tasks}
+    assert len(mclient1._chunk_results(to_return)) > 1
+
+    # Sending one of the plain chunks fails
+    def _return_chunk(results_compressed):
+        raise ConnectionError("server went away")
+
+    monkeypatch.setattr(mclient1, "_return_chunk", _return_chunk)
+
+    with pytest.raises(ConnectionError):
+        mclient1.return_and_claim(to_return, programs, ["tag1"], 5)
+
+    # Nothing was claimed, since the caller would not run the tasks
+    remaining_id = [x for x in results.keys() if x not in [t.record_id for t in tasks]]
+    records = snowflake.client().get_records(remaining_id)
+    assert records[0].status == RecordStatusEnum.waiting
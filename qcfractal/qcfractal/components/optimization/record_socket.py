@@ -325,13 +325,18 @@ class OptimizationRecordSocket(BaseRecordSocket):
                     (OptimizationRecordORM.id,),
                     lock_id=optimization_insert_lock_id,
                 )
-                return meta, [x[0] for x in ids]
+                ids = [x[0] for x in ids]
             else:
                 session.add_all(all_orm)
                 session.flush()
                 meta = InsertMetadata(inserted_idx=list(range(len(all_orm))))
+                ids = [x.id for x in all_orm]
 
-                return meta, [x.id for x in all_orm]
+            # Generate the task specifications in the background, rather than when they are claimed
+            if meta.n_inserted > 0:
+                self.root_socket.tasks.add_internal_job_generate_specifications(session=session)
+
+            return meta, ids
 
     def add(
         self,
@@ -20,7 +20,7 @@ from sqlalchemy import (
     event,
 )
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import relationship, deferred
+from sqlalchemy.orm import relationship, deferred, object_session, undefer
 from sqlalchemy.orm.collections import attribute_keyed_dict
 
 from qcfractal.components.auth.db_models import UserORM, GroupORM, UserIDMapSubquery, GroupIDMapSubquery
@@ -88,6 +88,29 @@ class RecordInfoBackupORM(BaseORM):
         return BaseORM.model_dict(self, exclude)
 
 
+class OutputChunkORM(BaseORM):
+    """
+    Table for storing text appended to an output
+
+    Only the appended text is compressed and stored. Chunks are merged back into
+    the output later by a compaction job.
+    """
+
+    __tablename__ = "output_store_chunk"
+
+    id = Column(Integer, primary_key=True)
+    output_id = Column(Integer, ForeignKey("output_store.id", ondelete="cascade"), nullable=False)
+
+    compression_type = Column(Enum(CompressionEnum), nullable=False)
+    compression_level = Column(Integer, nullable=False)
+    data = deferred(Column(LargeBinary, nullable=False))
+
+    __table_args__ = (Index("ix_output_store_chunk_output_id", "output_id"),)
+
+    def get_output(self) -> Any:
+        return decompress(self.data, self.compression_type)
+
+
 class OutputStoreORM(BaseORM):
     """
     Table for storing raw computation outputs (text) and errors (json)
@@ -103,14 +126,31 @@ class OutputStoreORM(BaseORM):
     compression_level = Column(Integer, nullable=False)
     data = deferred(Column(LargeBinary, nullable=False))
 
+    # Text appended to this output that has not been merged into it yet
+    chunks = relationship(
+        OutputChunkORM,
+        lazy="write_only",
+        order_by=OutputChunkORM.id,
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
     __table_args__ = (UniqueConstraint("history_id", "output_type", name="ux_output_store_id_type"),)
 
     def get_output(self) -> Any:
-        return decompress(self.data, self.compression_type)
+        output = decompress(self.data, self.compression_type)
+
+        session = object_session(self)
+        if session is not None and self.id is not None:
+            stmt = self.chunks.select().options(undefer(OutputChunkORM.data))
+            for chunk in session.execute(stmt).scalars():
+                output += chunk.get_output()
+
+        return output
 
     def model_dict(self, exclude: Optional[Iterable[str]] = None) -> Dict[str, Any]:
         # Fields not in model
-        exclude = self.append_exclude(exclude, "id", "history_id", "compression_level")
+        exclude = self.append_exclude(exclude, "id", "history_id", "compression_level", "chunks")
 
         return BaseORM.model_dict(self, exclude)
 
@@ -1,11 +1,11 @@
 from __future__ import annotations
 
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import TYPE_CHECKING
 
 from qcelemental.models import FailedOperation
-from sqlalchemy import select, union, or_
+from sqlalchemy import select, union, union_all, or_, delete, literal
 from sqlalchemy.orm import (
     joinedload,
     selectinload,
@@ -21,7 +21,7 @@ from sqlalchemy.orm import (
 from qcfractal.components.auth.db_models import UserIDMapSubquery, GroupIDMapSubquery
 from qcfractal.components.managers.db_models import ComputeManagerORM
 from qcfractal.components.services.db_models import ServiceQueueORM, ServiceDependencyORM
-from qcfractal.components.tasks.db_models import TaskQueueORM
+from qcfractal.components.tasks.db_models import TaskQueueORM, TaskReturnStagingORM
 from qcfractal.db_socket.helpers import (
     get_general,
     delete_general,
@@ -38,6 +38,7 @@ from .record_db_models import (
     RecordInfoBackupORM,
     RecordCommentORM,
     OutputStoreORM,
+    OutputChunkORM,
     NativeFileORM,
 )
 
@@ -45,6 +46,7 @@ if TYPE_CHECKING:
     from sqlalchemy.orm.session import Session
     from sqlalchemy.sql import Select
     from qcfractal.db_socket.socket import SQLAlchemySocket
+    from qcfractal.components.internal_jobs.status import JobProgress
     from qcportal.all_results import AllResultTypes
     from qcportal.record_models import RecordQueryFilters
     from typing import List, Dict, Tuple, Optional, Sequence, Any, Iterable, Type
@@ -77,6 +79,58 @@ def build_extras_properties(result: AllResultTypes) -> Tuple[Dict[str, Any], Dic
     return extras, new_prop
 
 
+# Relationships of a record that are not loaded by default, but can be requested via "include".
+# These are loaded along with the records in bulk (one additional query per relationship),
+# and are returned under the same names as the fields of the record models (ie, "compute_history_")
+record_include_relationships = ("compute_history", "comments", "task", "service", "native_files")
+
+
+def get_records_with_includes(
+    session: Session,
+    orm_type: Any,
+    record_ids: Sequence[int],
+    include: Optional[Iterable[str]],
+    exclude: Optional[Iterable[str]],
+    missing_ok: bool,
+) -> List[Optional[Dict[str, Any]]]:
+    """
+    Obtain records with the given ids, loading any included relationships in bulk
+
+    This wraps :func:`get_general`. Any relationships in `include` that are also in
+    `record_include_relationships` are loaded for all records at once, rather than requiring
+    a separate query (and request) for each record.
+    """
+
+    rels_to_load = []
+    load_options = []
+
+    if include is not None:
+        include = list(include)
+        rels_to_load = [x for x in record_include_relationships if x in include]
+        include = [x for x in include if x not in rels_to_load]
+
+        for rel in rels_to_load:
+            if rel == "service":
+                load_options.append(
+                    selectinload(orm_type.service).options(
+                        undefer("*"), selectinload(ServiceQueueORM.dependencies).options(undefer("*"))
+                    )
+                )
+            else:
+                load_options.append(selectinload(getattr(orm_type, rel)))
+
+    records = get_general(session, orm_type, orm_type.id, record_ids, include, exclude, missing_ok, load_options)
+
+    for r in records:
+        if r is None:
+            continue
+
+        for rel in rels_to_load:
+            r[rel + "_"] = r.pop(rel, None)
+
+    return records
+
+
 class BaseRecordSocket:
     """
     Base class for all record sockets
@@ -111,7 +165,14 @@ class BaseRecordSocket:
         Create an entry in the task queue, and attach it to the given record ORM
         """
 
-        record_orm.task = TaskQueueORM(tag=tag, priority=priority, required_programs=record_orm.required_programs)
+        # created_on of the record may not be set yet (if it has not been flushed to the database)
+        # The task is sorted by that date, so make sure it is set now
+        if record_orm.created_on is None:
+            record_orm.created_on = datetime.utcnow()
+
+        record_orm.task = TaskQueueORM(
+            tag=tag, priority=priority, required_programs=record_orm.required_programs, sort_date=record_orm.created_on
+        )
 
     @staticmethod
     def create_service(record_orm: BaseRecordORM, tag: str, priority: PriorityEnum, find_existing: bool) -> None:
@@ -159,7 +220,7 @@ class BaseRecordSocket:
         """
 
         with self.root_socket.optional_session(session, True) as session:
-            return get_general(session, self.record_orm, self.record_orm.id, record_ids, include, exclude, missing_ok)
+            return get_records_with_includes(session, self.record_orm, record_ids, include, exclude, missing_ok)
 
     def generate_task_specification(self, record_orm: BaseRecordORM) -> Dict[str, Any]:
         """
@@ -370,22 +431,44 @@ class BaseRecordSocket:
         *,
         session: Optional[Session] = None,
     ) -> Tuple[bytes, CompressionEnum]:
-
-        stmt = select(OutputStoreORM.data, OutputStoreORM.compression_type)
-        stmt = stmt.join(RecordComputeHistoryORM, RecordComputeHistoryORM.id == OutputStoreORM.history_id)
-        stmt = stmt.join(self.record_orm, RecordComputeHistoryORM.record_id == self.record_orm.id)
-        stmt = stmt.where(RecordComputeHistoryORM.record_id == record_id)
-        stmt = stmt.where(OutputStoreORM.history_id == history_id)
-        stmt = stmt.where(OutputStoreORM.output_type == output_type)
+        def _apply_filters(stmt):
+            stmt = stmt.join(RecordComputeHistoryORM, RecordComputeHistoryORM.id == OutputStoreORM.history_id)
+            stmt = stmt.join(self.record_orm, RecordComputeHistoryORM.record_id == self.record_orm.id)
+            stmt = stmt.where(RecordComputeHistoryORM.record_id == record_id)
+            stmt = stmt.where(OutputStoreORM.history_id == history_id)
+            return stmt.where(OutputStoreORM.output_type == output_type)
+
+        # The output and any appended chunks that haven't been merged yet. These are read in a single
+        # statement so that they are consistent with each other, even if the chunks are being merged
+        # into the output at the same time. Chunk ids are always > 0, so the output comes first
+        output_stmt = _apply_filters(
+            select(literal(0).label("idx"), OutputStoreORM.data, OutputStoreORM.compression_type)
+        )
+        chunk_stmt = _apply_filters(
+            select(OutputChunkORM.id, OutputChunkORM.data, OutputChunkORM.compression_type).join(
+                OutputStoreORM, OutputStoreORM.id == OutputChunkORM.output_id
+            )
+        )
+        stmt = union_all(output_stmt, chunk_stmt).order_by("idx")
 
         with self.root_socket.optional_session(session, True) as session:
-            output_data = session.execute(stmt).one_or_none()
-            if output_data is None:
+            rows = session.execute(stmt).all()
+            if not rows:
                 raise MissingDataError(
                     f"Record {record_id}/history {history_id} does not have {output_type} output (or record/history does not exist)"
                 )
 
-            return output_data[0], output_data[1]
+            _, data, compression_type = rows[0]
+            chunks = [(x, y) for _, x, y in rows[1:]]
+
+            if chunks:
+                output = decompress(data, compression_type)
+                output += "".join(decompress(x, y) for x, y in chunks)
+
+                # Use a low compression level - this is only for sending to the client
+                data, compression_type, _ = compress(output, CompressionEnum.zstd, 3)
+
+            return data, compression_type
 
     def get_single_output_uncompressed(
         self, record_id: int, history_id: int, output_type: OutputTypeEnum, *, session: Optional[Session] = None
@@ -520,6 +603,38 @@ class RecordSocket:
         # Union them into a single CTE
         self._child_cte = union(*selects).cte()
 
+        # Merging of output chunks (see append_output)
+        self._compact_outputs_frequency = 60 * 60  # one hour
+        self._compact_outputs_batch_size = 100
+
+        # Don't do it right at startup
+        self.add_internal_job_compact_outputs(self._compact_outputs_frequency)
+
+    def add_internal_job_compact_outputs(self, delay: float, *, session: Optional[Session] = None):
+        """
+        Adds an internal job to merge appended chunks of outputs
+
+        Parameters
+        ----------
+        delay
+            Schedule for this many seconds in the future
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+        """
+        with self.root_socket.optional_session(session) as session:
+            self.root_socket.internal_jobs.add(
+                "compact_outputs",
+                datetime.utcnow() + timedelta(seconds=delay),
+                "records.compact_outputs",
+                {},
+                user_id=None,
+                unique_name=True,
+                after_function="records.add_internal_job_compact_outputs",
+                after_function_kwargs={"delay": self._compact_outputs_frequency},
+                session=session,
+            )
+
     def get_socket(self, record_type: str) -> BaseRecordSocket:
         """
         Get the socket for a specific kind of record type
@@ -820,7 +935,7 @@ class RecordSocket:
             wp = BaseRecordORM
 
         with self.root_socket.optional_session(session, True) as session:
-            return get_general(session, wp, wp.id, record_ids, include, exclude, missing_ok)
+            return get_records_with_includes(session, wp, record_ids, include, exclude, missing_ok)
 
     def generate_task_specification(self, task_orm: TaskQueueORM) -> Dict[str, Any]:
         """
@@ -938,19 +1053,98 @@ class RecordSocket:
 
         compute_history = record_orm.compute_history[-1]
         if output_type in compute_history.outputs:
+            # Only compress & store the new text. The chunks are merged into the
+            # output later (see compact_outputs)
             out_orm = compute_history.outputs[output_type]
-            out_str = decompress(out_orm.data, out_orm.compression_type)
-            out_str += to_append
-
-            new_data, new_ctype, new_clevel = compress(out_str, CompressionEnum.zstd)
-            out_orm.data = new_data
-            out_orm.compression_type = new_ctype
-            out_orm.compression_level = new_clevel
+            chunk_data, chunk_ctype, chunk_clevel = compress(to_append, CompressionEnum.zstd)
+            out_orm.chunks.add(
+                OutputChunkORM(compression_type=chunk_ctype, compression_level=chunk_clevel, data=chunk_data)
+            )
         else:
             compute_history.outputs[output_type] = self.create_output_orm(session, output_type, to_append)
 
         session.flush()
 
+    def compact_output(self, session: Session, output_id: int) -> bool:
+        """
+        Merges the appended chunks of an output into the output itself
+
+        The output is locked while this is done. If it is already locked (for example, by a
+        transaction that is appending to it), nothing is done.
+
+        Parameters
+        ----------
+        session
+            An existing SQLAlchemy session to use. This session will not be committed.
+        output_id
+            ID of the output to compact
+
+        Returns
+        -------
+        :
+            True if the output was compacted (or has no chunks), False if it was locked
+        """
+
+        # FOR UPDATE conflicts with the lock taken on the output (via the foreign key) when inserting a chunk
+        stmt = select(OutputStoreORM).where(OutputStoreORM.id == output_id)
+        stmt = stmt.options(undefer(OutputStoreORM.data))
+        stmt = stmt.with_for_update(skip_locked=True)
+        out_orm = session.execute(stmt).scalar_one_or_none()
+
+        if out_orm is None:
+            return False
+
+        stmt = select(OutputChunkORM).where(OutputChunkORM.output_id == output_id)
+        stmt = stmt.options(undefer(OutputChunkORM.data))
+        stmt = stmt.order_by(OutputChunkORM.id)
+        chunks = session.execute(stmt).scalars().all()
+
+        if not chunks:
+            return True
+
+        output = decompress(out_orm.data, out_orm.compression_type)
+        output += "".join(x.get_output() for x in chunks)
+
+        out_orm.data, out_orm.compression_type, out_orm.compression_level = compress(output, CompressionEnum.zstd)
+
+        stmt = delete(OutputChunkORM).where(OutputChunkORM.id.in_([x.id for x in chunks]))
+        session.execute(stmt)
+        return True
+
+    def compact_outputs(self, session: Session, job_progress: JobProgress) -> None:
+        """
+        Merges the appended chunks of all outputs into their outputs
+
+        Parameters
+        ----------
+        session
+            An existing SQLAlchemy session to use. This session will be periodically committed
+        job_progress
+            An object used to report the current job progress and status
+        """
+
+        stmt = select(OutputChunkORM.output_id).distinct().order_by(OutputChunkORM.output_id)
+        output_ids = session.execute(stmt).scalars().all()
+
+        self._logger.info(f"Compacting {len(output_ids)} outputs")
+
+        n_skipped = 0
+        for i, id_batch in enumerate(chunk_iterable(output_ids, self._compact_outputs_batch_size)):
+            if job_progress.cancelled():
+                return
+
+            for output_id in id_batch:
+                if not self.compact_output(session, output_id):
+                    n_skipped += 1
+
+            session.commit()
+            job_progress.update_progress(
+                int(100 * min(1.0, (i + 1) * self._compact_outputs_batch_size / len(output_ids)))
+            )
+
+        if n_skipped:
+            self._logger.info(f"Skipped compacting {n_skipped} outputs which are currently in use")
+
     def update_completed_task(
         self, session: Session, record_orm: BaseRecordORM, result: AllResultTypes, manager_name: str
     ):
@@ -1220,6 +1414,9 @@ class RecordSocket:
         """
         Reset the status of records assigned to given managers to waiting
 
+        Records whose results have been returned by the manager, but are still staged (waiting to be ingested),
+        are not reset.
+
         Parameters
         ----------
         manager_name
@@ -1242,6 +1439,12 @@ class RecordSocket:
             stmt = stmt.where(BaseRecordORM.is_service.is_(False))
             stmt = stmt.where(BaseRecordORM.manager_name.in_(manager_name))
             stmt = stmt.where(BaseRecordORM.status == RecordStatusEnum.running)
+
+            staged_stmt = select(TaskReturnStagingORM.id)
+            staged_stmt = staged_stmt.join(TaskQueueORM, TaskQueueORM.id == TaskReturnStagingORM.task_id)
+            staged_stmt = staged_stmt.where(TaskQueueORM.record_id == BaseRecordORM.id)
+            stmt = stmt.where(~staged_stmt.exists())
+
             stmt = stmt.with_for_update()
 
             record_orms = session.execute(stmt).scalars().all()
@@ -1346,6 +1549,9 @@ class RecordSocket:
 
                 updated_ids.extend([r.id for r in record_data])
 
+                # Re-created tasks may be dependencies of services
+                self.root_socket.tasks.update_sort_dates([r.id for r in record_data], session=session)
+
             # put in order of the input parameter
             error_ids = set(record_ids) - set(updated_ids)
             updated_idx = [idx for idx, rid in enumerate(record_ids) if rid in updated_ids]
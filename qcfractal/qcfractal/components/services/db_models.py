@@ -18,6 +18,7 @@ from sqlalchemy.orm import relationship
 
 from qcfractal.components.record_db_models import BaseRecordORM
 from qcfractal.db_socket import BaseORM, PlainMsgpackExt
+from qcportal.compression import CompressionEnum, decompress
 
 
 class ServiceDependencyORM(BaseORM):
@@ -76,6 +77,16 @@ class ServiceQueueORM(BaseORM):
         CheckConstraint("tag = LOWER(tag)", name="ck_service_queue_tag_lower"),
     )
 
+    def model_dict(self, exclude: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        d = BaseORM.model_dict(self, exclude)
+
+        # Some services store their state compressed. Clients always get the uncompressed state
+        service_state = d.get("service_state")
+        if service_state is not None and "state_compressed" in service_state:
+            d["service_state"] = decompress(service_state["state_compressed"], CompressionEnum.zstd)
+
+        return d
+
 
 class ServiceSubtaskRecordORM(BaseRecordORM):
     """
@@ -2,17 +2,16 @@ from __future__ import annotations
 
 import logging
 import traceback
+from collections import defaultdict
 from datetime import datetime, timedelta
 from typing import TYPE_CHECKING
 
-from sqlalchemy import select, or_
+from sqlalchemy import select, or_, func
 from sqlalchemy.dialects.postgresql import array_agg
 from sqlalchemy.orm import contains_eager, aliased, defer, selectinload, joinedload
 
 from qcfractal.components.record_db_models import BaseRecordORM, RecordComputeHistoryORM
-from qcfractal.db_socket.helpers import (
-    get_count,
-)
+from qcfractal.components.tasks.db_models import TaskQueueORM
 from qcportal.generic_result import GenericTaskResult
 from qcportal.metadata_models import InsertMetadata
 from qcportal.record_models import PriorityEnum, RecordStatusEnum, OutputTypeEnum
@@ -23,7 +22,10 @@ if TYPE_CHECKING:
     from sqlalchemy.orm.session import Session
     from qcfractal.db_socket.socket import SQLAlchemySocket
     from qcfractal.components.internal_jobs.status import JobProgress
-    from typing import List, Dict, Tuple, Optional, Any, Union
+    from typing import List, Dict, Tuple, Optional, Any, Union, Sequence
+
+# Lock held while admitting services, so that limits are not exceeded by concurrent admissions
+services_admit_lock_id = 14700
 
 
 class ServiceSocket:
@@ -35,6 +37,12 @@ class ServiceSocket:
         self.root_socket = root_socket
         self._logger = logging.getLogger(__name__)
         self._max_active_services = root_socket.qcf_config.max_active_services
+        self._max_active_services_per_tag = root_socket.qcf_config.max_active_services_per_tag
+        self._max_active_services_per_type = root_socket.qcf_config.max_active_services_per_type
+        self._service_admission_max_waiting_tasks = root_socket.qcf_config.service_admission_max_waiting_tasks
+
+        # Maximum number of services to start at once
+        self._service_admission_batch_size = 100
         self._service_frequency = root_socket.qcf_config.service_frequency
 
         # Add the initial job for iterating the service
@@ -77,6 +85,120 @@ class ServiceSocket:
         session.commit()
         self.root_socket.notify_finished_watch(service_orm.record_id, RecordStatusEnum.complete)
 
+    def _mark_service_dependency_error(self, session: Session, service_orm: ServiceQueueORM):
+        # Some dependencies of the service did not complete successfully. Mark the service as errored
+        error = {
+            "error_type": "service_iteration_error",
+            "error_message": "Some task(s) did not complete successfully",
+        }
+
+        self._logger.info(
+            f"Record {service_orm.record_id} (service {service_orm.id}) has task failures. Marking as errored"
+        )
+
+        self.root_socket.records.update_failed_service(session, service_orm.record, error)
+        session.commit()
+
+        self.root_socket.notify_finished_watch(service_orm.record_id, RecordStatusEnum.error)
+
+    def add_internal_job_iterate_service(self, service_id: int, *, session: Optional[Session] = None) -> int:
+        """
+        Adds an internal job to iterate a single service as soon as possible
+
+        If a job for iterating this service is already in the queue, a new one will not be added.
+
+        Parameters
+        ----------
+        service_id
+            ID of the service to iterate (not the record ID)
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+
+        Returns
+        -------
+        :
+            ID of the internal job
+        """
+
+        with self.root_socket.optional_session(session) as session:
+            job_id = self.root_socket.internal_jobs.add(
+                name=f"iterate_service_{service_id}",
+                scheduled_date=datetime.utcnow(),
+                unique_name=True,
+                function="services._iterate_service",
+                kwargs={"service_id": service_id},
+                user_id=None,
+                session=session,
+            )
+            self._logger.debug(f"Internal job {job_id} for service {service_id} queued")
+            return job_id
+
+    def queue_ready_services(self, record_ids: Sequence[int], *, session: Optional[Session] = None) -> List[int]:
+        """
+        Queues iteration of services that are waiting only on the given records
+
+        This is called when records finish (ie, when tasks are returned), so that services whose
+        dependencies have all finished are iterated immediately, rather than waiting for the
+        next periodic check in :meth:`iterate_services`.
+
+        Parameters
+        ----------
+        record_ids
+            IDs of records that have just finished
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+
+        Returns
+        -------
+        :
+            IDs of the services that were queued for iteration
+        """
+
+        if not record_ids:
+            return []
+
+        with self.root_socket.optional_session(session) as session:
+            # Running services that depend on any of these records
+            # These are locked (in a consistent order) so that if the last few dependencies of a service
+            # are returned concurrently, the last one to commit will see all the others as finished
+            a_br_svc = aliased(BaseRecordORM)
+            stmt = (
+                select(ServiceQueueORM.id)
+                .join(a_br_svc, a_br_svc.id == ServiceQueueORM.record_id)
+                .where(a_br_svc.status == RecordStatusEnum.running)
+                .where(
+                    ServiceQueueORM.id.in_(
+                        select(ServiceDependencyORM.service_id).where(ServiceDependencyORM.record_id.in_(record_ids))
+                    )
+                )
+                .order_by(ServiceQueueORM.id)
+                .with_for_update(of=ServiceQueueORM)
+            )
+
+            service_ids = session.execute(stmt).scalars().all()
+
+            if not service_ids:
+                return []
+
+            # Of those, which have all their dependencies finished
+            # (this is a separate statement so that it sees anything committed while waiting on the locks)
+            stmt = (
+                select(ServiceDependencyORM.service_id)
+                .join(BaseRecordORM, BaseRecordORM.id == ServiceDependencyORM.record_id)
+                .where(ServiceDependencyORM.service_id.in_(service_ids))
+                .group_by(ServiceDependencyORM.service_id)
+                .having(array_agg(BaseRecordORM.status).contained_by(["complete", "error"]))
+            )
+
+            ready_ids = session.execute(stmt).scalars().all()
+
+            for service_id in ready_ids:
+                self.add_internal_job_iterate_service(service_id, session=session)
+
+            return ready_ids
+
     def _iterate_service(self, session: Session, job_progress: JobProgress, service_id: int) -> bool:
         """
         Iterate a single service given its service id
@@ -108,10 +230,26 @@ class ServiceSocket:
             self._logger.warning(f"Service {service_id} does not exist anymore!")
             return True
 
-        # All tasks successfully completed?
         # Since this is done asynchronously, then something could have happened
-        # between the creation of the internal job and this function call (invalidated, etc)
+        # between the creation of the internal job and this function call (cancelled, invalidated, etc)
+        if service_orm.record.status != RecordStatusEnum.running:
+            self._logger.info(
+                f"Record {service_orm.record_id} (service {service_orm.id}) is not running "
+                f"(status: {service_orm.record.status}). Ignoring..."
+            )
+            return False
+
+        # All tasks successfully completed?
         all_status = {x.record.status for x in service_orm.dependencies}
+
+        # Some tasks finished with an error
+        if RecordStatusEnum.error in all_status and all_status <= {RecordStatusEnum.complete, RecordStatusEnum.error}:
+            self._mark_service_dependency_error(session, service_orm)
+
+            # Start another service in place of this one
+            self.add_internal_job_admit_services()
+            return True
+
         if all_status != {RecordStatusEnum.complete} and all_status != set():
             self._logger.info(
                 f"Record {service_orm.record_id} (service {service_orm.id}) does NOT have all tasks completed. Ignoring..."
@@ -127,6 +265,10 @@ class ServiceSocket:
             )
             completed = self.root_socket.records.iterate_service(session, service_orm)
             service_orm.record.modified_on = datetime.utcnow()
+
+            # Tasks of any new dependencies should be ordered by the service's created_on
+            dep_ids = select(ServiceDependencyORM.record_id).where(ServiceDependencyORM.service_id == service_orm.id)
+            self.root_socket.tasks.update_sort_dates(dep_ids, session=session)
         except Exception as err:
             session.rollback()
 
@@ -139,11 +281,13 @@ class ServiceSocket:
             session.commit()
             self.root_socket.notify_finished_watch(service_orm.record_id, RecordStatusEnum.error)
 
+            self.add_internal_job_admit_services()
             return True
 
         if completed:
             # Will commit inside this function
             self.mark_service_complete(session, service_orm)
+            self.add_internal_job_admit_services()
             return True
         else:
             # Commit the changes
@@ -217,19 +361,7 @@ class ServiceSocket:
             self._logger.info(f"Found {len(err_services)} running services with task failures")
 
         for service_orm in err_services:
-            error = {
-                "error_type": "service_iteration_error",
-                "error_message": "Some task(s) did not complete successfully",
-            }
-
-            self._logger.info(
-                f"Record {service_orm.record_id} (service {service_orm.id}) has task failures. Marking as errored"
-            )
-
-            self.root_socket.records.update_failed_service(session, service_orm.record, error)
-            session.commit()
-
-            self.root_socket.notify_finished_watch(service_orm.record_id, RecordStatusEnum.error)
+            self._mark_service_dependency_error(session, service_orm)
 
         ###########################
         # Now successful services
@@ -246,131 +378,239 @@ class ServiceSocket:
         service_ids = session.execute(stmt).scalars().all()
 
         # Add an internal job for each completed service, calling the internal function
+        # Normally, these jobs are already queued when the last dependency of the service finishes
+        # (see queue_ready_services). This is just a safety net.
         for service_id in service_ids:
-            jobname = f"iterate_service_{service_id}"
-            job_id = self.root_socket.internal_jobs.add(
-                name=jobname,
-                scheduled_date=datetime.utcnow(),
-                unique_name=True,
-                function="services._iterate_service",
-                kwargs={"service_id": service_id},
+            self.add_internal_job_iterate_service(service_id, session=session)
+
+            # Commit after each one to allow it to be picked up by an internal job worker
+            session.commit()
+
+        # Start new services if there is room
+        return self.admit_services(session, job_progress)
+
+    def add_internal_job_admit_services(self, *, session: Optional[Session] = None):
+        """
+        Adds an internal job to start new services as soon as possible
+
+        Parameters
+        ----------
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+        """
+
+        with self.root_socket.optional_session(session) as session:
+            self.root_socket.internal_jobs.add(
+                "admit_services",
+                datetime.utcnow(),
+                "services.admit_services",
+                {},
                 user_id=None,
+                unique_name=True,
                 session=session,
             )
-            self._logger.debug(f"Internal job {job_id} for service {service_id} queued")
 
-            # Commit after each one to allow it to be picked up by an internal job worker
-            session.commit()
+    def admit_services(self, session: Session, job_progress: JobProgress) -> int:
+        """
+        Starts waiting services, as long as there is room for them
 
-        #
-        # How many services are currently running
-        #
-        stmt = select(BaseRecordORM).where(
-            BaseRecordORM.status == RecordStatusEnum.running, BaseRecordORM.is_service.is_(True)
-        )
-        running_count = get_count(session, stmt)
+        Services are started in order of priority and creation date, in batches. A service is not
+        started if that would exceed the overall limit on running services, or the limit for its
+        tag or record type. If configured, no services are started while too many tasks are waiting
+        to be claimed by compute managers.
+
+        Concurrent admissions are serialized with an advisory lock, taken for each batch.
+
+        Parameters
+        ----------
+        session
+            An existing SQLAlchemy session to use. This session will be periodically committed
+        job_progress
+            An object used to report the current job progress and status
+
+        Returns
+        -------
+        :
+            Number of services currently running after this function is done
+        """
 
-        self._logger.info(f"After iteration, now {running_count} running services. Max is {self._max_active_services}")
+        running_count = 0
 
+        # Each batch is committed, so the lock only lasts for one batch. Therefore, the running services
+        # must be counted again after taking the lock - they may have been changed by another admission job
         while True:
-            # Start up to 10 services at a time until we are full
-            new_service_count = min(10, self._max_active_services - running_count)
+            session.execute(select(func.pg_advisory_xact_lock(services_admit_lock_id))).scalar()
 
-            # we could possibly have a negative number here if the max active services was lowered or
-            # something weird was done manually, services restarted, etc
-            if new_service_count <= 0:
+            # How many services are currently running, by tag and record type
+            stmt = select(ServiceQueueORM.tag, BaseRecordORM.record_type, func.count())
+            stmt = stmt.join(BaseRecordORM, BaseRecordORM.id == ServiceQueueORM.record_id)
+            stmt = stmt.where(BaseRecordORM.status == RecordStatusEnum.running)
+            stmt = stmt.group_by(ServiceQueueORM.tag, BaseRecordORM.record_type)
+
+            running_by_tag: Dict[str, int] = defaultdict(int)
+            running_by_type: Dict[str, int] = defaultdict(int)
+            for tag, record_type, n in session.execute(stmt).all():
+                running_by_tag[tag] += n
+                running_by_type[record_type] += n
+
+            running_count = sum(running_by_tag.values())
+
+            # we could possibly have a negative number of services to start if the max active services was lowered
+            # or something weird was done manually, services restarted, etc
+            if running_count >= self._max_active_services:
                 break
 
+            # Can the compute resources take on the tasks of more services?
+            if self._service_admission_max_waiting_tasks is not None:
+                stmt = select(func.count()).select_from(TaskQueueORM)
+                stmt = stmt.join(BaseRecordORM, BaseRecordORM.id == TaskQueueORM.record_id)
+                stmt = stmt.where(BaseRecordORM.status == RecordStatusEnum.waiting)
+                n_waiting_tasks = session.execute(stmt).scalar_one()
+
+                if n_waiting_tasks >= self._service_admission_max_waiting_tasks:
+                    self._logger.info(f"{n_waiting_tasks} tasks are waiting to be claimed. Not starting new services")
+                    break
+
+            # Tags and record types that are at their limits
+            full_tags = {k for k, v in self._max_active_services_per_tag.items() if running_by_tag[k] >= v}
+            full_types = {k for k, v in self._max_active_services_per_type.items() if running_by_type[k] >= v}
+
             stmt = (
                 select(ServiceQueueORM)
                 .join(ServiceQueueORM.record)
                 .options(contains_eager(ServiceQueueORM.record))
                 .filter(BaseRecordORM.status == RecordStatusEnum.waiting)
-                .order_by(ServiceQueueORM.priority.desc(), BaseRecordORM.created_on)
-                .limit(new_service_count)
             )
 
+            if full_tags:
+                stmt = stmt.where(ServiceQueueORM.tag.not_in(full_tags))
+            if full_types:
+                stmt = stmt.where(BaseRecordORM.record_type.not_in(full_types))
+
+            stmt = stmt.order_by(ServiceQueueORM.priority.desc(), BaseRecordORM.created_on)
+            stmt = stmt.limit(min(self._service_admission_batch_size, self._max_active_services - running_count))
+
+            # Skip any that are being started elsewhere
+            stmt = stmt.with_for_update(skip_locked=True)
+
             new_services = session.execute(stmt).scalars().all()
 
             # No more services available to be started
             if len(new_services) == 0:
                 break
 
-            running_count += len(new_services)
-
+            to_start = []
             for service_orm in new_services:
+                tag = service_orm.tag
+                record_type = service_orm.record.record_type
 
-                now = datetime.utcnow()
-                service_orm.record.modified_on = now
-                service_orm.record.status = RecordStatusEnum.running
+                # May have been filled up by an earlier service in this batch
+                if tag in full_tags or record_type in full_types:
+                    continue
 
-                # Has this service been started before? ie, the service was restarted or something
-                fresh_start = len(service_orm.dependencies) == 0 and (
-                    service_orm.service_state == {} or service_orm.service_state is None
+                to_start.append(service_orm)
+                running_count += 1
+                running_by_tag[tag] += 1
+                running_by_type[record_type] += 1
+
+                tag_limit = self._max_active_services_per_tag.get(tag)
+                if tag_limit is not None and running_by_tag[tag] >= tag_limit:
+                    full_tags.add(tag)
+
+                type_limit = self._max_active_services_per_type.get(record_type)
+                if type_limit is not None and running_by_type[record_type] >= type_limit:
+                    full_types.add(record_type)
+
+            # Commits, which also releases the lock
+            self._start_services(session, to_start)
+
+        self._logger.info(f"Now {running_count} running services. Max is {self._max_active_services}")
+
+        return running_count
+
+    def _start_services(self, session: Session, service_orms: Sequence[ServiceQueueORM]):
+        """
+        Marks services as running, initializes them, and queues their first iteration
+
+        Parameters
+        ----------
+        session
+            An existing SQLAlchemy session to use. This session will be committed
+        service_orms
+            Services to start. These should be waiting (and locked)
+        """
+
+        now = datetime.utcnow()
+        fresh_starts: List[ServiceQueueORM] = []
+
+        for service_orm in service_orms:
+            # Has this service been started before? ie, the service was restarted or something
+            if len(service_orm.dependencies) == 0 and (
+                service_orm.service_state == {} or service_orm.service_state is None
+            ):
+                fresh_starts.append(service_orm)
+
+            service_orm.record.modified_on = now
+            service_orm.record.status = RecordStatusEnum.running
+
+            existing_history = service_orm.record.compute_history
+            if len(existing_history) == 0:
+                # Add a compute history entry.
+                # The iterate functions expect that at least one history entry exists
+                # But only add if this wasn't a restart of a running service
+
+                hist = RecordComputeHistoryORM()
+                hist.status = RecordStatusEnum.running
+                hist.modified_on = now
+
+                stdout_str = f"Starting service: {service_orm.record.record_type} at {now}"
+                stdout = self.root_socket.records.create_output_orm(session, OutputTypeEnum.stdout, stdout_str)
+                hist.outputs[OutputTypeEnum.stdout] = stdout
+
+                service_orm.record.compute_history.append(hist)
+
+            else:  # this was (probably) a restart
+                self.root_socket.records.append_output(
+                    session,
+                    service_orm.record,
+                    OutputTypeEnum.stdout,
+                    f"\nRestarting service: {service_orm.record.record_type} at {now}",
                 )
 
-                existing_history = service_orm.record.compute_history
-                if len(existing_history) == 0:
+        # Mark them all as running at once
+        session.commit()
 
-                    # Add a compute history entry.
-                    # The iterate functions expect that at least one history entry exists
-                    # But only add if this wasn't a restart of a running service
+        # Now initialize them. Each is done in a SAVEPOINT, so that a failure in one
+        # does not affect the others
+        failed_record_ids = []
+        for service_orm in fresh_starts:
+            nested_session = session.begin_nested()
 
-                    hist = RecordComputeHistoryORM()
-                    hist.status = RecordStatusEnum.running
-                    hist.modified_on = now
+            try:
+                self.root_socket.records.initialize_service(session, service_orm)
+                self.add_internal_job_iterate_service(service_orm.id, session=session)
+                nested_session.commit()
 
-                    stdout_str = f"Starting service: {service_orm.record.record_type} at {now}"
-                    stdout = self.root_socket.records.create_output_orm(session, OutputTypeEnum.stdout, stdout_str)
-                    hist.outputs[OutputTypeEnum.stdout] = stdout
+            except Exception as err:
+                nested_session.rollback()
 
-                    service_orm.record.compute_history.append(hist)
+                self._logger.error(
+                    f"Error initializing service {service_orm.id} (record {service_orm.record_id}):\n"
+                    + traceback.format_exc()
+                )
+                error = {
+                    "error_type": "service_initialization_error",
+                    "error_message": "Error in initialization/iteration of service: " + str(err),
+                }
 
-                else:  # this was (probably) a restart
-                    self.root_socket.records.append_output(
-                        session,
-                        service_orm.record,
-                        OutputTypeEnum.stdout,
-                        f"\nRestarting service: {service_orm.record.record_type} at {now}",
-                    )
+                self.root_socket.records.update_failed_service(session, service_orm.record, error)
+                failed_record_ids.append(service_orm.record_id)
 
-                session.commit()
-
-                try:
-                    if fresh_start:
-                        self.root_socket.records.initialize_service(session, service_orm)
-
-                        jobname = f"iterate_service_{service_orm.id}"
-                        job_id = self.root_socket.internal_jobs.add(
-                            name=jobname,
-                            scheduled_date=datetime.utcnow(),
-                            unique_name=True,
-                            function="services._iterate_service",
-                            kwargs={"service_id": service_orm.id},
-                            user_id=None,
-                            session=session,
-                        )
-                        self._logger.debug(
-                            f"Internal job {job_id} for service {service_orm.id} queued - first iteration"
-                        )
-                        session.commit()
-
-                except Exception as err:
-                    session.rollback()
-
-                    import traceback
-
-                    traceback.print_exc()
-                    error = {
-                        "error_type": "service_initialization_error",
-                        "error_message": "Error in initialization/iteration of service: " + str(err),
-                    }
-
-                    self.root_socket.records.update_failed_service(session, service_orm.record, error)
-                    session.commit()
-                    self.root_socket.notify_finished_watch(service_orm.record_id, RecordStatusEnum.error)
+        session.commit()
 
-        return running_count
+        for record_id in failed_record_ids:
+            self.root_socket.notify_finished_watch(record_id, RecordStatusEnum.error)
 
 
 class ServiceSubtaskRecordSocket(BaseRecordSocket):
@@ -477,4 +717,7 @@ class ServiceSubtaskRecordSocket(BaseRecordSocket):
             ids = [r.id for r in all_orm]
             meta = InsertMetadata(inserted_idx=list(range(len(function_kwargs))), existing_idx=[])
 
+            # Generate the task specifications in the background, rather than when they are claimed
+            self.root_socket.tasks.add_internal_job_generate_specifications(session=session)
+
             return meta, ids
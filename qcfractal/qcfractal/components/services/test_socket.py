@@ -1,22 +1,28 @@
 from __future__ import annotations
 
+import logging
+import threading
 from datetime import datetime
 from typing import TYPE_CHECKING
 
 from qcelemental.models import FailedOperation
+from sqlalchemy import select, func
 
 from qcfractal.components.gridoptimization.testing_helpers import (
     submit_test_data as submit_go_test_data,
 )
+from qcfractal.components.internal_jobs.db_models import InternalJobORM
 from qcfractal.components.record_db_models import BaseRecordORM
+from qcfractal.components.services.socket import services_admit_lock_id
 from qcfractal.components.torsiondrive.testing_helpers import (
     submit_test_data as submit_td_test_data,
     generate_task_key as generate_td_task_key,
 )
 from qcfractal.db_socket import SQLAlchemySocket
 from qcfractal.testing_helpers import run_service, DummyJobProgress
+from qcfractalcompute.compress import compress_result
 from qcportal.managers import ManagerName
-from qcportal.record_models import RecordStatusEnum, PriorityEnum
+from qcportal.record_models import RecordStatusEnum, PriorityEnum, RecordTask
 
 if TYPE_CHECKING:
     from qcfractal.db_socket import SQLAlchemySocket
@@ -65,3 +71,133 @@ def test_service_socket_iterate_order(storage_socket: SQLAlchemySocket, session:
 
     assert session.get(BaseRecordORM, id_1).status == RecordStatusEnum.waiting
     assert session.get(BaseRecordORM, id_2).status == RecordStatusEnum.running
+
+
+def test_service_socket_queue_on_dependency_finish(
+    storage_socket: SQLAlchemySocket, session: Session, activated_manager_name: ManagerName
+):
+    id_1, result_data_1 = submit_td_test_data(storage_socket, "td_H2O2_mopac_pm6", "*", PriorityEnum.normal)
+
+    service_id = session.get(BaseRecordORM, id_1).service.id
+    jobname = f"iterate_service_{service_id}"
+    job_stmt = select(InternalJobORM).where(InternalJobORM.unique_name == jobname)
+    manager_programs = storage_socket.managers.get([activated_manager_name.fullname])[0]["programs"]
+
+    def run_iteration_job():
+        with storage_socket.session_scope() as s:
+            job_orm = s.execute(job_stmt).scalar_one()
+            assert job_orm.function == "services._iterate_service"
+            assert job_orm.kwargs == {"service_id": service_id}
+            storage_socket.internal_jobs._run_single(s, job_orm, logging.getLogger("internal_job"), DummyJobProgress())
+
+        tasks = storage_socket.tasks.claim_tasks(activated_manager_name.fullname, manager_programs, ["*"])
+        tasks = [RecordTask(**x) for x in tasks]
+        return {t.id: compress_result(result_data_1[generate_td_task_key(t)].dict()) for t in tasks}
+
+    # Start the service, and run the first iteration (which creates the dependencies)
+    with storage_socket.session_scope() as s:
+        storage_socket.services.iterate_services(s, DummyJobProgress())
+
+    # Return dependencies until an iteration has more than one
+    # The next iteration is queued as soon as all of them are returned, without waiting for iterate_services
+    results = run_iteration_job()
+    while len(results) == 1:
+        storage_socket.tasks.update_finished(activated_manager_name.fullname, results)
+        results = run_iteration_job()
+
+    # Return all but one. The service is not ready for iteration yet
+    task_ids = list(results.keys())
+    storage_socket.tasks.update_finished(activated_manager_name.fullname, {k: results[k] for k in task_ids[:-1]})
+    assert session.execute(job_stmt).scalar_one_or_none() is None
+
+    # Returning the last one queues the iteration
+    storage_socket.tasks.update_finished(activated_manager_name.fullname, {task_ids[-1]: results[task_ids[-1]]})
+    assert session.execute(job_stmt).scalar_one_or_none() is not None
+
+
+def test_service_socket_admit_limits(storage_socket: SQLAlchemySocket, session: Session, monkeypatch):
+    monkeypatch.setattr(storage_socket.services, "_max_active_services", 20)
+    monkeypatch.setattr(storage_socket.services, "_max_active_services_per_tag", {"tag_a": 1})
+    monkeypatch.setattr(storage_socket.services, "_max_active_services_per_type", {"gridoptimization": 1})
+
+    id_1, _ = submit_td_test_data(storage_socket, "td_H2O2_mopac_pm6", "tag_a", PriorityEnum.high)
+    id_2, _ = submit_td_test_data(storage_socket, "td_H2O2_psi4_pbe", "tag_a", PriorityEnum.high)
+    id_3, _ = submit_td_test_data(storage_socket, "td_H2O2_psi4_pbe0", "tag_b", PriorityEnum.normal)
+    id_4, _ = submit_go_test_data(storage_socket, "go_H3NS_psi4_pbe", "tag_b", PriorityEnum.normal)
+    id_5, _ = submit_go_test_data(storage_socket, "go_H2O2_psi4_pbe", "tag_b", PriorityEnum.normal)
+
+    with storage_socket.session_scope() as s:
+        n_running = storage_socket.services.admit_services(s, DummyJobProgress())
+
+    assert n_running == 3
+
+    # Only one from tag_a, and one gridoptimization
+    assert session.get(BaseRecordORM, id_1).status == RecordStatusEnum.running
+    assert session.get(BaseRecordORM, id_2).status == RecordStatusEnum.waiting
+    assert session.get(BaseRecordORM, id_3).status == RecordStatusEnum.running
+    assert session.get(BaseRecordORM, id_4).status == RecordStatusEnum.running
+    assert session.get(BaseRecordORM, id_5).status == RecordStatusEnum.waiting
+
+
+def test_service_socket_admit_waiting_tasks(storage_socket: SQLAlchemySocket, session: Session, monkeypatch):
+    id_1, _ = submit_td_test_data(storage_socket, "td_H2O2_mopac_pm6", "*", PriorityEnum.high)
+    id_2, _ = submit_td_test_data(storage_socket, "td_H2O2_psi4_pbe", "*", PriorityEnum.normal)
+
+    monkeypatch.setattr(storage_socket.services, "_max_active_services", 1)
+    with storage_socket.session_scope() as s:
+        storage_socket.services.admit_services(s, DummyJobProgress())
+
+    # Creates the tasks for the first iteration
+    service_id = session.get(BaseRecordORM, id_1).service.id
+    with storage_socket.session_scope() as s:
+        stmt = select(InternalJobORM).where(InternalJobORM.unique_name == f"iterate_service_{service_id}")
+        job_orm = s.execute(stmt).scalar_one()
+        storage_socket.internal_jobs._run_single(s, job_orm, logging.getLogger("internal_job"), DummyJobProgress())
+
+    # Room for another service, but too many tasks waiting
+    monkeypatch.setattr(storage_socket.services, "_max_active_services", 2)
+    monkeypatch.setattr(storage_socket.services, "_service_admission_max_waiting_tasks", 1)
+
+    with storage_socket.session_scope() as s:
+        assert storage_socket.services.admit_services(s, DummyJobProgress()) == 1
+
+    assert session.get(BaseRecordORM, id_2).status == RecordStatusEnum.waiting
+
+    monkeypatch.setattr(storage_socket.services, "_service_admission_max_waiting_tasks", 10)
+    with storage_socket.session_scope() as s:
+        assert storage_socket.services.admit_services(s, DummyJobProgress()) == 2
+
+    session.expire_all()
+    assert session.get(BaseRecordORM, id_2).status == RecordStatusEnum.running
+
+
+def test_service_socket_admit_concurrent(storage_socket: SQLAlchemySocket, session: Session, monkeypatch):
+    id_1, _ = submit_td_test_data(storage_socket, "td_H2O2_mopac_pm6", "*", PriorityEnum.high)
+    id_2, _ = submit_td_test_data(storage_socket, "td_H2O2_psi4_pbe", "*", PriorityEnum.normal)
+
+    monkeypatch.setattr(storage_socket.services, "_max_active_services", 1)
+
+    def _admit(ret):
+        with storage_socket.session_scope() as s2:
+            ret.append(storage_socket.services.admit_services(s2, DummyJobProgress()))
+
+    ret = []
+    with storage_socket.session_scope() as s:
+        s.execute(select(func.pg_advisory_xact_lock(services_admit_lock_id))).scalar()
+
+        # Other admission must wait for the lock
+        th = threading.Thread(target=_admit, args=(ret,))
+        th.start()
+        th.join(2.0)
+        assert th.is_alive()
+
+        # Starts the only allowed service, and releases the lock
+        assert storage_socket.services.admit_services(s, DummyJobProgress()) == 1
+
+    th.join(30.0)
+    assert not th.is_alive()
+
+    # Other admission saw the newly-running service
+    assert ret == [1]
+    assert session.get(BaseRecordORM, id_1).status == RecordStatusEnum.running
+    assert session.get(BaseRecordORM, id_2).status == RecordStatusEnum.waiting
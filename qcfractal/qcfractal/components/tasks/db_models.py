@@ -1,6 +1,9 @@
+from typing import Optional, Iterable, Dict, Any
+
 from sqlalchemy import (
     Column,
     Integer,
+    DateTime,
     String,
     ForeignKey,
     Index,
@@ -34,6 +37,11 @@ class TaskQueueORM(BaseORM):
     tag = Column(String, nullable=False)
     priority = Column(Integer, nullable=False)
 
+    # Date used for ordering tasks when claiming. This is the created_on of the record, or of
+    # the earliest service that this record is a dependency of (whichever is earlier). That way
+    # a service doesn't have to wait for all other services to finish their tasks before it can finish.
+    sort_date = Column(DateTime, nullable=False)
+
     record_id = Column(Integer, ForeignKey(BaseRecordORM.id, ondelete="cascade"), nullable=False)
     record = relationship(BaseRecordORM, back_populates="task", uselist=False)
 
@@ -42,8 +50,13 @@ class TaskQueueORM(BaseORM):
     # rows, but if there is an index matching the ORDER BY, the first n rows
     # can be retrieved directly, without scanning the remainder at all.
     __table_args__ = (
-        Index("ix_task_queue_tag", "tag"),
+        # Indices matching the order when claiming tasks (with and without a specific tag). These cover
+        # all tasks - whether a task is waiting is stored in the record, so they cannot be partial
+        Index("ix_task_queue_tag_sort", tag, priority.desc(), sort_date, id),
+        Index("ix_task_queue_sort", priority.desc(), sort_date, id),
         Index("ix_task_queue_required_programs", "required_programs"),
+        # For finding tasks whose specifications have not been generated yet
+        Index("ix_task_queue_function_null", id, postgresql_where=function.is_(None)),
         UniqueConstraint("record_id", name="ux_task_queue_record_id"),
         # WARNING - these are not autodetected by alembic
         CheckConstraint(
@@ -51,3 +64,26 @@ class TaskQueueORM(BaseORM):
         ),
         CheckConstraint("tag = LOWER(tag)", name="ck_task_queue_tag_lower"),
     )
+
+    def model_dict(self, exclude: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        # Remove fields not present in the model
+        exclude = self.append_exclude(exclude, "sort_date")
+        return BaseORM.model_dict(self, exclude)
+
+
+class TaskReturnStagingORM(BaseORM):
+    """
+    Table for staging results returned from managers before they are ingested
+    """
+
+    __tablename__ = "task_return_staging"
+
+    id = Column(Integer, primary_key=True)
+
+    # Not a foreign key - the task may be deleted/reset between staging and ingestion
+    task_id = Column(Integer, nullable=False)
+    manager_name = Column(String, nullable=False)
+    received_on = Column(DateTime, nullable=False)
+    result_compressed = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (Index("ix_task_return_staging_task_id", task_id),)
@@ -1,10 +1,13 @@
+from typing import Dict
+
 from flask import current_app
 
 from qcfractal.flask_app import storage_socket
 from qcfractal.flask_app.api_v1.helpers import wrap_route  # uses the same wrap_route as the user api
 from qcfractal.flask_app.compute_v1.blueprint import compute_v1
 from qcportal.exceptions import LimitExceededError
-from qcportal.tasks import TaskClaimBody, TaskReturnBody
+from qcportal.metadata_models import TaskReturnMetadata
+from qcportal.tasks import TaskClaimBody, TaskReturnBody, TaskReturnClaimBody
 from qcportal.utils import calculate_limit
 
 
@@ -26,15 +29,43 @@ def claim_tasks_v1(body_data: TaskClaimBody):
     )
 
 
+def _return_tasks(manager_name: str, results_compressed: Dict[int, bytes]) -> TaskReturnMetadata:
+    qcf_config = current_app.config["QCFRACTAL_CONFIG"]
+
+    max_limit = qcf_config.api_limits.manager_tasks_claim
+    if len(results_compressed) > max_limit:
+        raise LimitExceededError(f"Attempted to return too many results - limit is {max_limit}")
+
+    # Store the results to be ingested later, and return immediately
+    if qcf_config.stage_task_returns:
+        return storage_socket.tasks.stage_finished(manager_name=manager_name, results_compressed=results_compressed)
+
+    return storage_socket.tasks.update_finished(manager_name=manager_name, results_compressed=results_compressed)
+
+
 @compute_v1.route("/tasks/return", methods=["POST"])
 @wrap_route("WRITE")
 def return_tasks_v1(body_data: TaskReturnBody):
     """Return finished tasks"""
 
-    max_limit = current_app.config["QCFRACTAL_CONFIG"].api_limits.manager_tasks_claim
-    if len(body_data.results_compressed) > max_limit:
-        raise LimitExceededError(f"Attempted to return too many results - limit is {max_limit}")
+    return _return_tasks(body_data.name_data.fullname, body_data.results_compressed)
+
 
-    return storage_socket.tasks.update_finished(
-        manager_name=body_data.name_data.fullname, results_compressed=body_data.results_compressed
+@compute_v1.route("/tasks/return_claim", methods=["POST"])
+@wrap_route("WRITE")
+def return_claim_tasks_v1(body_data: TaskReturnClaimBody):
+    """Return finished tasks, then claim new tasks from the task queue"""
+
+    manager_name = body_data.name_data.fullname
+
+    return_meta = _return_tasks(manager_name, body_data.results_compressed)
+
+    max_limit = current_app.config["QCFRACTAL_CONFIG"].api_limits.manager_tasks_claim
+    tasks = storage_socket.tasks.claim_tasks(
+        manager_name=manager_name,
+        tags=body_data.tags,
+        programs=body_data.programs,
+        limit=calculate_limit(max_limit, body_data.limit),
     )
+
+    return {"return_meta": return_meta, "tasks": tasks}
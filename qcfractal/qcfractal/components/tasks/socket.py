@@ -2,18 +2,20 @@ from __future__ import annotations
 
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import TYPE_CHECKING
 
 import pydantic
 from qcelemental.models import FailedOperation
-from sqlalchemy import select, func
+from sqlalchemy import select, update, delete, func
 from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.orm import joinedload, aliased, Load
 
 from qcfractal.components.managers.db_models import ComputeManagerORM
 from qcfractal.components.record_db_models import BaseRecordORM
 from qcfractal.components.services.db_models import ServiceQueueORM, ServiceDependencyORM
+from qcfractal.db_socket.helpers import get_count
 from qcportal.all_results import AllResultTypes
 from qcportal.compression import CompressionEnum, compress
 from qcportal.compression import decompress
@@ -22,13 +24,15 @@ from qcportal.managers import ManagerStatusEnum
 from qcportal.metadata_models import TaskReturnMetadata
 from qcportal.record_models import RecordStatusEnum
 from qcportal.utils import calculate_limit
-from .db_models import TaskQueueORM
+from .db_models import TaskQueueORM, TaskReturnStagingORM
 from .reset_logic import should_reset
 
 if TYPE_CHECKING:
     from sqlalchemy.orm.session import Session
+    from sqlalchemy.sql import Select
+    from qcfractal.components.internal_jobs.status import JobProgress
     from qcfractal.db_socket.socket import SQLAlchemySocket
-    from typing import List, Dict, Tuple, Optional, Any
+    from typing import List, Dict, Tuple, Optional, Any, Union, Sequence
 
 
 class TaskSocket:
@@ -42,18 +46,105 @@ class TaskSocket:
 
         self._tasks_claim_limit = root_socket.qcf_config.api_limits.manager_tasks_claim
 
+        # How many task specifications to generate at once (before committing)
+        self._generate_spec_batch_size = 500
+
+        # Maximum number of threads to use when decompressing returned results
+        self._result_parse_workers = 4
+
+        # Staging of returned results (see stage_finished)
+        self._task_ingest_jobs = root_socket.qcf_config.task_ingest_jobs
+        self._ingest_batch_size = root_socket.qcf_config.api_limits.manager_tasks_return
+
+    @staticmethod
+    def _parse_result(result_compressed: bytes) -> AllResultTypes:
+        result_dict = decompress(result_compressed, CompressionEnum.zstd)
+        return pydantic.parse_obj_as(AllResultTypes, result_dict)
+
+    def _update_finished_task(
+        self, session: Session, manager_name: str, task_orm: TaskQueueORM, result: AllResultTypes
+    ) -> Tuple[Optional[RecordStatusEnum], Optional[str], bool]:
+        """
+        Checks a returned result for consistency, and updates the corresponding record
+
+        Exceptions raised while updating the record are not handled here.
+
+        Returns
+        -------
+        :
+            The new status of the record (None if it was not updated), a message if the result
+            was rejected (None if accepted), and whether the record should be automatically reset.
+        """
+
+        record_orm: BaseRecordORM = task_orm.record
+        record_id = record_orm.id
+        task_id = task_orm.id
+
+        # Is the task in the running state
+        # If so, do not attempt to modify the task queue. Just move on
+        if record_orm.status != RecordStatusEnum.running:
+            self._logger.warning(f"Record {record_id} (task {task_id}) is not in a running state")
+            return None, "Task is not in a running state", False
+
+        # Was the manager that sent the data the one that was assigned?
+        # If so, do not attempt to modify the task queue. Just move on
+        if record_orm.manager_name != manager_name:
+            self._logger.warning(
+                f"Record {record_id} (task {task_id}) claimed by {record_orm.manager_name}, not {manager_name}"
+            )
+            return None, "Task is claimed by another manager", False
+
+        # Failed task returning FailedOperation
+        if result.success is False and isinstance(result, FailedOperation):
+            self.root_socket.records.update_failed_task(session, record_orm, result, manager_name)
+
+            # Should we automatically reset?
+            reset = False
+            if self.root_socket.qcf_config.auto_reset.enabled:
+                reset = should_reset(record_orm, self.root_socket.qcf_config.auto_reset)
+
+            return RecordStatusEnum.error, None, reset
+
+        if result.success is not True:
+            # QCEngine should always return either FailedOperation, or some result with success == True
+            msg = f"Unexpected return from manager for task {task_id}/base result {record_id}: Returned success != True, but not a FailedOperation"
+            error = {"error_type": "internal_fractal_error", "error_message": msg}
+            failed_op = FailedOperation(error=error, success=False)
+
+            self.root_socket.records.update_failed_task(session, record_orm, failed_op, manager_name)
+            self._logger.error(msg)
+            return RecordStatusEnum.error, "Returned success=False, but not a FailedOperation", False
+
+        # Manager returned a full, successful result
+        self.root_socket.records.update_completed_task(session, record_orm, result, manager_name)
+        return RecordStatusEnum.complete, None, False
+
     def update_finished(
-        self, manager_name: str, results_compressed: Dict[int, bytes], *, session: Optional[Session] = None
+        self,
+        manager_name: str,
+        results_compressed: Dict[int, bytes],
+        *,
+        require_active_manager: bool = True,
+        session: Optional[Session] = None,
     ) -> TaskReturnMetadata:
         """
         Insert data from finished calculations into the database
 
+        All returned tasks are locked with a single query, and all results are then processed
+        within a single SAVEPOINT. The ORM objects created for all the results (compute history, outputs,
+        native files, etc) are then inserted together when the session is flushed. Only if that fails are the results
+        processed again one at a time (each in their own SAVEPOINT), so that a single bad result does not
+        affect the others.
+
         Parameters
         ----------
         manager_name
             The name of the manager submitting the results
         results_compressed
             Results (in QCSchema format), with the task_id as the key
+        require_active_manager
+            If True, raise an exception if the manager is not active. This is False when ingesting staged
+            results, since those were already checked (and accepted) when they were staged.
         session
             An existing SQLAlchemy session to use. If None, one will be created. If an existing session
             is used, it will be flushed (but not committed) before returning from this function.
@@ -64,6 +155,14 @@ class TaskSocket:
         self._logger.info("Received completed tasks from {}.".format(manager_name))
         self._logger.info("    Task ids: " + " ".join(str(x) for x in all_task_ids))
 
+        # Decompress & parse the results. Decompression releases the GIL, so this can be done in parallel
+        if len(results_compressed) > 1:
+            n_workers = min(self._result_parse_workers, len(results_compressed))
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                all_results = dict(zip(all_task_ids, executor.map(self._parse_result, results_compressed.values())))
+        else:
+            all_results = {k: self._parse_result(v) for k, v in results_compressed.items()}
+
         tasks_success: List[int] = []
         tasks_failures: List[int] = []
         tasks_rejected: List[Tuple[int, str]] = []
@@ -77,122 +176,113 @@ class TaskSocket:
                 self._logger.warning(f"Manager {manager_name} does not exist, but is trying to return tasks. Ignoring.")
                 raise ComputeManagerError(f"Manager {manager_name} does not exist")
 
-            if manager.status != ManagerStatusEnum.active:
+            if require_active_manager and manager.status != ManagerStatusEnum.active:
                 self._logger.warning(f"Manager {manager_name} is not active. Ignoring...")
                 raise ComputeManagerError(f"Manager {manager_name} is not active")
 
-            all_notifications: List[Tuple[int, RecordStatusEnum]] = []
-
-            # For automatic resetting
-            to_be_reset: List[int] = []
+            # Lock all the tasks at once. These locks are released on commit or rollback.
+            # Ordering by id keeps the order of locking consistent between concurrent returns
+            # We are also deferring loading of the specific record tables. These will be lazy loaded
+            # when they are needed in the update functions of the various record subsockets.
+            # (I tried to use with_polymorphic, but it's kind of fussy and doesn't work well with innerjoin
+            #  which is needed because with_for_update doesn't work with nullable left outer joins. This should
+            #  be ok, even if the second select call doesn't use with_for_update, because any loading of
+            #  a derived-class orm will need to access base_record, which I believe will be locked)
+            stmt = select(TaskQueueORM).filter(TaskQueueORM.id.in_(all_task_ids))
+            stmt = stmt.options(joinedload(TaskQueueORM.record, innerjoin=True))
+            stmt = stmt.order_by(TaskQueueORM.id.asc())
+            stmt = stmt.with_for_update(skip_locked=False)
 
-            for task_id, result_compressed in results_compressed.items():
+            task_orms: Dict[int, TaskQueueORM] = {t.id: t for t in session.execute(stmt).scalars().all()}
 
-                result_dict = decompress(result_compressed, CompressionEnum.zstd)
-                result = pydantic.parse_obj_as(AllResultTypes, result_dict)
-
-                # We load one at a time. This works well with 'with_for_update'
-                # which will do row locking. This lock is released on commit or rollback
-                # We are also deferring loading of the specific record tables. These will be lazy loaded
-                # when they are needed in the update functions of the various record subsockets.
-                # (I tried to use with_polymorphic, but it's kind of fussy and doesn't work well with innerjoin
-                #  which is needed because with_for_update doesn't work with nullable left outer joins. This should
-                #  be ok, even if the second select call doesn't use with_for_update, because any loading of
-                #  a derived-class orm will need to access base_record, which I believe will be locked)
-                stmt = select(TaskQueueORM).filter(TaskQueueORM.id == task_id)
-                stmt = stmt.options(joinedload(TaskQueueORM.record, innerjoin=True))
-                stmt = stmt.with_for_update(skip_locked=False)
-
-                task_orm: Optional[TaskQueueORM] = session.execute(stmt).scalar_one_or_none()
-
-                # Does the task exist?
-                if task_orm is None:
+            # Does the task exist?
+            existing_task_ids = []
+            for task_id in all_task_ids:
+                if task_id in task_orms:
+                    existing_task_ids.append(task_id)
+                else:
                     self._logger.warning(f"Task id {task_id} does not exist in the task queue")
                     tasks_rejected.append((task_id, "Task does not exist in the task queue"))
-                    continue
 
-                record_orm: BaseRecordORM = task_orm.record
-                record_id = record_orm.id
+            # (task_id, record_id, notify status, rejected message, should reset)
+            processed: List[Tuple[int, int, Optional[RecordStatusEnum], Optional[str], bool]] = []
 
-                # Start a nested transaction, so that we can rollback if there is an issue with
-                # an individual result without releasing the lock on the manager
-                nested_session = session.begin_nested()
+            # First, try all the results together
+            # Start a nested transaction, so that we can rollback if there is an issue
+            # without releasing the lock on the manager or the tasks
+            nested_session = session.begin_nested()
 
-                notify_status = None
+            try:
+                for task_id in existing_task_ids:
+                    task_orm = task_orms[task_id]
+                    record_id = task_orm.record_id
+                    r = self._update_finished_task(session, manager_name, task_orm, all_results[task_id])
+                    processed.append((task_id, record_id, *r))
 
-                try:
-                    #################################################################
-                    # Perform some checks for consistency
-                    #################################################################
-                    # Is the task in the running state
-                    # If so, do not attempt to modify the task queue. Just move on
-                    if record_orm.status != RecordStatusEnum.running:
-                        self._logger.warning(f"Record {record_id} (task {task_id}) is not in a running state")
-                        tasks_rejected.append((task_id, "Task is not in a running state"))
-
-                    # Was the manager that sent the data the one that was assigned?
-                    # If so, do not attempt to modify the task queue. Just move on
-                    elif record_orm.manager_name != manager_name:
-                        self._logger.warning(
-                            f"Record {record_id} (task {task_id}) claimed by {record_orm.manager_name}, not {manager_name}"
-                        )
-                        tasks_rejected.append((task_id, "Task is claimed by another manager"))
-
-                    # Failed task returning FailedOperation
-                    elif result.success is False and isinstance(result, FailedOperation):
-                        self.root_socket.records.update_failed_task(session, record_orm, result, manager_name)
-                        notify_status = RecordStatusEnum.error
-                        tasks_failures.append(task_id)
-
-                        # Should we automatically reset?
-                        if self.root_socket.qcf_config.auto_reset.enabled:
-                            if should_reset(record_orm, self.root_socket.qcf_config.auto_reset):
-                                to_be_reset.append(record_id)
-
-                    elif result.success is not True:
-                        # QCEngine should always return either FailedOperation, or some result with success == True
-                        msg = f"Unexpected return from manager for task {task_id}/base result {record_id}: Returned success != True, but not a FailedOperation"
+                # Inserts everything that was added in the update functions
+                session.flush()
+                nested_session.commit()
+            except Exception:
+                # Rollback everything for this batch, and fall back to processing the results one at a time
+                self._logger.warning("Error processing returned tasks as a batch. Processing individually")
+                nested_session.rollback()
+                processed = []
+
+                # The rollback expires all the ORM, so get the tasks again
+                # (but we still hold the locks on them)
+                task_orms = {t.id: t for t in session.execute(stmt).scalars().all()}
+
+                for task_id in existing_task_ids:
+                    task_orm = task_orms[task_id]
+                    record_id = task_orm.record_id
+                    nested_session = session.begin_nested()
+
+                    try:
+                        r = self._update_finished_task(session, manager_name, task_orm, all_results[task_id])
+                        session.flush()
+                        processed.append((task_id, record_id, *r))
+
+                    except Exception:
+                        # We have no idea what was added or is pending for removal
+                        # So rollback the transaction to the most recent commit
+                        nested_session.rollback()
+
+                        # Need a new nested transaction - previous one is dead
+                        nested_session = session.begin_nested()
+
+                        msg = "Internal FractalServer Error:\n" + traceback.format_exc()
                         error = {"error_type": "internal_fractal_error", "error_message": msg}
                         failed_op = FailedOperation(error=error, success=False)
 
+                        record_orm = session.get(BaseRecordORM, record_id)
                         self.root_socket.records.update_failed_task(session, record_orm, failed_op, manager_name)
-                        notify_status = RecordStatusEnum.error
 
                         self._logger.error(msg)
-                        tasks_rejected.append((task_id, "Returned success=False, but not a FailedOperation"))
-
-                    # Manager returned a full, successful result
-                    else:
-                        self.root_socket.records.update_completed_task(session, record_orm, result, manager_name)
+                        processed.append((task_id, record_id, RecordStatusEnum.error, "Internal server error", False))
 
-                        notify_status = RecordStatusEnum.complete
-                        tasks_success.append(task_id)
-
-                except Exception:
-                    # We have no idea what was added or is pending for removal
-                    # So rollback the transaction to the most recent commit
-                    nested_session.rollback()
+                    finally:
+                        # releases the SAVEPOINT, does not actually commit to the db
+                        # (see SAVEPOINTS in postgres docs)
+                        nested_session.commit()
 
-                    # Need a new nested transaction - previous one is dead
-                    nested_session = session.begin_nested()
-
-                    msg = "Internal FractalServer Error:\n" + traceback.format_exc()
-                    error = {"error_type": "internal_fractal_error", "error_message": msg}
-                    failed_op = FailedOperation(error=error, success=False)
+            all_notifications: List[Tuple[int, RecordStatusEnum]] = []
 
-                    self.root_socket.records.update_failed_task(session, record_orm, failed_op, manager_name)
-                    notify_status = RecordStatusEnum.error
+            # For automatic resetting
+            to_be_reset: List[int] = []
 
-                    self._logger.error(msg)
-                    tasks_rejected.append((task_id, "Internal server error"))
+            for task_id, record_id, notify_status, rejected_msg, reset in processed:
+                if rejected_msg is not None:
+                    tasks_rejected.append((task_id, rejected_msg))
+                elif notify_status == RecordStatusEnum.complete:
+                    tasks_success.append(task_id)
+                else:
+                    tasks_failures.append(task_id)
 
-                finally:
-                    # releases the SAVEPOINT, does not actually commit to the db
-                    # (see SAVEPOINTS in postgres docs)
-                    nested_session.commit()
+                if notify_status is not None:
+                    all_notifications.append((record_id, notify_status))
 
-                    if notify_status is not None:
-                        all_notifications.append((record_id, notify_status))
+                if reset:
+                    to_be_reset.append(record_id)
 
             # Update the stats for the manager
             manager.successes += len(tasks_success)
@@ -206,6 +296,10 @@ class TaskSocket:
                 self._logger.info(f"Auto resetting {len(to_be_reset)} records")
                 self.root_socket.records.reset(to_be_reset, session=session)
 
+            # Iterate any services that were only waiting on these records
+            finished_record_ids = [record_id for record_id, _ in all_notifications]
+            self.root_socket.services.queue_ready_services(finished_record_ids, session=session)
+
         # Send notifications that tasks were completed
         for record_id, notify_status in all_notifications:
             self.root_socket.notify_finished_watch(record_id, notify_status)
@@ -218,6 +312,355 @@ class TaskSocket:
 
         return TaskReturnMetadata(rejected_info=tasks_rejected, accepted_ids=(tasks_success + tasks_failures))
 
+    def stage_finished(
+        self, manager_name: str, results_compressed: Dict[int, bytes], *, session: Optional[Session] = None
+    ) -> TaskReturnMetadata:
+        """
+        Stores results from finished calculations, to be ingested later by internal jobs
+
+        The results are stored as-is (compressed). Whether the manager is active and whether the tasks are assigned
+        to it is checked here, and not again when the results are ingested (see :meth:`ingest_staged_results`).
+        Until then, the records remain in the running state, and are not reset if the manager is deactivated.
+
+        Parameters
+        ----------
+        manager_name
+            The name of the manager submitting the results
+        results_compressed
+            Results (in QCSchema format), with the task_id as the key
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+        """
+
+        all_task_ids = list(results_compressed.keys())
+
+        self._logger.info("Received completed tasks from {} for staging.".format(manager_name))
+        self._logger.info("    Task ids: " + " ".join(str(x) for x in all_task_ids))
+
+        tasks_accepted: List[int] = []
+        tasks_rejected: List[Tuple[int, str]] = []
+
+        with self.root_socket.optional_session(session) as session:
+            # Lock the manager, so that it cannot be deactivated (and its tasks reset) while staging
+            stmt = select(ComputeManagerORM).where(ComputeManagerORM.name == manager_name)
+            stmt = stmt.with_for_update(skip_locked=False)
+            manager: Optional[ComputeManagerORM] = session.execute(stmt).scalar_one_or_none()
+
+            if manager is None:
+                self._logger.warning(f"Manager {manager_name} does not exist, but is trying to return tasks. Ignoring.")
+                raise ComputeManagerError(f"Manager {manager_name} does not exist")
+
+            if manager.status != ManagerStatusEnum.active:
+                self._logger.warning(f"Manager {manager_name} is not active. Ignoring...")
+                raise ComputeManagerError(f"Manager {manager_name} is not active")
+
+            stmt = select(TaskQueueORM.id, BaseRecordORM.status, BaseRecordORM.manager_name)
+            stmt = stmt.join(TaskQueueORM.record)
+            stmt = stmt.where(TaskQueueORM.id.in_(all_task_ids))
+            task_info = {x.id: x for x in session.execute(stmt).all()}
+
+            # Results may be sent again if the manager did not get our response. Only store them once
+            stmt = select(TaskReturnStagingORM.task_id).where(TaskReturnStagingORM.task_id.in_(all_task_ids))
+            already_staged = set(session.execute(stmt).scalars().all())
+
+            now = datetime.utcnow()
+            for task_id, result_compressed in results_compressed.items():
+                info = task_info.get(task_id, None)
+
+                if info is None:
+                    self._logger.warning(f"Task id {task_id} does not exist in the task queue")
+                    tasks_rejected.append((task_id, "Task does not exist in the task queue"))
+                elif info.status != RecordStatusEnum.running:
+                    self._logger.warning(f"Task {task_id} is not in a running state")
+                    tasks_rejected.append((task_id, "Task is not in a running state"))
+                elif info.manager_name != manager_name:
+                    self._logger.warning(f"Task {task_id} claimed by {info.manager_name}, not {manager_name}")
+                    tasks_rejected.append((task_id, "Task is claimed by another manager"))
+                else:
+                    tasks_accepted.append(task_id)
+
+                    if task_id not in already_staged:
+                        staged_orm = TaskReturnStagingORM(
+                            task_id=task_id,
+                            manager_name=manager_name,
+                            received_on=now,
+                            result_compressed=result_compressed,
+                        )
+                        session.add(staged_orm)
+
+            manager.rejected += len(tasks_rejected)
+
+            if tasks_accepted:
+                self.add_internal_job_ingest_staged_results(session=session)
+
+        return TaskReturnMetadata(rejected_info=tasks_rejected, accepted_ids=tasks_accepted)
+
+    def add_internal_job_ingest_staged_results(
+        self, only_if_staged: bool = False, *, session: Optional[Session] = None
+    ) -> None:
+        """
+        Adds internal jobs for ingesting staged results
+
+        One job is added for each of the `task_ingest_jobs` lanes in the configuration. If a job for a lane is
+        already waiting, another one is not added.
+
+        Parameters
+        ----------
+        only_if_staged
+            Only add the jobs if there are staged results waiting to be ingested
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+        """
+
+        with self.root_socket.optional_session(session) as session:
+            if only_if_staged:
+                stmt = select(TaskReturnStagingORM.id).limit(1)
+                if session.execute(stmt).scalar_one_or_none() is None:
+                    return
+
+            for lane in range(self._task_ingest_jobs):
+                self.root_socket.internal_jobs.add(
+                    f"ingest_staged_results_{lane}",
+                    datetime.utcnow(),
+                    "tasks.ingest_staged_results",
+                    {},
+                    user_id=None,
+                    unique_name=True,
+                    after_function="tasks.add_internal_job_ingest_staged_results",
+                    after_function_kwargs={"only_if_staged": True},
+                    session=session,
+                )
+
+    def _ingest_staged_group(self, session: Session, manager_name: str, results_compressed: Dict[int, bytes]) -> None:
+        """
+        Ingests staged results from a single manager, within a SAVEPOINT
+
+        Exceptions are not handled here, and the SAVEPOINT is rolled back if one is raised
+        """
+
+        with session.begin_nested():
+            rmeta = self.update_finished(
+                manager_name, results_compressed, require_active_manager=False, session=session
+            )
+
+        for task_id, msg in rmeta.rejected_info:
+            self._logger.warning(f"Staged result for task {task_id} from {manager_name} rejected: {msg}")
+
+    def ingest_staged_results(self, session: Session, job_progress: JobProgress) -> None:
+        """
+        Ingests staged results into the database
+
+        Staged results are processed in batches, grouped by the manager that returned them. Results that are
+        currently locked (ie, being ingested by another job) are skipped. The manager has already been
+        told the results were accepted, so they are ingested even if the manager is no longer active.
+
+        If a group of results cannot be ingested, they are ingested one at a time. A result that still cannot be
+        ingested marks its record as errored. If even that fails, the result is left staged, to be retried by a
+        later job.
+
+        Parameters
+        ----------
+        session
+            An existing SQLAlchemy session to use. This session will be committed after each batch
+        job_progress
+            An object used to report the current job progress and status
+        """
+
+        total = get_count(session, select(TaskReturnStagingORM))
+        n_processed = 0
+
+        # Results that could not be ingested at all. Don't try these again in this job
+        failed_ids: List[int] = []
+
+        while True:
+            stmt = select(TaskReturnStagingORM)
+            if failed_ids:
+                stmt = stmt.where(TaskReturnStagingORM.id.not_in(failed_ids))
+            stmt = stmt.order_by(TaskReturnStagingORM.id.asc())
+            stmt = stmt.limit(self._ingest_batch_size)
+            stmt = stmt.with_for_update(skip_locked=True)
+
+            staged_orms = session.execute(stmt).scalars().all()
+            if not staged_orms:
+                break
+
+            by_manager: Dict[str, List[TaskReturnStagingORM]] = {}
+            for staged_orm in staged_orms:
+                by_manager.setdefault(staged_orm.manager_name, []).append(staged_orm)
+
+            ingested_ids: List[int] = []
+
+            for manager_name, manager_staged in by_manager.items():
+                try:
+                    results_compressed = {x.task_id: x.result_compressed for x in manager_staged}
+                    self._ingest_staged_group(session, manager_name, results_compressed)
+                    ingested_ids.extend(x.id for x in manager_staged)
+                    continue
+                except Exception:
+                    self._logger.exception(
+                        f"Error ingesting staged results from {manager_name}. Ingesting individually"
+                    )
+
+                for staged_orm in manager_staged:
+                    task_id = staged_orm.task_id
+
+                    try:
+                        self._ingest_staged_group(session, manager_name, {task_id: staged_orm.result_compressed})
+                        ingested_ids.append(staged_orm.id)
+                        continue
+                    except Exception:
+                        msg = "Internal FractalServer Error:\n" + traceback.format_exc()
+                        self._logger.error(f"Error ingesting staged result for task {task_id}: " + msg)
+
+                    # Mark the record as errored instead
+                    try:
+                        error = {"error_type": "internal_fractal_error", "error_message": msg}
+                        failed_op = FailedOperation(error=error, success=False)
+                        failed_compressed, _, _ = compress(failed_op.dict(), CompressionEnum.zstd)
+                        self._ingest_staged_group(session, manager_name, {task_id: failed_compressed})
+                        ingested_ids.append(staged_orm.id)
+                    except Exception:
+                        self._logger.exception(f"Could not ingest staged result for task {task_id}. Will retry later")
+                        failed_ids.append(staged_orm.id)
+
+            stmt = delete(TaskReturnStagingORM)
+            stmt = stmt.where(TaskReturnStagingORM.id.in_(ingested_ids))
+            session.execute(stmt)
+
+            n_processed += len(staged_orms)
+            session.commit()
+
+            if total > 0:
+                job_progress.update_progress(min(100, int(100 * n_processed / total)))
+            if job_progress.cancelled():
+                return
+
+        self._logger.info(f"Ingested {n_processed - len(failed_ids)} staged results")
+
+    def _generate_task_specification(self, task_orm: TaskQueueORM) -> None:
+        """
+        Generates the function and compressed function kwargs for a task, storing them in the task orm
+        """
+
+        task_spec = self.root_socket.records.generate_task_specification(task_orm)
+        kwargs_compressed, _, _ = compress(task_spec["function_kwargs"], CompressionEnum.zstd)
+
+        task_orm.function = task_spec["function"]
+        task_orm.function_kwargs_compressed = kwargs_compressed
+
+    def add_internal_job_generate_specifications(self, *, session: Optional[Session] = None) -> None:
+        """
+        Adds an internal job for generating the specifications of tasks that do not have them yet
+
+        If such a job is already waiting, another one is not added.
+
+        Parameters
+        ----------
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+        """
+
+        with self.root_socket.optional_session(session) as session:
+            self.root_socket.internal_jobs.add(
+                "generate_task_specifications",
+                datetime.utcnow(),
+                "tasks.generate_task_specifications",
+                {},
+                user_id=None,
+                unique_name=True,
+                session=session,
+            )
+
+    def generate_task_specifications(self, session: Session, job_progress: JobProgress) -> None:
+        """
+        Generates and stores the function and compressed function kwargs for all tasks that do not have them
+
+        This is run as an internal job after records are added, so that this work is not done when tasks are
+        claimed by managers. Tasks are processed in batches, and tasks that are currently locked (ie, being
+        claimed) are skipped.
+
+        Parameters
+        ----------
+        session
+            An existing SQLAlchemy session to use. This session will be committed after each batch
+        job_progress
+            An object used to report the current job progress and status
+        """
+
+        base_stmt = select(TaskQueueORM).where(TaskQueueORM.function.is_(None))
+        total = get_count(session, base_stmt)
+
+        last_id = 0
+        n_processed = 0
+
+        while True:
+            # Keyset pagination, so tasks that fail are not retried over and over
+            stmt = base_stmt.where(TaskQueueORM.id > last_id)
+            stmt = stmt.options(joinedload(TaskQueueORM.record, innerjoin=True))
+            stmt = stmt.order_by(TaskQueueORM.id.asc())
+            stmt = stmt.limit(self._generate_spec_batch_size)
+            stmt = stmt.with_for_update(of=[TaskQueueORM], skip_locked=True)
+
+            task_orms = session.execute(stmt).scalars().all()
+            if not task_orms:
+                break
+
+            for task_orm in task_orms:
+                try:
+                    self._generate_task_specification(task_orm)
+                except Exception:
+                    # Will be tried again when the task is claimed
+                    self._logger.exception(f"Error generating specification for task {task_orm.id}")
+
+            last_id = task_orms[-1].id
+            n_processed += len(task_orms)
+
+            session.commit()
+
+            if total > 0:
+                job_progress.update_progress(min(100, int(100 * n_processed / total)))
+            if job_progress.cancelled():
+                return
+
+        self._logger.info(f"Generated specifications for {n_processed} tasks")
+
+    def update_sort_dates(self, record_ids: Union[Sequence[int], Select], *, session: Optional[Session] = None) -> None:
+        """
+        Updates the sort date of tasks, taking into account any services the records are dependencies of
+
+        The sort date of a task is the created_on of its record, or the created_on of the earliest service that
+        record is a dependency of, whichever is earlier. This should be called whenever records are
+        added as a dependency of a service.
+
+        Parameters
+        ----------
+        record_ids
+            IDs of records whose tasks should be updated, or a select statement returning those ids
+        session
+            An existing SQLAlchemy session to use. If None, one will be created. If an existing session
+            is used, it will be flushed (but not committed) before returning from this function.
+        """
+
+        br_svc = aliased(BaseRecordORM)  # BaseRecord for services
+
+        svc_date = select(func.min(br_svc.created_on))
+        svc_date = svc_date.join(ServiceQueueORM, ServiceQueueORM.record_id == br_svc.id)
+        svc_date = svc_date.join(ServiceDependencyORM, ServiceDependencyORM.service_id == ServiceQueueORM.id)
+        svc_date = svc_date.where(ServiceDependencyORM.record_id == TaskQueueORM.record_id)
+        svc_date = svc_date.scalar_subquery()
+
+        # least() ignores nulls (if the record is not a dependency of any service)
+        stmt = update(TaskQueueORM)
+        stmt = stmt.where(TaskQueueORM.record_id.in_(record_ids))
+        stmt = stmt.values(sort_date=func.least(TaskQueueORM.sort_date, svc_date))
+        stmt = stmt.execution_options(synchronize_session=False)
+
+        with self.root_socket.optional_session(session) as session:
+            session.execute(stmt)
+
     def claim_tasks(
         self,
         manager_name: str,
@@ -249,23 +692,6 @@ class TaskSocket:
         # to claim absolutely everything. So double check here
         limit = calculate_limit(self._tasks_claim_limit, limit)
 
-        # CTE for finding the created_on from services which this record is a dependency of
-        # If a record is a dependency of a service, we use either the record's created_on or the service's created_on,
-        # whichever is earlier. That way a service doesn't have to wait for all other services to finish their tasks
-        # before it can finish.
-        br_task = aliased(BaseRecordORM)  # BaseRecord for the task
-        br_svc = aliased(BaseRecordORM)  # BaseRecord for services
-
-        least_date = func.least(br_task.created_on, func.min(br_svc.created_on)).label("created_on")
-        svcdate_cte = select(br_task.id.label("record_id"), least_date)
-        svcdate_cte = svcdate_cte.join(ServiceDependencyORM, ServiceDependencyORM.record_id == br_task.id)
-        svcdate_cte = svcdate_cte.join(ServiceQueueORM, ServiceQueueORM.id == ServiceDependencyORM.service_id)
-        svcdate_cte = svcdate_cte.join(br_svc, br_svc.id == ServiceQueueORM.record_id)
-        svcdate_cte = svcdate_cte.where(br_task.status == RecordStatusEnum.waiting)
-        svcdate_cte = svcdate_cte.group_by(br_task.id)
-        svcdate_cte = svcdate_cte.order_by(least_date.asc())
-        svcdate_cte = svcdate_cte.cte()
-
         with self.root_socket.optional_session(session) as session:
             stmt = select(ComputeManagerORM).where(ComputeManagerORM.name == manager_name)
             stmt = stmt.with_for_update(skip_locked=False)
@@ -314,15 +740,14 @@ class TaskSocket:
                     )
                 )
 
-                stmt = stmt.join(svcdate_cte, svcdate_cte.c.record_id == BaseRecordORM.id, isouter=True)
                 stmt = stmt.filter(BaseRecordORM.status == RecordStatusEnum.waiting)
                 stmt = stmt.filter(manager_programs.contains(TaskQueueORM.required_programs))
 
-                # Order by priority, then created_on (earliest first)
-                # Where the created_on may be the created_on of the parent service (see CTE above)
-                stmt = stmt.order_by(
-                    TaskQueueORM.priority.desc(), func.least(BaseRecordORM.created_on, svcdate_cte.c.created_on).asc()
-                )
+                # Order by priority, then sort_date (earliest first)
+                # The sort_date may be the created_on of a parent service (see update_sort_dates)
+                # This matches the ix_task_queue_tag_sort and ix_task_queue_sort indices, so
+                # the first tasks can be read straight from the index
+                stmt = stmt.order_by(TaskQueueORM.priority.desc(), TaskQueueORM.sort_date.asc(), TaskQueueORM.id.asc())
 
                 # If tag is "*", then the manager will pull anything
                 if tag != "*":
@@ -343,25 +768,12 @@ class TaskSocket:
                 # Also, retrieve the actual function kwargs. Eventually we may want the managers
                 # to retrieve the kwargs themselves
                 for task_orm, _ in new_items:
-
-                    task_dict = task_orm.model_dict(exclude=["record"])
-
+                    # These are normally generated ahead of time (see generate_task_specifications),
+                    # but may not be if that job has not run yet
                     if task_orm.function is None:
-                        # Generate the task on the fly
-                        task_spec = self.root_socket.records.generate_task_specification(task_orm)
-
-                        kwargs = task_spec["function_kwargs"]
-                        kwargs_compressed, _, _ = compress(kwargs, CompressionEnum.zstd)
-
-                        # Add this to the orm for any future managers claiming this task
-                        task_orm.function = task_spec["function"]
-                        task_orm.function_kwargs_compressed = kwargs_compressed
-
-                        # But just use what we created when returning to this manager
-                        task_dict["function"] = task_spec["function"]
-                        task_dict["function_kwargs_compressed"] = kwargs_compressed
+                        self._generate_task_specification(task_orm)
 
-                    found.append(task_dict)
+                    found.append(task_orm.model_dict(exclude=["record"]))
 
                 session.flush()
 
@@ -331,3 +331,62 @@ def test_task_socket_return_manager_badstatus_3(storage_socket: SQLAlchemySocket
     assert manager.successes == 0
     assert manager.failures == 0
     assert manager.rejected == 1
+
+
+def test_task_socket_return_manager_batch_fallback(storage_socket: SQLAlchemySocket, session: Session, caplog):
+    # One result in a batch causes an internal error. The others should still be accepted
+
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-5678")
+    mid = storage_socket.managers.activate(
+        name_data=mname1,
+        manager_version="v2.0",
+        username="bill",
+        programs=_manager_programs,
+        tags=["tag1"],
+    )
+
+    test_names = ["sp_psi4_benzene_energy_1", "sp_psi4_benzene_energy_2", "sp_psi4_peroxide_energy_wfn"]
+    record_ids = []
+    results = {}
+    for name in test_names:
+        record_id, result_data = submit_test_data(storage_socket, name, "tag1")
+        record_ids.append(record_id)
+        results[record_id] = compress_result(result_data.dict())
+
+    tasks = storage_socket.tasks.claim_tasks(mname1.fullname, _manager_programs, ["tag1"])
+    assert len(tasks) == 3
+    task_records = {t["record_id"]: t["id"] for t in tasks}
+
+    bad_record_id = record_ids[1]
+    orig_update = storage_socket.records.update_completed_task
+
+    def _bad_update(session, record_orm, result, manager_name):
+        if record_orm.id == bad_record_id:
+            raise RuntimeError("Bad record!")
+        return orig_update(session, record_orm, result, manager_name)
+
+    storage_socket.records.update_completed_task = _bad_update
+
+    to_return = {task_records[rid]: results[rid] for rid in record_ids}
+    with caplog_handler_at_level(caplog, logging.WARNING):
+        rmeta = storage_socket.tasks.update_finished(mname1.fullname, to_return)
+        assert "Processing individually" in caplog.text
+
+    storage_socket.records.update_completed_task = orig_update
+
+    assert rmeta.accepted_ids == [task_records[record_ids[0]], task_records[record_ids[2]]]
+    assert rmeta.rejected_info == [(task_records[bad_record_id], "Internal server error")]
+
+    for rid in record_ids:
+        rec = session.get(BaseRecordORM, rid)
+        if rid == bad_record_id:
+            assert rec.status == RecordStatusEnum.error
+            assert rec.task is not None
+        else:
+            assert rec.status == RecordStatusEnum.complete
+            assert rec.task is None
+            assert len(rec.compute_history) == 1
+
+    manager = session.get(ComputeManagerORM, mid)
+    assert manager.successes == 2
+    assert manager.rejected == 1
@@ -5,10 +5,17 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
+from sqlalchemy import select
+
+from qcfractal.components.internal_jobs.db_models import InternalJobORM
 from qcfractal.components.managers.db_models import ComputeManagerORM
 from qcfractal.components.optimization.testing_helpers import load_test_data as load_opt_test_data
 from qcfractal.components.record_db_models import BaseRecordORM
+from qcfractal.components.services.db_models import ServiceDependencyORM
 from qcfractal.components.singlepoint.testing_helpers import load_test_data as load_sp_test_data
+from qcfractal.components.torsiondrive.testing_helpers import submit_test_data as submit_td_test_data
+from qcfractal.testing_helpers import DummyJobProgress
+from qcportal.compression import decompress, CompressionEnum
 from qcportal.managers import ManagerName
 from qcportal.record_models import PriorityEnum
 
@@ -200,6 +207,50 @@ def test_task_socket_claim_priority(storage_socket: SQLAlchemySocket, session: S
     assert tasks[2]["id"] == recs[0].task.id
 
 
+def test_task_socket_claim_service_date(storage_socket: SQLAlchemySocket, session: Session):
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host1", uuid="1234-5678-1234-5678")
+    mprog1 = {"qcengine": ["unknown"], "psi4": ["unknown"], "geometric": ["v3.0"]}
+    storage_socket.managers.activate(
+        name_data=mname1,
+        manager_version="v2.0",
+        username="bill",
+        programs=mprog1,
+        tags=["tag1"],
+    )
+
+    svc_id, _ = submit_td_test_data(storage_socket, "td_H2O2_mopac_pm6", "tag1")
+
+    meta, id_1 = storage_socket.records.singlepoint.add(
+        [molecule_1], input_spec_1, "tag1", PriorityEnum.normal, None, None, True
+    )
+    meta, id_2 = storage_socket.records.singlepoint.add(
+        [molecule_2], input_spec_2, "tag1", PriorityEnum.normal, None, None, True
+    )
+
+    # Make the second record a dependency of the (earlier) service
+    svc_rec = session.get(BaseRecordORM, svc_id)
+    svc_rec.service.dependencies.append(ServiceDependencyORM(record_id=id_2[0], extras={}))
+    session.flush()
+    storage_socket.tasks.update_sort_dates(id_1 + id_2, session=session)
+    session.commit()
+
+    rec_1 = session.get(BaseRecordORM, id_1[0])
+    rec_2 = session.get(BaseRecordORM, id_2[0])
+    session.refresh(rec_1.task)
+    session.refresh(rec_2.task)
+    assert rec_1.task.sort_date == rec_1.created_on
+    assert rec_2.task.sort_date == svc_rec.created_on
+
+    # The service dependency is claimed first
+    tasks = storage_socket.tasks.claim_tasks(mname1.fullname, mprog1, ["tag1"], 1)
+    assert len(tasks) == 1
+    assert tasks[0]["id"] == rec_2.task.id
+    assert "sort_date" not in tasks[0]
+
+    tasks = storage_socket.tasks.claim_tasks(mname1.fullname, mprog1, ["tag1"], 1)
+    assert tasks[0]["id"] == rec_1.task.id
+
+
 def test_task_socket_claim_tag(storage_socket: SQLAlchemySocket, session: Session):
     mname1 = ManagerName(cluster="test_cluster", hostname="a_host1", uuid="1234-5678-1234-5678")
     mprog1 = {"qcengine": ["unknown"], "psi4": ["unknown"], "geometric": ["v3.0"]}
@@ -363,3 +414,48 @@ def test_task_socket_claim_program_subset(storage_socket: SQLAlchemySocket, sess
     tasks = storage_socket.tasks.claim_tasks(mname1.fullname, claim_prog, ["*"], 100)
     assert len(tasks) == 1
     assert tasks[0]["id"] == recs[0].task.id
+
+
+def test_task_socket_generate_specifications(storage_socket: SQLAlchemySocket, session: Session):
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host1", uuid="1234-5678-1234-5678")
+    mprog1 = {"qcengine": ["unknown"], "psi4": ["unknown"], "geometric": ["v3.0"]}
+    storage_socket.managers.activate(
+        name_data=mname1,
+        manager_version="v2.0",
+        username="bill",
+        programs=mprog1,
+        tags=["*"],
+    )
+
+    meta, id_1 = storage_socket.records.singlepoint.add(
+        [molecule_1, molecule_5], input_spec_1, "tag1", PriorityEnum.normal, None, None, True
+    )
+    meta, id_2 = storage_socket.records.optimization.add(
+        [molecule_4], input_spec_4, "tag1", PriorityEnum.normal, None, None, True
+    )
+    all_id = id_1 + id_2
+
+    # A single job should have been queued
+    stmt = select(InternalJobORM).where(InternalJobORM.name == "generate_task_specifications")
+    jobs = session.execute(stmt).scalars().all()
+    assert len(jobs) == 1
+    assert jobs[0].function == "tasks.generate_task_specifications"
+
+    recs = [session.get(BaseRecordORM, rid) for rid in all_id]
+    assert all(r.task.function is None for r in recs)
+
+    storage_socket.tasks._generate_spec_batch_size = 2
+    storage_socket.tasks.generate_task_specifications(session, DummyJobProgress())
+
+    for r in recs:
+        session.refresh(r.task)
+        assert r.task.function is not None
+        assert r.task.function_kwargs_compressed is not None
+
+    # Claiming returns the stored specifications
+    expected = {r.task.id: r.task.function_kwargs_compressed for r in recs}
+    tasks = storage_socket.tasks.claim_tasks(mname1.fullname, mprog1, ["*"])
+    assert len(tasks) == 3
+    for t in tasks:
+        assert t["function_kwargs_compressed"] == expected[t["id"]]
+        assert decompress(t["function_kwargs_compressed"], CompressionEnum.zstd)
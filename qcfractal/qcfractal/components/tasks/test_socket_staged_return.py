@@ -0,0 +1,162 @@
+"""
+Tests staging of returned tasks, and the later ingestion of them
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pytest
+from sqlalchemy import select
+
+from qcfractal.components.internal_jobs.db_models import InternalJobORM
+from qcfractal.components.record_db_models import BaseRecordORM
+from qcfractal.components.singlepoint.testing_helpers import submit_test_data
+from qcfractal.components.tasks.db_models import TaskReturnStagingORM
+from qcfractal.testing_helpers import DummyJobProgress
+from qcfractalcompute.compress import compress_result
+from qcportal.exceptions import ComputeManagerError
+from qcportal.managers import ManagerName
+from qcportal.record_models import RecordStatusEnum
+
+if TYPE_CHECKING:
+    from qcfractal.db_socket import SQLAlchemySocket
+    from sqlalchemy.orm.session import Session
+
+_manager_programs = {"qcengine": ["unknown"], "psi4": ["unknown"], "qchem": ["v3.0"]}
+
+
+def _submit_and_claim(storage_socket: SQLAlchemySocket, mname: ManagerName):
+    storage_socket.managers.activate(
+        name_data=mname,
+        manager_version="v2.0",
+        username="bill",
+        programs=_manager_programs,
+        tags=["tag1"],
+    )
+
+    results = {}
+    for name in ["sp_psi4_benzene_energy_1", "sp_psi4_peroxide_energy_wfn"]:
+        record_id, result_data = submit_test_data(storage_socket, name, "tag1")
+        results[record_id] = compress_result(result_data.dict())
+
+    tasks = storage_socket.tasks.claim_tasks(mname.fullname, _manager_programs, ["tag1"])
+    assert len(tasks) == 2
+
+    return {t["id"]: results[t["record_id"]] for t in tasks}, {t["id"]: t["record_id"] for t in tasks}
+
+
+def test_task_socket_stage_ingest(storage_socket: SQLAlchemySocket, session: Session):
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-5678")
+    to_return, task_records = _submit_and_claim(storage_socket, mname1)
+
+    rmeta = storage_socket.tasks.stage_finished(mname1.fullname, to_return)
+    assert rmeta.accepted_ids == list(to_return.keys())
+
+    # Not ingested yet
+    staged = session.execute(select(TaskReturnStagingORM)).scalars().all()
+    assert {x.task_id for x in staged} == set(to_return.keys())
+
+    for record_id in task_records.values():
+        assert session.get(BaseRecordORM, record_id).status == RecordStatusEnum.running
+
+    # Jobs for ingesting were added
+    stmt = select(InternalJobORM).where(InternalJobORM.function == "tasks.ingest_staged_results")
+    jobs = session.execute(stmt).scalars().all()
+    assert len(jobs) == storage_socket.qcf_config.task_ingest_jobs
+
+    storage_socket.tasks.ingest_staged_results(session, DummyJobProgress())
+    session.expire_all()
+
+    assert session.execute(select(TaskReturnStagingORM)).scalars().all() == []
+
+    for record_id in task_records.values():
+        rec = session.get(BaseRecordORM, record_id)
+        assert rec.status == RecordStatusEnum.complete
+        assert rec.task is None
+
+
+def test_task_socket_stage_manager_inactive(storage_socket: SQLAlchemySocket, session: Session):
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-5678")
+    to_return, task_records = _submit_and_claim(storage_socket, mname1)
+
+    storage_socket.tasks.stage_finished(mname1.fullname, to_return)
+
+    # Manager is deactivated (ie, shuts down) before its results are ingested.
+    # The records with staged results are not reset
+    storage_socket.managers.deactivate([mname1.fullname])
+
+    for record_id in task_records.values():
+        rec = session.get(BaseRecordORM, record_id)
+        assert rec.status == RecordStatusEnum.running
+        assert rec.manager_name == mname1.fullname
+
+    # Results are still ingested
+    storage_socket.tasks.ingest_staged_results(session, DummyJobProgress())
+    session.expire_all()
+
+    assert session.execute(select(TaskReturnStagingORM)).scalars().all() == []
+
+    for record_id in task_records.values():
+        rec = session.get(BaseRecordORM, record_id)
+        assert rec.status == RecordStatusEnum.complete
+
+    # Now inactive, so can't stage anything
+    with pytest.raises(ComputeManagerError, match="is not active"):
+        storage_socket.tasks.stage_finished(mname1.fullname, to_return)
+
+
+def test_task_socket_stage_ownership(storage_socket: SQLAlchemySocket, session: Session):
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-5678")
+    mname2 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-0000")
+    to_return, task_records = _submit_and_claim(storage_socket, mname1)
+
+    storage_socket.managers.activate(
+        name_data=mname2,
+        manager_version="v2.0",
+        username="bill",
+        programs=_manager_programs,
+        tags=["tag1"],
+    )
+
+    # Tasks belong to another manager, or don't exist
+    task_id_1, task_id_2 = list(to_return.keys())
+    rmeta = storage_socket.tasks.stage_finished(mname2.fullname, {task_id_1: to_return[task_id_1], 99999: b"abc"})
+    assert rmeta.accepted_ids == []
+    assert dict(rmeta.rejected_info) == {
+        task_id_1: "Task is claimed by another manager",
+        99999: "Task does not exist in the task queue",
+    }
+
+    # Sending the same results twice only stages them once
+    rmeta = storage_socket.tasks.stage_finished(mname1.fullname, to_return)
+    assert rmeta.accepted_ids == [task_id_1, task_id_2]
+    rmeta = storage_socket.tasks.stage_finished(mname1.fullname, to_return)
+    assert rmeta.accepted_ids == [task_id_1, task_id_2]
+
+    staged = session.execute(select(TaskReturnStagingORM)).scalars().all()
+    assert sorted(x.task_id for x in staged) == [task_id_1, task_id_2]
+
+
+def test_task_socket_stage_bad_result(storage_socket: SQLAlchemySocket, session: Session):
+    mname1 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-5678")
+    to_return, task_records = _submit_and_claim(storage_socket, mname1)
+
+    # One of the results is corrupt
+    task_id_1, task_id_2 = list(to_return.keys())
+    to_return[task_id_2] = b"not a compressed result"
+
+    storage_socket.tasks.stage_finished(mname1.fullname, to_return)
+    storage_socket.tasks.ingest_staged_results(session, DummyJobProgress())
+    session.expire_all()
+
+    assert session.execute(select(TaskReturnStagingORM)).scalars().all() == []
+
+    # The good result is ingested, and the bad one marks its record as errored
+    rec = session.get(BaseRecordORM, task_records[task_id_1])
+    assert rec.status == RecordStatusEnum.complete
+
+    rec = session.get(BaseRecordORM, task_records[task_id_2])
+    assert rec.status == RecordStatusEnum.error
+    assert rec.task is not None
+    assert rec.compute_history[-1].outputs["error"].get_output()["error_type"] == "internal_fractal_error"
@@ -1,17 +1,18 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Optional, List, Tuple, Dict
 
+import pandas as pd
 import pytest
 
 from qcfractal.components.singlepoint.testing_helpers import load_test_data, run_test_data
-from qcportal import PortalRequestError
+from qcportal import PortalClient, PortalRequestError
+from qcportal.dataset_models import DatasetFetchRecordDataBody
 from qcportal.molecules import Molecule
-from qcportal.record_models import PriorityEnum
+from qcportal.record_models import PriorityEnum, RecordStatusEnum
 from qcportal.singlepoint import SinglepointDataset
 
 if TYPE_CHECKING:
-    from qcportal import PortalClient
     from qcarchivetesting.testing_classes import QCATestingSnowflake
 
 
@@ -240,3 +241,196 @@ def test_dataset_client_get_computed_properties(snowflake: QCATestingSnowflake):
     assert "spec_1" in computed_prop
     assert "scf_total_energy" in computed_prop["spec_1"]
     assert "calcinfo_natom" in computed_prop["spec_1"]
+
+
+def test_dataset_client_compile_values(snowflake: QCATestingSnowflake):
+    snowflake_client = snowflake.client()
+    storage_socket = snowflake.get_storage_socket()
+    manager_name, _ = snowflake.activate_manager()
+
+    ds: SinglepointDataset = snowflake_client.add_dataset("singlepoint", "Test dataset")
+
+    test_names = ["sp_psi4_water_energy", "sp_psi4_benzene_energy_1", "sp_psi4_peroxide_energy_wfn"]
+    for i, test_name in enumerate(test_names):
+        input_spec, molecule, _ = load_test_data(test_name)
+        run_test_data(storage_socket, manager_name, test_name)
+        ds.add_specification(f"spec_{i}", input_spec)
+        ds.add_entry(name=f"mol_{i}", molecule=molecule)
+
+    # An entry that has no complete records
+    ds.add_entry(name="mol_none", molecule=Molecule(symbols=["He"], geometry=[0, 0, 0]))
+    ds.submit()
+
+    # Reference, built from the long form of the data
+    long_data = [
+        (e, s, r.properties["return_energy"], r.properties["calcinfo_nbasis"])
+        for e, s, r in ds.iterate_records(status=RecordStatusEnum.complete)
+    ]
+    assert len(long_data) == 3
+    ref_df = pd.DataFrame(long_data, columns=["entry", "specification", "energy", "nbasis"])
+    ref_df = ref_df.pivot(index="entry", columns="specification", values=["energy", "nbasis"]).swaplevel(axis=1)
+
+    df = ds.compile_values(
+        lambda r: [r.properties["return_energy"], r.properties["calcinfo_nbasis"]],
+        value_names=["energy", "nbasis"],
+        unpack=True,
+    )
+    pd.testing.assert_frame_equal(df, ref_df)
+
+    # Multiple value functions
+    df = ds.compile_values(
+        [lambda r: r.properties["return_energy"], lambda r: r.properties["calcinfo_nbasis"]],
+        value_names=["energy", "nbasis"],
+    )
+    pd.testing.assert_frame_equal(df, ref_df)
+
+    # Single value
+    df = ds.compile_values(lambda r: r.properties["return_energy"], value_names="energy")
+    pd.testing.assert_frame_equal(df, ref_df[[x for x in ref_df.columns if x[1] == "energy"]])
+
+    # Automatic naming
+    df = ds.compile_values(lambda r: [r.id, r.id], unpack=True, entry_names=["mol_0", "mol_1"])
+    assert list(df.columns) == [("spec_0", "value0"), ("spec_1", "value0"), ("spec_0", "value1"), ("spec_1", "value1")]
+    assert list(df.index) == ["mol_0", "mol_1"]
+
+    with pytest.raises(ValueError, match="must match"):
+        ds.compile_values(lambda r: [r.id, r.id], value_names=["a", "b", "c"], unpack=True)
+    with pytest.raises(ValueError, match="must match"):
+        ds.compile_values([lambda r: r.id], value_names=["a", "b"])
+
+
+@pytest.mark.parametrize("prefetch_batches", [0, 1, 4])
+def test_dataset_client_iterate_records_prefetch(snowflake: QCATestingSnowflake, tmp_path, prefetch_batches: int):
+    # Use a disk cache, which is then used from the prefetching threads
+    snowflake_client = PortalClient(snowflake.get_uri(), cache_dir=str(tmp_path))
+
+    ds: SinglepointDataset = snowflake_client.add_dataset("singlepoint", "Test dataset")
+    input_spec, _, _ = load_test_data("sp_psi4_water_energy")
+    ds.add_specification("spec_1", input_spec)
+    ds.add_specification("spec_2", input_spec.copy(update={"method": "test_method_2"}))
+
+    entry_names = [f"mol_{i}" for i in range(25)]
+    for i, name in enumerate(entry_names):
+        ds.add_entry(name=name, molecule=Molecule(symbols=["He"], geometry=[0, 0, i]))
+    ds.submit()
+
+    # The testing server has small api limits, so there will be many small batches
+    assert snowflake_client.api_limits["get_records"] < 25
+
+    ds = snowflake_client.get_dataset_by_id(ds.id)
+    records = list(ds.iterate_records(prefetch_batches=prefetch_batches))
+    assert [(e, s) for e, s, _ in records] == [(e, s) for s in ds.specification_names for e in entry_names]
+    assert len({r.id for _, _, r in records}) == 50
+
+    # Stopping early is fine
+    ds = snowflake_client.get_dataset_by_id(ds.id)
+    for i, _ in enumerate(ds.iterate_records(prefetch_batches=prefetch_batches)):
+        if i == 5:
+            break
+
+    # Subset of entries, with status filtering
+    records = list(ds.iterate_records(entry_names[3:7], "spec_2", status="waiting", prefetch_batches=prefetch_batches))
+    assert [e for e, _, _ in records] == entry_names[3:7]
+    assert list(ds.iterate_records(status="complete", prefetch_batches=prefetch_batches)) == []
+
+
+def test_dataset_client_fetch_records_cache(snowflake: QCATestingSnowflake, tmp_path, monkeypatch):
+    snowflake_client = snowflake.client()
+    storage_socket = snowflake.get_storage_socket()
+    manager_name, _ = snowflake.activate_manager()
+
+    ds: SinglepointDataset = snowflake_client.add_dataset("singlepoint", "Test dataset")
+    input_spec, molecule, _ = load_test_data("sp_psi4_peroxide_energy_wfn")
+    run_test_data(storage_socket, manager_name, "sp_psi4_peroxide_energy_wfn")
+
+    ds.add_specification("spec_1", input_spec)
+    ds.add_entry(name="test_molecule", molecule=molecule)
+    ds.add_entry(name="test_molecule_2", molecule=Molecule(symbols=["He"], geometry=[0, 0, 0]))
+    ds.submit()
+
+    client = PortalClient(snowflake.get_uri(), cache_dir=str(tmp_path))
+    ds = client.get_dataset_by_id(ds.id)
+    ds.fetch_records()
+    records = {k: v.dict() for k, v in ds.record_map_.items()}
+    assert len(records) == 2
+
+    # A new client, using the same cache directory
+    client2 = PortalClient(snowflake.get_uri(), cache_dir=str(tmp_path))
+    requests = []
+    orig_make_request = client2.make_request
+
+    def _make_request(method, endpoint, *args, **kwargs):
+        requests.append((endpoint, kwargs.get("body")))
+        return orig_make_request(method, endpoint, *args, **kwargs)
+
+    monkeypatch.setattr(client2, "make_request", _make_request)
+
+    ds2 = client2.get_dataset_by_id(ds.id)
+    ds2.fetch_records()
+    assert {k: v.dict() for k, v in ds2.record_map_.items()} == records
+
+    # Only the modification times were downloaded
+    assert not [x for x in requests if x[0] == "api/v1/records/bulkGet"]
+    fetch_data = [x[1] for x in requests if x[0].endswith("records/bulkFetchData")]
+    assert fetch_data and all(x.include == ["modified_on"] for x in fetch_data)
+
+    # Only the modified record is downloaded again
+    waiting_id = ds2.get_record("test_molecule_2", "spec_1").id
+    client2.cancel_records(waiting_id)
+    requests.clear()
+
+    ds2.fetch_records(force_refetch=True)
+    assert ds2.get_record("test_molecule_2", "spec_1").status == RecordStatusEnum.cancelled
+
+    full_fetches = [x[1] for x in requests if x[0] == "api/v1/records/bulkGet" and x[1].include is None]
+    assert [x.ids for x in full_fetches] == [[waiting_id]]
+
+
+def test_dataset_client_fetch_record_data(snowflake: QCATestingSnowflake):
+    snowflake_client = snowflake.client()
+    storage_socket = snowflake.get_storage_socket()
+    manager_name, _ = snowflake.activate_manager()
+
+    ds: SinglepointDataset = snowflake_client.add_dataset("singlepoint", "Test dataset")
+    input_spec, molecule, _ = load_test_data("sp_psi4_peroxide_energy_wfn")
+    record_id = run_test_data(storage_socket, manager_name, "sp_psi4_peroxide_energy_wfn")
+
+    ds.add_specification("spec_1", input_spec)
+    ds.add_entry(name="test_molecule", molecule=molecule)
+    ds.add_entry(name="test_molecule_2", molecule=Molecule(symbols=["He"], geometry=[0, 0, 0]))
+    ds.submit()
+
+    # Record items and full records in a single request, with projection
+    body = DatasetFetchRecordDataBody(
+        entry_names=["test_molecule", "test_molecule_2", "does_not_exist"],
+        specification_names=["spec_1"],
+        status=[RecordStatusEnum.complete],
+        include=["id", "status", "properties"],
+    )
+    ret = snowflake_client.make_request(
+        "post", f"api/v1/datasets/singlepoint/{ds.id}/records/bulkFetchData", List[Tuple[str, str, Dict]], body=body
+    )
+
+    assert len(ret) == 1
+    entry_name, spec_name, record_data = ret[0]
+    assert (entry_name, spec_name) == ("test_molecule", "spec_1")
+    assert record_data["id"] == record_id
+    assert record_data["status"] == RecordStatusEnum.complete
+    assert "properties" in record_data
+    assert "specification" not in record_data
+
+    # Used when fetching records through the dataset
+    rec = ds.get_record("test_molecule", "spec_1", include=["molecule"])
+    assert rec.id == record_id
+    assert rec.molecule_ is not None
+    assert ds.get_record("test_molecule_2", "spec_1").status == RecordStatusEnum.waiting
+
+    # Over the limit
+    body = DatasetFetchRecordDataBody(
+        entry_names=[f"entry_{i}" for i in range(snowflake_client.api_limits["get_records"] + 1)],
+        specification_names=["spec_1"],
+    )
+    with pytest.raises(PortalRequestError, match="limit is"):
+        snowflake_client.make_request(
+            "post", f"api/v1/datasets/singlepoint/{ds.id}/records/bulkFetchData", List[Tuple[str, str, Dict]], body=body
+        )
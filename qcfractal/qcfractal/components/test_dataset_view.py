@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import TYPE_CHECKING
+
+import pandas as pd
+import pytest
+
+from qcfractal.components.create_view import create_dataset_view, refresh_dataset_view
+from qcfractal.components.singlepoint.testing_helpers import load_test_data, run_test_data
+from qcportal.dataset_models import load_dataset_view
+from qcportal.internal_jobs import InternalJobStatusEnum
+from qcportal.molecules import Molecule
+from qcportal.record_models import RecordStatusEnum
+
+if TYPE_CHECKING:
+    from qcarchivetesting.testing_classes import QCATestingSnowflake
+
+
+def _build_test_dataset(snowflake: QCATestingSnowflake, n_extra_entries: int = 0):
+    snowflake_client = snowflake.client()
+    storage_socket = snowflake.get_storage_socket()
+    manager_name, _ = snowflake.activate_manager()
+
+    ds = snowflake_client.add_dataset("singlepoint", "Test dataset")
+
+    input_spec, molecule, _ = load_test_data("sp_psi4_peroxide_energy_wfn")
+    run_test_data(storage_socket, manager_name, "sp_psi4_peroxide_energy_wfn")
+
+    ds.add_specification("spec_1", input_spec)
+    ds.add_entry(name="test_molecule", molecule=molecule)
+
+    for i in range(n_extra_entries):
+        ds.add_entry(name=f"test_molecule_{i}", molecule=Molecule(symbols=["He"], geometry=[0, 0, i]))
+
+    ds.submit()
+    return ds
+
+
+def _wait_for_job(snowflake_client, job_id: int):
+    for _ in range(60):
+        job = snowflake_client.get_internal_job(job_id)
+        if job.status not in (InternalJobStatusEnum.waiting, InternalJobStatusEnum.running):
+            break
+        time.sleep(0.5)
+
+    return job
+
+
+def test_dataset_view_entries(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    ds = _build_test_dataset(snowflake, 20)
+
+    view_path = str(tmp_path / "view.sqlite")
+    create_dataset_view(ds.id, storage_socket, view_path)
+
+    view = load_dataset_view(view_path)
+    assert view.is_view
+    assert view.id == ds.id
+    assert set(view.entry_names) == set(ds.entry_names)
+
+    # Make the view use many small chunks
+    view._view_data.deserialize_chunk_size = 3
+
+    all_entries = list(view.iterate_entries())
+    assert sorted(x.name for x in all_entries) == sorted(view.entry_names)
+
+    # Specified order is kept, and missing entries are skipped
+    some_names = ["test_molecule_5", "does_not_exist", "test_molecule", "test_molecule_2"]
+    some_entries = list(view.iterate_entries(some_names))
+    assert [x.name for x in some_entries] == ["test_molecule_5", "test_molecule", "test_molecule_2"]
+
+    entry = view.get_entry("test_molecule")
+    assert entry.molecule.get_hash() == ds.get_entry("test_molecule").molecule.get_hash()
+    assert view.get_entry("does_not_exist") is None
+
+
+def test_dataset_view_records(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    ds = _build_test_dataset(snowflake, 3)
+
+    view_path = str(tmp_path / "view.sqlite")
+    create_dataset_view(ds.id, storage_socket, view_path)
+    view = load_dataset_view(view_path)
+
+    assert view.specification_names == ["spec_1"]
+
+    records = list(view.iterate_records())
+    assert len(records) == 4
+
+    rec = view.get_record("test_molecule", "spec_1")
+    assert rec.status == RecordStatusEnum.complete
+    assert rec.properties == ds.get_record("test_molecule", "spec_1").properties
+
+
+def test_dataset_view_small_batches(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    ds = _build_test_dataset(snowflake, 10)
+
+    # Many batches, and more workers than items in a batch
+    view_path = str(tmp_path / "view.sqlite")
+    create_dataset_view(ds.id, storage_socket, view_path, batch_size=3, max_compression_workers=4)
+
+    # View is a single, self-contained file
+    assert not os.path.exists(view_path + "-wal")
+
+    view = load_dataset_view(view_path)
+    records = list(view.iterate_records())
+    assert len(records) == 11
+    assert {(e, s) for e, s, _ in records} == {(e, "spec_1") for e in ds.entry_names}
+
+    for e, s, r in records:
+        assert r.id == ds.get_record(e, s).id
+
+    # Will not overwrite an existing file
+    with pytest.raises(RuntimeError, match="exists"):
+        create_dataset_view(ds.id, storage_socket, view_path)
+
+
+def test_dataset_view_internal_job(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    snowflake_client = snowflake.client()
+    ds = _build_test_dataset(snowflake, 3)
+
+    view_path = str(tmp_path / "view.sqlite")
+    job_id = storage_socket.datasets.add_create_view_internal_job(ds.id, view_path)
+
+    snowflake.start_job_runner()
+
+    job = _wait_for_job(snowflake_client, job_id)
+    assert job.status == InternalJobStatusEnum.complete
+    assert job.progress == 100
+
+    view = load_dataset_view(view_path)
+    assert len(list(view.iterate_records())) == 4
+
+
+def test_dataset_view_internal_job_refresh(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    snowflake_client = snowflake.client()
+    ds = _build_test_dataset(snowflake, 3)
+
+    view_path = str(tmp_path / "view.sqlite")
+    create_dataset_view(ds.id, storage_socket, view_path)
+
+    ds.add_entry(name="test_molecule_new", molecule=Molecule(symbols=["Ne"], geometry=[0, 0, 0]))
+    ds.submit()
+
+    # Existing file is updated, not overwritten
+    job_id = storage_socket.datasets.add_create_view_internal_job(ds.id, view_path, refresh=True)
+    snowflake.start_job_runner()
+
+    job = _wait_for_job(snowflake_client, job_id)
+    assert job.status == InternalJobStatusEnum.complete
+
+    view = load_dataset_view(view_path)
+    assert "test_molecule_new" in view.entry_names
+    assert len(list(view.iterate_records())) == 5
+
+
+def test_dataset_view_properties_df(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    ds = _build_test_dataset(snowflake, 3)
+
+    view_path = str(tmp_path / "view.sqlite")
+    create_dataset_view(ds.id, storage_socket, view_path)
+    view = load_dataset_view(view_path)
+    assert view._view_data.has_record_properties()
+
+    rec = ds.get_record("test_molecule", "spec_1")
+    properties_list = ["return_energy", "calcinfo_nbasis", "scf_dipole_moment", "does_not_exist"]
+    assert isinstance(rec.properties["scf_dipole_moment"], list)
+
+    df = view._view_data.get_record_properties(properties_list)
+    assert len(df) == 1
+    assert df["return_energy"][0] == rec.properties["return_energy"]
+    assert df["scf_dipole_moment"][0] == rec.properties["scf_dipole_moment"]
+
+    # Only complete records
+    df = view._view_data.get_record_properties(properties_list, status=None)
+    assert len(df) == 4
+
+    view_df = view.get_properties_df(properties_list)
+    ds_df = ds.get_properties_df(properties_list)
+    pd.testing.assert_frame_equal(view_df, ds_df)
+
+
+def test_dataset_view_refresh(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    snowflake_client = snowflake.client()
+    ds = _build_test_dataset(snowflake, 5)
+
+    view_path = str(tmp_path / "view.sqlite")
+    create_dataset_view(ds.id, storage_socket, view_path)
+
+    # Nothing has changed - no records should be fetched
+    fetched_ids = []
+    orig_get = storage_socket.records.get
+
+    def _counting_get(record_ids, *args, **kwargs):
+        fetched_ids.extend(record_ids)
+        return orig_get(record_ids, *args, **kwargs)
+
+    storage_socket.records.get = _counting_get
+    refresh_dataset_view(ds.id, storage_socket, view_path, batch_size=2)
+    assert fetched_ids == []
+
+    # Change the dataset
+    ds.delete_entries(["test_molecule_0"])
+    ds.rename_entries({"test_molecule_1": "test_molecule_renamed"})
+    ds.add_entry(name="test_molecule_new", molecule=Molecule(symbols=["Ne"], geometry=[0, 0, 0]))
+    ds.submit()
+    rec_2 = ds.get_record("test_molecule_2", "spec_1")
+    snowflake_client.cancel_records([rec_2.id])
+
+    refresh_dataset_view(ds.id, storage_socket, view_path, batch_size=2)
+    storage_socket.records.get = orig_get
+
+    rec_renamed = ds.get_record("test_molecule_renamed", "spec_1")
+    rec_new = ds.get_record("test_molecule_new", "spec_1")
+    assert sorted(fetched_ids) == sorted([rec_2.id, rec_renamed.id, rec_new.id])
+
+    # Should match a freshly-created view
+    new_view_path = str(tmp_path / "view_new.sqlite")
+    create_dataset_view(ds.id, storage_socket, new_view_path)
+
+    view = load_dataset_view(view_path)
+    new_view = load_dataset_view(new_view_path)
+
+    assert sorted(view.entry_names) == sorted(new_view.entry_names)
+    assert "test_molecule_0" not in view.entry_names
+
+    records = {(e, s): r for e, s, r in view.iterate_records()}
+    new_records = {(e, s): r for e, s, r in new_view.iterate_records()}
+    assert records.keys() == new_records.keys()
+    assert records[("test_molecule_2", "spec_1")].status == RecordStatusEnum.cancelled
+    for k, r in records.items():
+        assert r.id == new_records[k].id
+        assert r.modified_on == new_records[k].modified_on
+
+    df = view._view_data.get_record_properties(["return_energy"], status=None)
+    assert len(df) == len(records)
+
+    # Old properties are removed
+    prop_stmt = "SELECT entry_name, specification_name, property_name FROM dataset_record_property"
+    assert sorted(view._view_data._sqlite_con.execute(prop_stmt)) == sorted(
+        new_view._view_data._sqlite_con.execute(prop_stmt)
+    )
+
+    # Can't refresh a view of a different dataset
+    ds2 = snowflake_client.add_dataset("singlepoint", "Test dataset 2")
+    with pytest.raises(RuntimeError, match="is of dataset"):
+        refresh_dataset_view(ds2.id, storage_socket, view_path)
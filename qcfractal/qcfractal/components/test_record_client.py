@@ -7,6 +7,7 @@ from datetime import datetime
 from typing import TYPE_CHECKING
 
 import pytest
+from sqlalchemy import select
 
 from qcarchivetesting import test_users
 from qcarchivetesting.testing_classes import QCATestingSnowflake
@@ -14,14 +15,17 @@ from qcfractal.components.optimization.testing_helpers import (
     run_test_data as run_opt_test_data,
     submit_test_data as submit_opt_test_data,
 )
-from qcfractal.components.record_db_models import BaseRecordORM
+from qcfractal.components.record_db_models import BaseRecordORM, OutputChunkORM
 from qcfractal.components.singlepoint.testing_helpers import (
     run_test_data as run_sp_test_data,
     submit_test_data as submit_sp_test_data,
 )
 from qcfractal.components.testing_helpers import populate_records_status
-from qcfractal.components.torsiondrive.testing_helpers import submit_test_data as submit_td_test_data
-from qcfractal.testing_helpers import DummyJobProgress
+from qcfractal.components.torsiondrive.testing_helpers import (
+    submit_test_data as submit_td_test_data,
+    generate_task_key as generate_td_task_key,
+)
+from qcfractal.testing_helpers import DummyJobProgress, run_service
 from qcportal import PortalRequestError
 from qcportal.molecules import Molecule
 from qcportal.record_models import PriorityEnum, RecordStatusEnum
@@ -55,6 +59,52 @@ def test_record_client_get(snowflake: QCATestingSnowflake):
     assert r[1].task is not None
 
 
+def test_record_client_get_includes_inline(snowflake: QCATestingSnowflake):
+    storage_socket = snowflake.get_storage_socket()
+    activated_manager_name, _ = snowflake.activate_manager()
+    snowflake_client = snowflake.client()
+
+    id1 = run_sp_test_data(storage_socket, activated_manager_name, "sp_psi4_benzene_energy_1")
+    id2, _ = submit_opt_test_data(storage_socket, "opt_psi4_benzene")
+    id3, _ = submit_td_test_data(storage_socket, "td_H2O2_mopac_pm6")
+    all_id = [id1, id2, id3]
+    snowflake_client.add_comment(all_id, "A comment")
+
+    # Count all the requests made by the client
+    requests = []
+    orig_make_request = snowflake_client.make_request
+
+    def _counting_make_request(method, endpoint, *args, **kwargs):
+        requests.append(endpoint)
+        return orig_make_request(method, endpoint, *args, **kwargs)
+
+    snowflake_client.make_request = _counting_make_request
+
+    includes = ["compute_history", "comments", "task", "service", "native_files"]
+    r = snowflake_client.get_records(all_id, include=includes)
+
+    # One request per batch, rather than per record
+    batch_size = snowflake_client.api_limits["get_records"] // 4
+    assert requests == ["api/v1/records/bulkGet"] * ((len(all_id) + batch_size - 1) // batch_size)
+
+    assert len(r[0].compute_history_) == 1
+    assert r[0].compute_history[0].outputs_ is None
+    assert r[0].stdout is not None
+    assert r[0].native_files_ is not None
+    assert r[0].task_ is None
+    assert r[1].task_ is not None
+    assert r[1].task_.required_programs == r[1].task.required_programs
+    assert r[2].service_ is not None
+    assert len(r[2].service_.dependencies) == 0
+    assert all(len(x.comments_) == 1 for x in r)
+
+    requests.clear()
+    r = snowflake_client.get_optimizations([id2], include=["compute_history", "initial_molecule"])
+    assert requests == ["api/v1/records/optimization/bulkGet", "api/v1/molecules/bulkGet"]
+    assert r[0].compute_history_ == []
+    assert r[0].initial_molecule_ is not None
+
+
 def test_record_client_get_missing(snowflake: QCATestingSnowflake):
     storage_socket = snowflake.get_storage_socket()
     snowflake_client = snowflake.client()
@@ -108,6 +158,51 @@ def test_record_client_query_parents_children(snowflake: QCATestingSnowflake):
     assert query_res_l[0].id == opt_rec.id
 
 
+def test_record_client_get_appended_output(snowflake: QCATestingSnowflake):
+    storage_socket = snowflake.get_storage_socket()
+    activated_manager_name, _ = snowflake.activate_manager()
+    snowflake_client = snowflake.client()
+
+    # Run a few iterations of a service. Each iteration appends to the stdout
+    id_1, result_data_1 = submit_td_test_data(storage_socket, "td_H2O2_mopac_pm6")
+    finished, _ = run_service(storage_socket, activated_manager_name, id_1, generate_td_task_key, result_data_1, 3)
+    assert finished is False
+
+    with storage_socket.session_scope() as session:
+        rec = session.get(BaseRecordORM, id_1)
+        stdout_orm = rec.compute_history[-1].outputs["stdout"]
+        stdout_id = stdout_orm.id
+        n_chunks = len(session.execute(stdout_orm.chunks.select()).all())
+        stdout = stdout_orm.get_output()
+
+    assert n_chunks > 0
+    assert stdout.startswith("Starting service")
+
+    rec = snowflake_client.get_records(id_1)
+    assert rec.stdout == stdout
+
+    # Chunks are being merged, but that isn't committed yet
+    with storage_socket.session_scope() as session:
+        assert storage_socket.records.compact_output(session, stdout_id)
+        session.flush()
+
+        rec = snowflake_client.get_records(id_1)
+        assert rec.stdout == stdout
+
+    rec = snowflake_client.get_records(id_1)
+    assert rec.stdout == stdout
+
+    # Merge the chunks into the output
+    with storage_socket.session_scope() as session:
+        storage_socket.records.compact_outputs(session, DummyJobProgress())
+
+    with storage_socket.session_scope() as session:
+        assert len(session.execute(select(OutputChunkORM)).all()) == 0
+
+    rec = snowflake_client.get_records(id_1)
+    assert rec.stdout == stdout
+
+
 def test_record_client_add_comment(secure_snowflake: QCATestingSnowflake):
     storage_socket = secure_snowflake.get_storage_socket()
 
@@ -0,0 +1,143 @@
+"""
+Tests the client-side record/molecule cache
+"""
+from __future__ import annotations
+
+import pytest
+
+from qcarchivetesting.testing_classes import QCATestingSnowflake
+from qcfractal.components.optimization.testing_helpers import submit_test_data as submit_opt_test_data
+from qcfractal.components.singlepoint.testing_helpers import run_test_data as run_sp_test_data
+from qcportal import PortalClient
+from qcportal.cache import compute_server_fingerprint
+from qcportal.molecules import Molecule
+
+
+def test_record_client_cache_fingerprint():
+    fp1 = compute_server_fingerprint("https://server.example.com/", "Test Server")
+    fp2 = compute_server_fingerprint("server.example.com", "Test Server")
+    fp3 = compute_server_fingerprint("https://other.example.com/", "Test Server")
+
+    assert fp1 == fp2
+    assert fp1 != fp3
+    assert " " not in fp1
+
+
+@pytest.mark.parametrize("memory_cache_size", [0, 100])
+def test_record_client_cache_records(snowflake: QCATestingSnowflake, tmp_path, memory_cache_size: int):
+    storage_socket = snowflake.get_storage_socket()
+    activated_manager_name, _ = snowflake.activate_manager()
+
+    id1 = run_sp_test_data(storage_socket, activated_manager_name, "sp_psi4_benzene_energy_1")
+    id2, _ = submit_opt_test_data(storage_socket, "opt_psi4_benzene")
+    all_id = [id1, id2]
+
+    client = PortalClient(snowflake.get_uri(), cache_dir=str(tmp_path), memory_cache_size=memory_cache_size)
+    assert client.cache_dir.startswith(str(tmp_path))
+
+    r = client.get_records(all_id)
+    assert [x.id for x in r] == all_id
+
+    # A new client using the same directory should find the records on disk
+    client2 = PortalClient(snowflake.get_uri(), cache_dir=str(tmp_path), memory_cache_size=memory_cache_size)
+    cached = client2._cache.get_records(all_id, client2)
+    assert set(cached.keys()) == set(all_id)
+    assert cached[id1].modified_on == r[0].modified_on
+    assert cached[id1]._client is client2
+
+    r2 = client2.get_records(all_id)
+    assert [x.id for x in r2] == all_id
+    assert r2[0].properties == r[0].properties
+    assert r2[1].status == r[1].status
+
+    # Modifying a record on the server invalidates the cached copy
+    client2.cancel_records(id2)
+    r3 = client2.get_records(id2)
+    assert r3.modified_on > r[1].modified_on
+    assert r3.status == "cancelled"
+
+    # Deleting a record removes it from the cache
+    client2.delete_records(id2, soft_delete=False)
+    r4 = client2.get_records(all_id, missing_ok=True)
+    assert r4[0].id == id1
+    assert r4[1] is None
+    assert set(client2._cache.get_records(all_id, client2).keys()) == {id1}
+
+    stats = client2.cache.statistics
+    assert stats.memory_hits + stats.disk_hits > 0
+    if memory_cache_size == 0:
+        assert stats.memory_items == 0
+
+    client2.clear_cache()
+    assert client2._cache.get_records(all_id, client2) == {}
+
+
+def test_record_client_cache_memory_bytes(snowflake: QCATestingSnowflake):
+    storage_socket = snowflake.get_storage_socket()
+    activated_manager_name, _ = snowflake.activate_manager()
+
+    id1 = run_sp_test_data(storage_socket, activated_manager_name, "sp_psi4_benzene_energy_1")
+    id2, _ = submit_opt_test_data(storage_socket, "opt_psi4_benzene")
+
+    client = PortalClient(snowflake.get_uri(), memory_cache_size=None, memory_cache_max_bytes=10 * 1024**2)
+    assert client.cache_dir is None
+
+    client.get_records([id1, id2])
+    stats = client.cache.statistics
+    assert stats.memory_items == 2
+    assert 0 < stats.memory_bytes < 10 * 1024**2
+
+    client.get_records([id1, id2])
+    assert client.cache.statistics.memory_hits == 2
+
+    # Byte limit on its own enables the memory cache
+    client = PortalClient(snowflake.get_uri(), memory_cache_max_bytes=10 * 1024**2)
+    assert client.cache is not None
+    assert client.cache.memcache.maxsize is None
+    assert client.cache.memcache.max_bytes == 10 * 1024**2
+
+    client.get_records([id1, id2])
+    client.get_records([id1, id2])
+    assert client.cache.statistics.memory_hits == 2
+
+
+def test_record_client_cache_records_by_type(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    activated_manager_name, _ = snowflake.activate_manager()
+
+    id1 = run_sp_test_data(storage_socket, activated_manager_name, "sp_psi4_benzene_energy_1")
+    id2, _ = submit_opt_test_data(storage_socket, "opt_psi4_benzene")
+
+    client = PortalClient(snowflake.get_uri(), cache_dir=str(tmp_path))
+    client.get_records([id1, id2])
+
+    r = client.get_singlepoints(id1)
+    assert r.id == id1
+
+    # Cached record is of the wrong type, so must go to the server (which will complain)
+    r = client.get_singlepoints([id2], missing_ok=True)
+    assert r == [None]
+
+
+def test_record_client_cache_molecules(snowflake: QCATestingSnowflake, tmp_path):
+    client = PortalClient(snowflake.get_uri(), cache_dir=str(tmp_path), memory_cache_size=10)
+
+    water = Molecule(symbols=["O", "H", "H"], geometry=[0, 0, 0, 0, 0, 2, 0, 2, 0])
+    hooh = Molecule(symbols=["H", "O", "O", "H"], geometry=[0, 0, 0, 0, 0, 2, 0, 2, 0, 2, 2, 0])
+    _, mol_ids = client.add_molecules([water, hooh])
+
+    mols = client.get_molecules(mol_ids)
+    assert [m.get_hash() for m in mols] == [water.get_hash(), hooh.get_hash()]
+
+    client2 = PortalClient(snowflake.get_uri(), cache_dir=str(tmp_path))
+    cached = client2._cache.get_molecules(mol_ids)
+    assert set(cached.keys()) == set(mol_ids)
+    assert cached[mol_ids[0]].get_hash() == water.get_hash()
+
+    # Modifying removes from the cache
+    client2.modify_molecule(mol_ids[0], name="new water name")
+    assert set(client2._cache.get_molecules(mol_ids).keys()) == {mol_ids[1]}
+
+    mols = client2.get_molecules(mol_ids)
+    assert mols[0].name == "new water name"
+    assert mols[1].get_hash() == hooh.get_hash()
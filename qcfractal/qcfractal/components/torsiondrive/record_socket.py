@@ -20,6 +20,7 @@ from qcfractal.components.optimization.record_db_models import (
 )
 from qcfractal.components.services.db_models import ServiceQueueORM, ServiceDependencyORM
 from qcfractal.components.singlepoint.record_db_models import QCSpecificationORM
+from qcportal.compression import CompressionEnum, compress, decompress
 from qcportal.exceptions import MissingDataError
 from qcportal.metadata_models import InsertMetadata
 from qcportal.molecules import Molecule
@@ -75,6 +76,30 @@ class TorsiondriveServiceState(BaseModel):
     molecule_template: str
     dihedral_template: str
 
+    @classmethod
+    def from_stored(cls, stored: Dict[str, Any]) -> TorsiondriveServiceState:
+        """
+        Loads the state from what is stored in the service_state column
+        """
+
+        # Services started before the state was compressed store it as a plain dict
+        if "state_compressed" in stored:
+            stored = decompress(stored["state_compressed"], CompressionEnum.zstd)
+
+        return cls(**stored)
+
+    def to_stored(self) -> Dict[str, Any]:
+        """
+        Converts the state to what is to be stored in the service_state column
+
+        The torsiondrive state contains the geometries of every optimization so far, so the
+        whole state is stored as a single compressed blob.
+        """
+
+        # Use a low compression level - this is rewritten every iteration
+        state_compressed, _, _ = compress(self.dict(), CompressionEnum.zstd, 3)
+        return {"state_compressed": state_compressed}
+
 
 # Meaningless, but unique to torsiondrives
 torsiondrive_insert_lock_id = 14200
@@ -156,7 +181,7 @@ class TorsiondriveRecordSocket(BaseRecordSocket):
             molecule_template=molecule_template_str,
         )
 
-        service_orm.service_state = service_state.dict()
+        service_orm.service_state = service_state.to_stored()
         sqlalchemy.orm.attributes.flag_modified(service_orm, "service_state")
 
     def iterate_service(
@@ -175,33 +200,43 @@ class TorsiondriveRecordSocket(BaseRecordSocket):
         }
 
         # Load the state from the service_state column
-        service_state = TorsiondriveServiceState(**service_orm.service_state)
+        service_state = TorsiondriveServiceState.from_stored(service_orm.service_state)
 
         # Sort by position
         # Fully sorting by the key is not important since that ends up being a key in the dict
         # All that matters is that position 1 for a particular key comes before position 2, etc
+        # The dependencies are only those submitted in the previous iteration, so only their
+        # results are fed to the torsiondrive package (which already has the earlier ones in its state)
         complete_tasks = sorted(service_orm.dependencies, key=lambda x: x.extras["position"])
 
+        # Get the molecule ids & energies of all the optimizations at once
+        stmt = select(
+            OptimizationRecordORM.id,
+            OptimizationRecordORM.initial_molecule_id,
+            OptimizationRecordORM.final_molecule_id,
+            OptimizationRecordORM.energies,
+        )
+        stmt = stmt.where(OptimizationRecordORM.id.in_([x.record_id for x in complete_tasks]))
+        opt_data = {x.id: x for x in session.execute(stmt).all()}
+
+        # Then all the geometries
+        mol_ids = list({y for x in opt_data.values() for y in (x.initial_molecule_id, x.final_molecule_id)})
+        mol_data = self.root_socket.molecules.get(molecule_id=mol_ids, include=["id", "geometry"], session=session)
+
+        # Use plain lists rather than numpy arrays
+        geometries = {x["id"]: x["geometry"].tolist() for x in mol_data}
+
         # Populate task results needed by the torsiondrive package
         task_results = {}
         for task in complete_tasks:
             td_api_key = task.extras["td_api_key"]
             task_results.setdefault(td_api_key, [])
 
-            # This is an ORM for an optimization
-            opt_record = task.record
-
-            # Lookup molecules
-            initial_id = opt_record.initial_molecule_id
-            final_id = opt_record.final_molecule_id
-            mol_ids = [initial_id, final_id]
-            mol_data = self.root_socket.molecules.get(molecule_id=mol_ids, include=["geometry"], session=session)
-
-            # Use plain lists rather than numpy arrays
-            initial_mol_geom = mol_data[0]["geometry"].tolist()
-            final_mol_geom = mol_data[1]["geometry"].tolist()
+            opt = opt_data[task.record_id]
+            initial_mol_geom = geometries[opt.initial_molecule_id]
+            final_mol_geom = geometries[opt.final_molecule_id]
 
-            task_results[td_api_key].append((initial_mol_geom, final_mol_geom, opt_record.energies[-1]))
+            task_results[td_api_key].append((initial_mol_geom, final_mol_geom, opt.energies[-1]))
 
         # The torsiondrive package uses print, so capture that using contextlib
         # Also capture any warnings generated by that package
@@ -237,7 +272,7 @@ class TorsiondriveRecordSocket(BaseRecordSocket):
         # Set the new service state. We must then mark it as modified
         # so that SQLAlchemy can pick up changes. This is because SQLAlchemy
         # cannot track mutations in nested dicts
-        service_orm.service_state = service_state.dict()
+        service_orm.service_state = service_state.to_stored()
         sqlalchemy.orm.attributes.flag_modified(service_orm, "service_state")
 
         # Return True to indicate that this service has successfully completed
@@ -7,6 +7,7 @@ import pytest
 
 from qcarchivetesting import load_molecule_data
 from qcfractal.components.torsiondrive.record_db_models import TorsiondriveRecordORM
+from qcfractal.components.torsiondrive.record_socket import TorsiondriveServiceState
 from qcfractal.db_socket import SQLAlchemySocket
 from qcfractal.testing_helpers import run_service
 from qcportal.auth import UserInfo, GroupInfo
@@ -14,7 +15,7 @@ from qcportal.optimization import OptimizationSpecification, OptimizationProtoco
 from qcportal.record_models import RecordStatusEnum, PriorityEnum
 from qcportal.singlepoint import QCSpecification, SinglepointProtocols
 from qcportal.torsiondrive import TorsiondriveSpecification, TorsiondriveKeywords
-from .testing_helpers import compare_torsiondrive_specs, test_specs, load_test_data, generate_task_key
+from .testing_helpers import compare_torsiondrive_specs, test_specs, load_test_data, generate_task_key, submit_test_data
 
 if TYPE_CHECKING:
     from qcfractal.db_socket import SQLAlchemySocket
@@ -327,6 +328,31 @@ def test_torsiondrive_socket_run(
     assert len(rec.optimizations) == n_optimizations
 
 
+def test_torsiondrive_socket_service_state():
+    td_state = {"grid_spacing": [15], "grid_status": {"-90": [[[0.0, 1.0, 2.0], [0.1, 1.1, 2.1], -76.5]]}}
+    state = TorsiondriveServiceState(torsiondrive_state=td_state, molecule_template="{}", dihedral_template="[]")
+
+    stored = state.to_stored()
+    assert isinstance(stored["state_compressed"], bytes)
+    assert TorsiondriveServiceState.from_stored(stored) == state
+
+    # State stored as a plain dict (before compression was used)
+    assert TorsiondriveServiceState.from_stored(state.dict()) == state
+
+
+def test_torsiondrive_socket_service_state_get(storage_socket: SQLAlchemySocket, activated_manager_name: ManagerName):
+    record_id, result_data = submit_test_data(storage_socket, "td_H2O2_mopac_pm6")
+    finished, _ = run_service(storage_socket, activated_manager_name, record_id, generate_task_key, result_data, 1)
+    assert not finished
+
+    # Stored compressed, but returned uncompressed
+    rec = storage_socket.records.torsiondrive.get([record_id], include=["*", "service"])[0]
+    service_state = rec["service_"]["service_state"]
+    assert "state_compressed" not in service_state
+    td_state = TorsiondriveServiceState(**service_state).torsiondrive_state
+    assert td_state["grid_spacing"] == rec["specification"]["keywords"]["grid_spacing"]
+
+
 def test_torsiondrive_socket_run_duplicate(
     storage_socket: SQLAlchemySocket,
     session: Session,
@@ -7,7 +7,7 @@ from __future__ import annotations
 import logging
 import os
 import secrets
-from typing import Optional, Dict, Union, Any
+from typing import Optional, Dict, Union, Any, List
 
 import yaml
 from psycopg2.extensions import make_dsn, parse_dsn
@@ -283,6 +283,25 @@ class APILimitConfig(ConfigBase):
         env_prefix = "QCF_APILIMIT_"
 
 
+class InternalJobLaneConfig(ConfigBase):
+    """
+    Settings for a lane of internal job runners
+    """
+
+    functions: Optional[List[str]] = Field(
+        None,
+        description="Functions whose jobs are run in this lane. Entries can be a function name (services.iterate_services) "
+        "or all functions of a socket (services.*). If not specified, this lane runs all jobs not handled by other lanes",
+    )
+    threads: int = Field(1, description="Number of threads in each internal job process that run jobs from this lane")
+
+    @validator("threads")
+    def _check_threads(cls, v):
+        if v < 1:
+            raise ValueError("Number of threads in an internal job lane must be at least 1")
+        return v
+
+
 class WebAPIConfig(ConfigBase):
     """
     Settings for the Web API (api) interface
@@ -358,8 +377,35 @@ class FractalConfig(ConfigBase):
     statistics_frequency: int = Field(
         3600, description="The frequency at which to update servre statistics (in seconds)"
     )
-    service_frequency: int = Field(60, description="The frequency at which to update services (in seconds)")
+    service_frequency: int = Field(
+        60,
+        description="The frequency at which to update services (in seconds). Services are normally iterated as soon "
+        "as all their dependencies finish; this periodic check starts new services and catches any that were missed",
+    )
     max_active_services: int = Field(20, description="The maximum number of concurrent active services")
+    max_active_services_per_tag: Dict[str, int] = Field(
+        {},
+        description="The maximum number of concurrent active services with a given tag. Tags not listed here are "
+        "only limited by max_active_services",
+    )
+    max_active_services_per_type: Dict[str, int] = Field(
+        {},
+        description="The maximum number of concurrent active services of a given record type (torsiondrive, "
+        "gridoptimization, etc). Types not listed here are only limited by max_active_services",
+    )
+    service_admission_max_waiting_tasks: Optional[int] = Field(
+        None,
+        description="If specified, new services are only started while fewer than this many tasks are waiting "
+        "to be claimed by compute managers",
+    )
+    stage_task_returns: bool = Field(
+        False,
+        description="If True, results returned from managers are staged and acknowledged immediately, and then ingested "
+        "into the database by internal jobs",
+    )
+    task_ingest_jobs: int = Field(
+        2, description="Number of internal jobs that ingest staged results concurrently (if stage_task_returns is True)"
+    )
     heartbeat_frequency: int = Field(
         1800, description="The frequency (in seconds) to check the heartbeat of compute managers"
     )
@@ -390,6 +436,17 @@ class FractalConfig(ConfigBase):
     internal_job_processes: int = Field(
         1, description="Number of processes for processing internal jobs and async requests"
     )
+    internal_job_lanes: Dict[str, InternalJobLaneConfig] = Field(
+        {"services": {"functions": ["services.*"]}, "default": {}},
+        description="Lanes of internal job runners, by name. Each lane runs its jobs in its own threads (in each "
+        "internal job process), so that long-running jobs in one lane do not hold up jobs in the others. "
+        "Exactly one lane must not specify its functions; it runs everything not handled by the other lanes",
+    )
+    internal_job_function_limits: Dict[str, int] = Field(
+        {},
+        description="Maximum number of internal jobs running a function at the same time (across all lanes and processes). "
+        "Keys can be a function name (services.iterate_services) or all functions of a socket (services.*)",
+    )
 
     # Homepage settings
     homepage_redirect_url: Optional[str] = Field(None, description="Redirect to this URL when going to the root path")
@@ -412,6 +469,18 @@ class FractalConfig(ConfigBase):
         values.setdefault("auto_reset", dict())
         return values
 
+    @validator("max_active_services_per_tag", "max_active_services_per_type")
+    def _check_max_active_services_keys(cls, v):
+        # Tags and record types are always stored lowercase
+        return {k.lower(): n for k, n in v.items()}
+
+    @validator("internal_job_lanes")
+    def _check_internal_job_lanes(cls, v):
+        n_default = sum(1 for x in v.values() if x.functions is None)
+        if n_default != 1:
+            raise ValueError(f"Exactly one internal job lane must not specify its functions (found {n_default})")
+        return v
+
     @validator("geoip2_dir")
     def _check_geoip2_dir(cls, v, values):
         return _make_abs_path(v, values["base_folder"], "geoip2")
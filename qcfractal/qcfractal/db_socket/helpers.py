@@ -393,6 +393,7 @@ def get_general(
     include: Optional[Iterable[str]],
     exclude: Optional[Iterable[str]],
     missing_ok: bool,
+    additional_options: Optional[Iterable[Any]] = None,
 ) -> List[Optional[Dict[str, Any]]]:
     """
     Perform a query for records based on a unique id
@@ -420,6 +421,8 @@ def get_general(
     missing_ok
         If False, an exception is raised if one of the values is missing. Else, None is returned in the list
         in place of the missing data
+    additional_options
+        Additional options (typically loader options for relationships) to add to the query
 
     Returns
     -------
@@ -444,6 +447,8 @@ def get_general(
 
     stmt = select(orm_type).filter(search_col.in_(unique_values))
     stmt = stmt.options(*proj_options)
+    if additional_options:
+        stmt = stmt.options(*additional_options)
 
     results = session.execute(stmt).scalars().all()
 
@@ -47,7 +47,7 @@ class FractalJobRunner:
         This function will block until interrupted
         """
 
-        self.storage_socket.internal_jobs.run_loop(self._end_event)
+        self.storage_socket.internal_jobs.run_lanes(self._end_event)
 
     def stop(self) -> None:
         """
@@ -1,15 +1,21 @@
 from __future__ import annotations
 
+import glob
 import json
+import logging
+import os
 import subprocess
+import sys
+import sysconfig
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache, partial
-from typing import TYPE_CHECKING, Dict, List, Set, Any, Optional
+from typing import TYPE_CHECKING, Dict, List, Set, Any, Optional, Tuple, Iterable
 
 import parsl
 
 from qcfractalcompute.apps.geometric import geometric_nextchain_conda_app, geometric_nextchain_apptainer_app
-from qcfractalcompute.apps.helpers import run_apptainer
+from qcfractalcompute.apps.helpers import build_apptainer_cmd
 from qcfractalcompute.apps.qcengine import qcengine_conda_app, qcengine_apptainer_app
 from qcfractalcompute.run_scripts import get_script_path
 from qcportal.record_models import RecordTask
@@ -18,9 +24,128 @@ if TYPE_CHECKING:
     from parsl.dataflow.dflow import DataFlowKernel
     from qcfractalcompute.config import FractalComputeConfig
 
+logger = logging.getLogger(__name__)
+
+
+class ProgramDiscoveryCache:
+    """
+    On-disk cache of the programs available in environments
+
+    Each entry stores a stamp of the environment (something that changes when packages are installed
+    into or removed from it). An entry is only used if the stamp still matches.
+    """
+
+    def __init__(self, file_path: Optional[str]):
+        self._file_path = file_path
+        self._data: Dict[str, Dict[str, Any]] = {}
+        self._modified = False
+
+        if file_path and os.path.isfile(file_path):
+            try:
+                with open(file_path, "r") as f:
+                    data = json.load(f)
+                if not isinstance(data, dict):
+                    raise ValueError("Cache file does not contain a dictionary")
+                self._data = data
+            except Exception as e:
+                logger.warning(f"Could not read program discovery cache {file_path}: {str(e)}")
+
+    def get(self, key: str, stamp: Optional[List[Any]]) -> Optional[Dict[str, Optional[str]]]:
+        if stamp is None:
+            return None
+
+        entry = self._data.get(key)
+        if isinstance(entry, dict) and entry.get("stamp") == stamp and isinstance(entry.get("programs"), dict):
+            return entry["programs"]
+
+        return None
+
+    def set(self, key: str, stamp: Optional[List[Any]], programs: Dict[str, Optional[str]]) -> None:
+        if stamp is None:
+            return
+
+        self._data[key] = {"stamp": stamp, "programs": programs}
+        self._modified = True
+
+    def save(self) -> None:
+        if not self._file_path or not self._modified:
+            return
+
+        try:
+            tmp_path = self._file_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._data, f)
+            os.replace(tmp_path, self._file_path)
+            self._modified = False
+        except Exception as e:
+            logger.warning(f"Could not write program discovery cache {self._file_path}: {str(e)}")
+
+
+def _file_stamp(path: str) -> Optional[List[Any]]:
+    try:
+        st = os.stat(path)
+        return [st.st_mtime, st.st_size]
+    except OSError:
+        return None
+
 
 @lru_cache()
-def discover_programs_conda(conda_env_name: Optional[str]) -> Dict[str, Dict[str, Any]]:
+def _conda_env_prefixes() -> Dict[str, str]:
+    """
+    Returns a mapping of conda environment name to prefix (path)
+    """
+
+    try:
+        result = subprocess.check_output(["conda", "env", "list", "--json"], universal_newlines=True)
+        env_paths = json.loads(result)["envs"]
+    except Exception:
+        return {}
+
+    return {os.path.basename(x): x for x in env_paths}
+
+
+def _site_packages_dirs(prefix: str) -> List[str]:
+    """
+    Returns the directories python packages are installed into for an environment prefix
+    """
+
+    if prefix == sys.prefix:
+        return [sysconfig.get_paths()["purelib"]]
+
+    dirs = glob.glob(os.path.join(prefix, "lib", "python*", "site-packages"))
+    dirs += glob.glob(os.path.join(prefix, "Lib", "site-packages"))
+    return sorted(dirs)
+
+
+def _environment_stamp(env: Tuple[str, Optional[str]]) -> Optional[List[Any]]:
+    env_type, env_name = env
+
+    if env_type == "apptainer":
+        return [env_name] + (_file_stamp(env_name) or [])
+
+    if env_name is None:
+        prefix = sys.prefix
+    else:
+        prefix = _conda_env_prefixes().get(env_name)
+        if prefix is None:
+            return None
+
+    # conda appends to the history file whenever packages are installed or removed. pip does not,
+    # so also use the directories where packages are installed (which change when packages are added or removed)
+    stamps = [_file_stamp(os.path.join(prefix, "conda-meta", "history"))]
+    stamps += [_file_stamp(x) for x in _site_packages_dirs(prefix)]
+    stamps = [x for x in stamps if x is not None]
+
+    if not stamps:
+        return None
+
+    return [prefix] + stamps
+
+
+def query_programs_conda(conda_env_name: Optional[str]) -> Dict[str, Optional[str]]:
+    """
+    Obtains the programs (and versions) available to qcengine in a conda environment
+    """
 
     qcengine_list_path = get_script_path("qcengine_list.py")
 
@@ -34,54 +159,109 @@ def discover_programs_conda(conda_env_name: Optional[str]) -> Dict[str, Dict[str
         result = subprocess.check_output(cmd, universal_newlines=True, cwd=tmpdir)
 
     # QCEngine differentiates between programs and procedures, but we don't
-    program_info = json.loads(result)
+    return json.loads(result)
 
-    # functions are always the same
-    functions = {
-        "qcengine.compute": {
-            "programs": program_info,
-            "app_function": partial(qcengine_conda_app, conda_env_name=conda_env_name),
-        },
-        "qcengine.compute_procedure": {
-            "programs": program_info,
-            "app_function": partial(qcengine_conda_app, conda_env_name=conda_env_name),
-        },
-    }
 
-    if "geometric" in program_info:
-        functions["geometric.qcf_neb.nextchain"] = {
-            "programs": {"geometric": program_info["geometric"]},
-            "app_function": partial(geometric_nextchain_conda_app, conda_env_name=conda_env_name),
-        }
-
-    return functions
-
-
-@lru_cache()
-def discover_programs_apptainer(sif_path: str) -> Dict[str, Dict[str, Any]]:
+def query_programs_apptainer(sif_path: str) -> Dict[str, Optional[str]]:
+    """
+    Obtains the programs (and versions) available to qcengine in an apptainer/singularity image
+    """
 
     qcengine_list_path = get_script_path("qcengine_list.py")
 
-    program_info = run_apptainer(
+    cmd = build_apptainer_cmd(
         sif_path, command=["python3", "/qcengine_list.py"], volumes=[(qcengine_list_path, "/qcengine_list.py")]
     )
 
+    with tempfile.TemporaryDirectory() as tmpdir:
+        result = subprocess.check_output(cmd, universal_newlines=True, cwd=tmpdir)
+
+    return json.loads(result)
+
+
+def _query_programs(env: Tuple[str, Optional[str]]) -> Dict[str, Optional[str]]:
+    env_type, env_name = env
+    if env_type == "apptainer":
+        return query_programs_apptainer(env_name)
+    else:
+        return query_programs_conda(env_name)
+
+
+def discover_programs(
+    envs: Iterable[Tuple[str, Optional[str]]], cache_file: Optional[str]
+) -> Dict[Tuple[str, Optional[str]], Dict[str, Optional[str]]]:
+    """
+    Obtains the programs available in multiple environments
+
+    Results are taken from the on-disk cache if the environment has not changed. All other
+    environments are queried in parallel, and the results are stored in the cache.
+
+    Parameters
+    ----------
+    envs
+        Environments to query. Each is a tuple of type ("conda" or "apptainer") and the conda
+        environment name (None for the current environment) or path to the apptainer image
+    cache_file
+        Path to the cache file. If None, the cache is not used
+    """
+
+    cache = ProgramDiscoveryCache(cache_file)
+
+    ret: Dict[Tuple[str, Optional[str]], Dict[str, Optional[str]]] = {}
+    stamps: Dict[Tuple[str, Optional[str]], Optional[List[Any]]] = {}
+    to_query: List[Tuple[str, Optional[str]]] = []
+
+    for env in envs:
+        stamps[env] = _environment_stamp(env) if cache_file else None
+        program_info = cache.get(f"{env[0]}:{env[1]}", stamps[env])
+
+        if program_info is None:
+            to_query.append(env)
+        else:
+            ret[env] = program_info
+
+    if to_query:
+        with ThreadPoolExecutor(max_workers=min(len(to_query), 8)) as pool:
+            for env, program_info in zip(to_query, pool.map(_query_programs, to_query)):
+                ret[env] = program_info
+                cache.set(f"{env[0]}:{env[1]}", stamps[env], program_info)
+
+        cache.save()
+
+    logger.info(f"Discovered programs in {len(ret)} environments ({len(ret) - len(to_query)} from cache)")
+    return ret
+
+
+def build_functions(env: Tuple[str, Optional[str]], program_info: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    """
+    Builds the functions (and their available programs) that can be run in an environment
+    """
+
+    env_type, env_name = env
+
+    if env_type == "apptainer":
+        qcengine_app = partial(qcengine_apptainer_app, sif_path=env_name)
+        geometric_app = partial(geometric_nextchain_apptainer_app, sif_path=env_name)
+    else:
+        qcengine_app = partial(qcengine_conda_app, conda_env_name=env_name)
+        geometric_app = partial(geometric_nextchain_conda_app, conda_env_name=env_name)
+
     # functions are always the same
     functions = {
         "qcengine.compute": {
             "programs": program_info,
-            "app_function": partial(qcengine_apptainer_app, sif_path=sif_path),
+            "app_function": qcengine_app,
         },
         "qcengine.compute_procedure": {
             "programs": program_info,
-            "app_function": partial(qcengine_apptainer_app, sif_path=sif_path),
+            "app_function": qcengine_app,
         },
     }
 
     if "geometric" in program_info:
         functions["geometric.qcf_neb.nextchain"] = {
             "programs": {"geometric": program_info["geometric"]},
-            "app_function": partial(geometric_nextchain_apptainer_app, sif_path=sif_path),
+            "app_function": geometric_app,
         }
 
     return functions
@@ -93,9 +273,10 @@ class AppManager:
         # key is executor label
         self._parsl_apps = {}
 
-        for executor_label, executor_config in manager_config.executors.items():
-            self._parsl_apps[executor_label] = []
+        # Environments for each executor
+        executor_envs: Dict[str, List[Tuple[str, Optional[str]]]] = {}
 
+        for executor_label, executor_config in manager_config.executors.items():
             # Merge in the global config into the executor-specific config
             use_current_env = executor_config.environments.use_manager_environment
             conda_envs = set(manager_config.environments.conda) | set(executor_config.environments.conda)
@@ -103,24 +284,27 @@ class AppManager:
             # Same for apptainers
             apptainers = set(manager_config.environments.apptainer) | set(executor_config.environments.apptainer)
 
+            envs = []
+
             # Check the current environment
             if use_current_env:
-                qcengine_functions = discover_programs_conda(None)
-                for qcengine_function_name, func_info in qcengine_functions.items():
-                    self._parsl_apps[executor_label].append(
-                        (qcengine_function_name, func_info["programs"], func_info["app_function"])
-                    )
+                envs.append(("conda", None))
 
-            # Check the conda environments in the config
-            for conda_env in conda_envs:
-                qcengine_functions = discover_programs_conda(conda_env)
-                for qcengine_function_name, func_info in qcengine_functions.items():
-                    self._parsl_apps[executor_label].append(
-                        (qcengine_function_name, func_info["programs"], func_info["app_function"])
-                    )
+            # Check the conda environments and apptainers in the config
+            envs.extend(("conda", x) for x in conda_envs)
+            envs.extend(("apptainer", x) for x in apptainers)
+
+            executor_envs[executor_label] = envs
+
+        # Discover all the environments at once
+        all_envs = {env for envs in executor_envs.values() for env in envs}
+        all_program_info = discover_programs(all_envs, manager_config.program_cache_file)
+
+        for executor_label, envs in executor_envs.items():
+            self._parsl_apps[executor_label] = []
 
-            for apptainer in apptainers:
-                qcengine_functions = discover_programs_apptainer(apptainer)
+            for env in envs:
+                qcengine_functions = build_functions(env, all_program_info[env])
                 for qcengine_function_name, func_info in qcengine_functions.items():
                     self._parsl_apps[executor_label].append(
                         (qcengine_function_name, func_info["programs"], func_info["app_function"])
@@ -32,7 +32,9 @@ def geometric_nextchain_conda_app(
         f.flush()
 
         cmd = ["python3", script_path, str(record_id), f.name]
-        return run_conda_subprocess(conda_env_name, cmd, executor_config.scratch_directory, env)
+        return run_conda_subprocess(
+            conda_env_name, cmd, executor_config.scratch_directory, env, executor_config.compression_level
+        )
 
 
 def geometric_nextchain_apptainer_app(
@@ -57,4 +59,6 @@ def geometric_nextchain_apptainer_app(
         volumes = [(script_path, "/geometric_nextchain.py"), (f.name, "/input.json")]
         cmd = ["python3", "/geometric_nextchain.py", str(record_id), "/input.json"]
 
-        return run_apptainer(sif_path, command=cmd, volumes=volumes)
+        return run_apptainer(
+            sif_path, command=cmd, volumes=volumes, compression_level=executor_config.compression_level
+        )
@@ -4,8 +4,10 @@ import json
 import os
 import shutil
 import subprocess
+import threading
 import time
-from typing import Optional, Dict, Tuple, List
+import traceback
+from typing import Optional, Dict, Tuple, List, Any, Hashable
 
 from qcfractalcompute.compress import compress_result
 from .models import AppTaskResult
@@ -28,13 +30,20 @@ def get_apptainer_cmd() -> str:
     return _apptainer_cmd
 
 
-def run_apptainer(sif_path: str, command: List[str], volumes: List[Tuple[str, str]]) -> AppTaskResult:
-
+def build_apptainer_cmd(sif_path: str, command: List[str], volumes: List[Tuple[str, str]]) -> List[str]:
     cmd = [get_apptainer_cmd()]
 
     volumes_tmp = [f"{v[0]}:{v[1]}" for v in volumes]
     cmd.extend(["run", "--bind", ",".join(volumes_tmp), sif_path])
     cmd.extend(command)
+    return cmd
+
+
+def run_apptainer(
+    sif_path: str, command: List[str], volumes: List[Tuple[str, str]], compression_level: Optional[int] = None
+) -> AppTaskResult:
+
+    cmd = build_apptainer_cmd(sif_path, command, volumes)
 
     time_0 = time.time()
     proc_result = subprocess.run(cmd, capture_output=True, text=True)
@@ -54,12 +63,16 @@ def run_apptainer(sif_path: str, command: List[str], volumes: List[Tuple[str, st
     return AppTaskResult(
         success=ret["success"],
         walltime=time_1 - time_0,
-        result_compressed=compress_result(ret),
+        result_compressed=compress_result(ret, compression_level),
     )
 
 
 def run_conda_subprocess(
-    conda_env_name: Optional[str], cmd: List[str], cwd: Optional[str], env: Dict[str, str]
+    conda_env_name: Optional[str],
+    cmd: List[str],
+    cwd: Optional[str],
+    env: Dict[str, str],
+    compression_level: Optional[int] = None,
 ) -> AppTaskResult:
 
     if cwd:
@@ -89,5 +102,124 @@ def run_conda_subprocess(
     return AppTaskResult(
         success=ret["success"],
         walltime=time_1 - time_0,
-        result_compressed=compress_result(ret),
+        result_compressed=compress_result(ret, compression_level),
+    )
+
+
+class PersistentRunner:
+    """
+    A long-lived process that runs tasks sent to it over a pipe
+
+    Each task is sent as a single line of json to the stdin of the process, and the result is read back as
+    a single line of json from its stdout (see run_scripts/qcengine_compute.py). The process exits when its
+    stdin is closed, which also happens if this (parent) process exits.
+    """
+
+    def __init__(self, cmd: List[str], cwd: Optional[str], env: Dict[str, str]):
+        if cwd:
+            cwd = os.path.expandvars(cwd)
+
+        sub_env = os.environ.copy()
+        sub_env.update(env)
+
+        self._proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1, cwd=cwd, env=sub_env
+        )
+
+        self.n_tasks = 0
+        self.max_rss = 0
+
+    def is_alive(self) -> bool:
+        return self._proc.poll() is None
+
+    def run(self, function_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        self._proc.stdin.write(json.dumps(function_kwargs) + "\n")
+        self._proc.stdin.flush()
+
+        line = self._proc.stdout.readline()
+        if not line:
+            raise RuntimeError(f"Persistent runner exited unexpectedly with error code {self._proc.wait()}")
+
+        response = json.loads(line)
+        self.n_tasks += 1
+        self.max_rss = response["max_rss"]
+        return response["result"]
+
+    def close(self) -> None:
+        try:
+            self._proc.stdin.close()
+            self._proc.wait(timeout=10)
+        except Exception:
+            self._proc.kill()
+            self._proc.wait()
+
+
+# Persistent runners for this thread. Key is given by the caller (usually identifies the environment)
+# When running in a thread pool, each thread gets its own runners
+_persistent_runners = threading.local()
+
+
+def run_persistent(
+    runner_key: Hashable,
+    cmd: List[str],
+    cwd: Optional[str],
+    env: Dict[str, str],
+    function_kwargs: Dict[str, Any],
+    max_tasks: int,
+    max_memory: Optional[float],
+    compression_level: Optional[int] = None,
+) -> AppTaskResult:
+    """
+    Runs a task in a persistent runner, starting a new runner if needed
+
+    Parameters
+    ----------
+    runner_key
+        Identifies the runner (within this thread) to use
+    cmd
+        Command used to start a new runner
+    cwd
+        Working directory for a new runner
+    env
+        Additional environment variables for a new runner
+    function_kwargs
+        Task to send to the runner
+    max_tasks
+        Restart the runner after this many tasks
+    max_memory
+        Restart the runner once its peak memory usage exceeds this (in GiB)
+    compression_level
+        Level to use when compressing the outputs and native files of the result
+    """
+
+    if not hasattr(_persistent_runners, "runners"):
+        _persistent_runners.runners = {}
+
+    runners: Dict[Hashable, PersistentRunner] = _persistent_runners.runners
+
+    runner = runners.get(runner_key)
+    if runner is None or not runner.is_alive():
+        runner = PersistentRunner(cmd, cwd, env)
+        runners[runner_key] = runner
+
+    time_0 = time.time()
+
+    try:
+        ret = runner.run(function_kwargs)
+        recycle = runner.n_tasks >= max_tasks or (max_memory is not None and runner.max_rss > max_memory * 1024**3)
+    except Exception:
+        msg = "Running task in persistent runner failed:\n" + traceback.format_exc()
+        ret = {"success": False, "error": {"error_type": "RuntimeError", "error_message": msg}}
+        recycle = True
+
+    time_1 = time.time()
+
+    if recycle:
+        runner.close()
+        del runners[runner_key]
+
+    return AppTaskResult(
+        success=ret["success"],
+        walltime=time_1 - time_0,
+        result_compressed=compress_result(ret, compression_level),
     )
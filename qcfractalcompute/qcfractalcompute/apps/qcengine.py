@@ -16,7 +16,7 @@ def qcengine_conda_app(
 ) -> AppTaskResult:
     import json
     from qcportal.compression import decompress, CompressionEnum
-    from qcfractalcompute.apps.helpers import run_conda_subprocess
+    from qcfractalcompute.apps.helpers import run_conda_subprocess, run_persistent
     from qcfractalcompute.run_scripts import get_script_path
 
     script_path = get_script_path("qcengine_compute.py")
@@ -38,12 +38,31 @@ def qcengine_conda_app(
     function_kwargs = decompress(function_kwargs_compressed, CompressionEnum.zstd)
     function_kwargs = {**function_kwargs, "task_config": qcengine_options}
 
+    if executor_config.persistent_runners:
+        # Output must be streamed (not captured by conda) to communicate with the runner
+        cmd = ["python3", script_path, "--persistent"]
+        if conda_env_name:
+            cmd = ["conda", "run", "--no-capture-output", "-n", conda_env_name] + cmd
+
+        return run_persistent(
+            ("conda", conda_env_name),
+            cmd,
+            executor_config.scratch_directory,
+            {},
+            function_kwargs,
+            executor_config.persistent_runner_max_tasks,
+            executor_config.persistent_runner_max_memory,
+            executor_config.compression_level,
+        )
+
     with tempfile.NamedTemporaryFile("w") as f:
         json.dump(function_kwargs, f)
         f.flush()
 
         cmd = ["python3", script_path, f.name]
-        return run_conda_subprocess(conda_env_name, cmd, executor_config.scratch_directory, {})
+        return run_conda_subprocess(
+            conda_env_name, cmd, executor_config.scratch_directory, {}, executor_config.compression_level
+        )
 
 
 def qcengine_apptainer_app(
@@ -54,7 +73,7 @@ def qcengine_apptainer_app(
 ) -> AppTaskResult:
     import json
     from qcportal.compression import decompress, CompressionEnum
-    from qcfractalcompute.apps.helpers import run_apptainer
+    from qcfractalcompute.apps.helpers import run_apptainer, build_apptainer_cmd, run_persistent
     from qcfractalcompute.run_scripts import get_script_path
 
     script_path = get_script_path("qcengine_compute.py")
@@ -76,6 +95,21 @@ def qcengine_apptainer_app(
     function_kwargs = decompress(function_kwargs_compressed, CompressionEnum.zstd)
     function_kwargs = {**function_kwargs, "task_config": qcengine_options}
 
+    if executor_config.persistent_runners:
+        volumes = [(script_path, "/qcengine_compute.py")]
+        cmd = build_apptainer_cmd(sif_path, ["python3", "/qcengine_compute.py", "--persistent"], volumes)
+
+        return run_persistent(
+            ("apptainer", sif_path),
+            cmd,
+            None,
+            {},
+            function_kwargs,
+            executor_config.persistent_runner_max_tasks,
+            executor_config.persistent_runner_max_memory,
+            executor_config.compression_level,
+        )
+
     with tempfile.NamedTemporaryFile("w") as f:
         json.dump(function_kwargs, f)
         f.flush()
@@ -83,4 +117,6 @@ def qcengine_apptainer_app(
         volumes = [(script_path, "/qcengine_compute.py"), (f.name, "/input.json")]
         cmd = ["python3", "/qcengine_compute.py", "/input.json"]
 
-        return run_apptainer(sif_path, command=cmd, volumes=volumes)
+        return run_apptainer(
+            sif_path, command=cmd, volumes=volumes, compression_level=executor_config.compression_level
+        )
@@ -2,14 +2,43 @@
 Helpers for compressing data to send back to the server
 """
 
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
 import numpy
+import zstandard
 
 from qcportal.compression import CompressionEnum, compress
 
+# Level used when compressing the entire result. Most of the large data (outputs and native files)
+# is already compressed by then, so a fast level is used
+_result_compression_level = 3
 
-def _compress_common(result: Dict[str, Any]):
+# Size of the sample used to check if data is compressible
+_compressible_sample_size = 65536
+
+
+def _is_compressible(data: Any) -> bool:
+    """
+    Checks if binary data is worth compressing (ie, is not already compressed)
+
+    Only a sample at the start of the data is checked, using a fast compression level
+    """
+
+    if not isinstance(data, bytes) or len(data) < _compressible_sample_size:
+        return True
+
+    sample = data[:_compressible_sample_size]
+    return len(zstandard.compress(sample, level=1)) < 0.95 * len(sample)
+
+
+def _compress_data(data: Any, compression_level: Optional[int]) -> Tuple[bytes, CompressionEnum, int]:
+    if _is_compressible(data):
+        return compress(data, CompressionEnum.zstd, compression_level)
+    else:
+        return compress(data, CompressionEnum.none)
+
+
+def _compress_common(result: Dict[str, Any], compression_level: Optional[int]):
     """
     Compresses outputs of an AtomicResult or OptimizationResult, storing them in extras
     """
@@ -22,19 +51,19 @@ def _compress_common(result: Dict[str, Any]):
 
     if stdout is not None:
         result["extras"].setdefault("_qcfractal_compressed_outputs", {})
-        new_stdout, ctype, clevel = compress(stdout, CompressionEnum.zstd)
+        new_stdout, ctype, clevel = compress(stdout, CompressionEnum.zstd, compression_level)
         compressed_outputs["stdout"] = {"compression_type": ctype, "compression_level": clevel, "data": new_stdout}
         result["stdout"] = None
 
     if stderr is not None:
         result["extras"].setdefault("_qcfractal_compressed_outputs", {})
-        new_stderr, ctype, clevel = compress(stderr, CompressionEnum.zstd)
+        new_stderr, ctype, clevel = compress(stderr, CompressionEnum.zstd, compression_level)
         compressed_outputs["stderr"] = {"compression_type": ctype, "compression_level": clevel, "data": new_stderr}
         result["stderr"] = None
 
     if error is not None:
         result["extras"].setdefault("_qcfractal_compressed_outputs", {})
-        new_error, ctype, clevel = compress(error.dict(), CompressionEnum.zstd)
+        new_error, ctype, clevel = compress(error.dict(), CompressionEnum.zstd, compression_level)
         compressed_outputs["error"] = {"compression_type": ctype, "compression_level": clevel, "data": new_error}
         result["error"] = None
 
@@ -42,9 +71,11 @@ def _compress_common(result: Dict[str, Any]):
         result["extras"]["_qcfractal_compressed_outputs"] = compressed_outputs
 
 
-def _compress_native_files(result: Dict[str, Any]):
+def _compress_native_files(result: Dict[str, Any], compression_level: Optional[int]):
     """
-    Compresses outputs and native files, storing them in extras
+    Compresses native files, storing them in extras
+
+    Native files that are already compressed are stored without (re-)compressing them
     """
 
     native_files = result.get("native_files", None)
@@ -53,14 +84,14 @@ def _compress_native_files(result: Dict[str, Any]):
 
     compressed_nf = {}
     for name, data in native_files.items():
-        nf, ctype, clevel = compress(data, CompressionEnum.zstd)
+        nf, ctype, clevel = _compress_data(data, compression_level)
         compressed_nf[name] = {"compression_type": ctype, "compression_level": clevel, "data": nf}
 
     result["native_files"] = {}
     result["extras"]["_qcfractal_compressed_native_files"] = compressed_nf
 
 
-def _compress_optimizationresult(result: Dict[str, Any]):
+def _compress_optimizationresult(result: Dict[str, Any], compression_level: Optional[int]):
     """
     Compresses outputs inside an OptimizationResult, storing them in extras
 
@@ -70,10 +101,10 @@ def _compress_optimizationresult(result: Dict[str, Any]):
     # Handle the trajectory
     if result.get("trajectory", None):
         for x in result["trajectory"]:
-            _compress_common(x)
+            _compress_common(x, compression_level)
 
     # Now handle the outputs of the optimization itself
-    _compress_common(result)
+    _compress_common(result, compression_level)
 
 
 def _convert_numpy(obj):
@@ -90,7 +121,7 @@ def _convert_numpy(obj):
         return obj
 
 
-def compress_result(result: Dict[str, Any]) -> bytes:
+def compress_result(result: Dict[str, Any], compression_level: Optional[int] = None) -> bytes:
     """
     Compress outputs and native files inside results, storing them in extras. Then compress the whole result
 
@@ -100,21 +131,23 @@ def compress_result(result: Dict[str, Any]) -> bytes:
     The compressed outputs are stored in extras. For OptimizationResult, the outputs for the optimization
     are stored in the extras field of the OptimizationResult, while the outputs for the trajectory
     are stored in the extras field for the AtomicResults within the trajectory
+
+    If compression_level is None, a default level is chosen based on the size of the data
     """
 
     result = _convert_numpy(result)
     schema_type = result.get("schema_name", None)
 
     if schema_type == "qcschema_output":
-        _compress_common(result)
-        _compress_native_files(result)
+        _compress_common(result, compression_level)
+        _compress_native_files(result, compression_level)
     elif schema_type == "qcschema_optimization_output":
-        _compress_optimizationresult(result)
+        _compress_optimizationresult(result, compression_level)
     elif schema_type == "qca_generic_task_result":
-        _compress_common(result)
+        _compress_common(result, compression_level)
     else:
         pass
 
     # Compress the whole thing
-    r, _, _ = compress(result, CompressionEnum.zstd)
+    r, _, _ = compress(result, CompressionEnum.zstd, _result_compression_level)
     return r
@@ -1,14 +1,14 @@
 from __future__ import annotations
 
 import logging
+import math
 import sched
 import socket
 import threading
 import time
 import traceback
 import uuid
-from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, List, Tuple
+from typing import TYPE_CHECKING, Dict, List, Tuple, Optional
 
 import parsl.executors.high_throughput.interchange
 import tabulate
@@ -21,7 +21,7 @@ from pydantic import BaseModel, Extra, Field
 from requests.exceptions import Timeout
 
 from qcfractalcompute.apps.app_manager import AppManager
-from qcportal import ManagerClient
+from qcportal import ManagerClient, PortalRequestError
 from qcportal.managers import ManagerName
 from qcportal.metadata_models import TaskReturnMetadata
 from qcportal.record_models import RecordTask
@@ -31,6 +31,7 @@ from .apps.models import AppTaskResult
 from .compress import compress_result
 from .config import FractalComputeConfig
 from .executors import build_executor
+from .result_spool import ResultSpool
 
 if TYPE_CHECKING:
     from parsl.executors.base import ParslExecutor
@@ -77,6 +78,39 @@ class ManagerStatistics(BaseModel):
         return self.total_successful_tasks + self.total_failed_tasks
 
 
+def calculate_claim_target(
+    max_workers: int, update_frequency: float, average_walltime: Optional[float], max_factor: int = 3
+) -> int:
+    """
+    Determine how many tasks an executor should have (running or queued) after claiming
+
+    Enough tasks are claimed to keep all workers busy until the next update, based on how long tasks
+    take to run on average. This is limited to `max_factor` times the number of workers, so that
+    tasks that could be run by other managers are not hoarded. If the average walltime is not
+    known, the maximum is used.
+
+    Parameters
+    ----------
+    max_workers
+        Maximum number of tasks the executor can run at once
+    update_frequency
+        Time between updates (in seconds)
+    average_walltime
+        Average walltime of tasks run on this executor (in seconds), or None if not known
+    max_factor
+        Maximum number of tasks to have, as a multiple of max_workers
+    """
+
+    max_target = max_factor * max_workers
+
+    if average_walltime is None:
+        return max_target
+
+    # Number of tasks we expect all the workers to finish before the next update
+    expected_finished = math.ceil(max_workers * update_frequency / max(average_walltime, 1.0e-3))
+    return min(max_workers + expected_finished, max_target)
+
+
 class ComputeManager:
     """
     This object maintains a computational queue and watches for finished tasks for different
@@ -117,8 +151,11 @@ class ComputeManager:
 
         self.scheduler = InterruptableScheduler()
 
-        # key = number of retries. value = dict of (task_id, compressed result)
-        self._deferred_tasks: Dict[int, Dict[int, AppTaskResult]] = defaultdict(dict)
+        # Results that could not be returned to the server, to be retried later
+        self._result_spool = ResultSpool(config.result_spool_file)
+
+        # Maximum time between attempts at returning results in the spool (in seconds)
+        self._spool_max_delay = 600.0
 
         # key = executor label, value = (key = task_id, value = parsl future)
         self._task_futures: Dict[str, Dict[int, ParslFuture]] = {exl: {} for exl in config.executors.keys()}
@@ -126,6 +163,18 @@ class ComputeManager:
         # Mapping of task_id to record_id
         self._record_id_map: Dict[int, int] = {}
 
+        # Exponentially-weighted average walltime of tasks run on each executor. Used for determining
+        # how many tasks to claim
+        self._average_walltime: Dict[str, Optional[float]] = {exl: None for exl in config.executors.keys()}
+        self._walltime_smoothing = 0.2
+
+        # Whether the last claim for an executor returned fewer tasks than requested (ie, the server
+        # has no more tasks for us). If so, we don't try to claim again until the next regular update
+        self._claim_exhausted: Dict[str, bool] = {exl: False for exl in config.executors.keys()}
+
+        # The next scheduled update (so that it can be moved earlier if we run low on tasks)
+        self._update_event: Optional[sched.Event] = None
+
         self.all_queue_tags = []
         for ex_config in config.executors.values():
             self.all_queue_tags.extend(ex_config.queue_tags)
@@ -238,7 +287,7 @@ class ComputeManager:
 
     @property
     def n_deferred_tasks(self) -> int:
-        return sum(len(x) for x in self._deferred_tasks.values())
+        return self._result_spool.count(self.name)
 
     def start(self, manual_updates: bool = False):
         """
@@ -259,11 +308,31 @@ class ComputeManager:
             ex = build_executor(ex_label, ex_config)
             self.dflow_kernel.add_executors([ex])
 
+        # Return any results left over from a previous run
+        try:
+            self._return_orphaned_results()
+        except Exception as ex:
+            self.logger.warning(f"Error returning left over results: {str(ex).strip()}")
+
         def scheduler_update():
             if not manual_updates:
                 self.update(new_tasks=True)
             if not self._is_stopping:
-                self.scheduler.enter(self.manager_config.update_frequency, 1, scheduler_update)
+                self._update_event = self.scheduler.enter(self.manager_config.update_frequency, 1, scheduler_update)
+
+        def scheduler_check_queue():
+            # If we are running low on tasks, move the next update to right now
+            if self._update_event is not None and self._below_low_water():
+                self.logger.info("Number of unfinished tasks is below the low-water mark. Updating early")
+                try:
+                    self.scheduler.cancel(self._update_event)
+                except ValueError:
+                    # Not in the queue anymore
+                    pass
+                self._update_event = self.scheduler.enter(0, 1, scheduler_update)
+
+            if not self._is_stopping:
+                self.scheduler.enter(self.manager_config.queue_check_frequency, 3, scheduler_check_queue)
 
         def scheduler_heartbeat():
             if not manual_updates:
@@ -274,9 +343,12 @@ class ComputeManager:
         self.logger.info("Compute Manager successfully started.")
 
         self._failed_heartbeats = 0
-        self.scheduler.enter(0, 1, scheduler_update)
+        self._update_event = self.scheduler.enter(0, 1, scheduler_update)
         self.scheduler.enter(0, 2, scheduler_heartbeat)
 
+        if not manual_updates:
+            self.scheduler.enter(self.manager_config.queue_check_frequency, 3, scheduler_check_queue)
+
         # Blocks until the ComputeManager.stop() method is called
         self.scheduler.run(blocking=True)
 
@@ -347,6 +419,33 @@ class ComputeManager:
                 self.logger.warning("Too many failed heartbeats, shutting down.")
                 self.stop()
 
+    def _below_low_water(self) -> bool:
+        """
+        Determines if any executor has fewer unfinished tasks than the low-water mark
+
+        Executors for which the server did not have enough tasks at the last claim are not considered.
+        """
+
+        active_tasks = self.n_active_tasks
+
+        for executor_label in self.manager_config.executors.keys():
+            if self._claim_exhausted[executor_label]:
+                continue
+
+            executor = self.dflow_kernel.executors[executor_label]
+            low_water = self.manager_config.claim_low_water * self._get_max_workers(executor)
+            if active_tasks[executor_label] < low_water:
+                return True
+
+        return False
+
+    def _update_average_walltime(self, executor_label: str, walltime: float) -> None:
+        average = self._average_walltime[executor_label]
+        if average is None:
+            self._average_walltime[executor_label] = walltime
+        else:
+            self._average_walltime[executor_label] = average + self._walltime_smoothing * (walltime - average)
+
     def _acquire_complete_tasks(self) -> Dict[str, Dict[int, AppTaskResult]]:
 
         # First key is name of executor
@@ -450,37 +549,117 @@ class ComputeManager:
 
         return return_meta
 
+    def _return_finished_and_claim(
+        self, executor_label: str, results: Dict[int, AppTaskResult], limit: int
+    ) -> Tuple[TaskReturnMetadata, List[RecordTask]]:
+        # Handling of exceptions is expected to be done in the calling function
+        to_send = {k: v.result_compressed for k, v in results.items()}
+        executor_programs = self.executor_programs[executor_label]
+        queue_tags = self.manager_config.executors[executor_label].queue_tags
+
+        return_meta, new_task_info = self.client.return_and_claim(to_send, executor_programs, queue_tags, limit)
+
+        if return_meta.success:
+            self.logger.info(f"Successfully returned {return_meta.n_accepted} tasks to the fractal server")
+        else:
+            self.logger.warning(f"Error in returning tasks: {str(return_meta.error_string)}")
+
+        return return_meta, new_task_info
+
     def _update_deferred_tasks(self) -> Dict[int, TaskReturnMetadata]:
         """
-        Attempt to post the previous payload failures
+        Attempt to return results stored in the spool (from previous failures)
+
+        Results are sent in batches (of the maximum size allowed by the server). If sending a batch fails,
+        the results in that batch are postponed (with increasing delay) and no more batches are sent.
         """
-        new_deferred_tasks = defaultdict(dict)
 
         # key = number of attempts. value = metadata
         ret: Dict[int, TaskReturnMetadata] = {}
 
-        for attempts, results in self._deferred_tasks.items():
+        batch_size = self.client.server_info["api_limits"]["manager_tasks_return"]
+
+        while True:
+            spooled = self._result_spool.get(self.name, batch_size)
+            if not spooled:
+                break
+
+            results = {task_id: result for task_id, _, _, result in spooled}
+            attempts_map = {task_id: attempts for task_id, _, attempts, _ in spooled}
+
+            for task_id, record_id, _, _ in spooled:
+                self._record_id_map[task_id] = record_id
+
             try:
                 return_meta = self._return_finished(results)
-                ret[attempts] = return_meta
+            except (Timeout, ConnectionError):
+                self._result_spool.postpone(results.keys(), self.manager_config.update_frequency, self._spool_max_delay)
+                self.logger.warning(f"Could not return {len(results)} deferred results, will retry later.")
+                break
 
-                if return_meta.success:
-                    self.logger.info(f"Successfully pushed jobs from {attempts+1} updates ago")
-                else:
-                    self.logger.warning(
-                        f"Did not successfully push jobs from {attempts+1} updates ago. Error: {return_meta.error_string}"
-                    )
+            # Either accepted or rejected. Either way, we are done with them
+            self._result_spool.remove(results.keys())
 
-            except (Timeout, ConnectionError):
-                # Tried and failed
-                attempts += 1
+            if not return_meta.success:
+                self.logger.warning(f"Did not successfully return deferred results. Error: {return_meta.error_string}")
 
-                new_deferred_tasks[attempts] = results
-                self.logger.warning(f"Could not post jobs from {attempts-1} updates ago, will retry on next update.")
+            for task_id in return_meta.accepted_ids:
+                ret.setdefault(attempts_map[task_id], TaskReturnMetadata()).accepted_ids.append(task_id)
+            for task_id, reason in return_meta.rejected_info:
+                ret.setdefault(attempts_map[task_id], TaskReturnMetadata()).rejected_info.append((task_id, reason))
 
-        self._deferred_tasks = new_deferred_tasks
         return ret
 
+    def _return_orphaned_results(self) -> None:
+        """
+        Attempt to return results in the spool that were run by a previous instance of this manager
+
+        These will only be accepted if that instance has not yet been marked inactive by the server.
+        Results that the server does not accept are discarded.
+        """
+
+        batch_size = self.client.server_info["api_limits"]["manager_tasks_return"]
+
+        for name_data in self._result_spool.managers():
+            manager_name = name_data.fullname
+            if manager_name == self.name:
+                continue
+
+            n_results = self._result_spool.count(manager_name)
+            self.logger.info(f"Returning {n_results} results left over from previous manager {manager_name}")
+
+            old_client = ManagerClient(
+                name_data=name_data,
+                address=self.manager_config.server.fractal_uri,
+                username=self.manager_config.server.username,
+                password=self.manager_config.server.password,
+                verify=self.manager_config.server.verify,
+            )
+
+            n_accepted = 0
+
+            while True:
+                spooled = self._result_spool.get(manager_name, batch_size, ready_only=False)
+                if not spooled:
+                    break
+
+                results = {task_id: result.result_compressed for task_id, _, _, result in spooled}
+
+                try:
+                    return_meta = old_client.return_finished(results)
+                    n_accepted += return_meta.n_accepted
+                except (Timeout, ConnectionError) as ex:
+                    # Leave them for next time
+                    self.logger.warning(f"Could not return left over results: {str(ex).strip()}")
+                    return
+                except PortalRequestError as ex:
+                    # Server will not accept any of these (ie, the previous manager is not active anymore)
+                    self.logger.warning(f"Server did not accept left over results: {str(ex).strip()}")
+
+                self._result_spool.remove(results.keys())
+
+            self.logger.info(f"Server accepted {n_accepted} of {n_results} left over results from {manager_name}")
+
     def update(self, new_tasks) -> None:
         """Examines the queue for completed tasks and adds successful completions to the database
         while unsuccessful are logged for future inspection.
@@ -516,6 +695,13 @@ class ComputeManager:
             )
             self.statistics.total_rejected_tasks += return_meta.n_rejected
 
+        # Tasks claimed in the same request as returning results. Key is executor label,
+        # value is (open slots, claimed tasks)
+        claimed: Dict[str, Tuple[int, List[RecordTask]]] = {}
+
+        # What do we have for each executor? (finished tasks were removed when acquiring results)
+        active_tasks = self.n_active_tasks
+
         # Return results to the server (per executor)
         for executor_label, executor_results in results.items():
             # Any post-processing tasks
@@ -527,21 +713,6 @@ class ComputeManager:
             if n_result:
                 n_success = 0
 
-                try:
-                    return_meta = self._return_finished(executor_results)
-
-                    status_rows.extend([(task_id, "sent", "") for task_id in return_meta.accepted_ids])
-
-                    status_rows.extend([(task_id, "rejected", reason) for task_id, reason in return_meta.rejected_info])
-                    self.statistics.total_rejected_tasks += return_meta.n_rejected
-
-                except (ConnectionError, Timeout):
-                    self.logger.warning("Returning complete tasks failed. Attempting again on next update.")
-                    self._deferred_tasks[0].update(executor_results)
-
-                    status_rows.extend([(task_id, "deferred", "") for task_id in executor_results.keys()])
-                    server_up = False
-
                 for task_id, app_result in executor_results.items():
                     walltime_seconds = app_result.walltime
 
@@ -551,6 +722,10 @@ class ComputeManager:
                         self.logger.debug(f"Task {task_id} (record {self._record_id_map[task_id]}) failed:")
                         self.logger.debug(app_result.result["error"]["error_message"])
 
+                    # Tasks where the worker was lost, etc, have zero walltime
+                    if walltime_seconds > 0.0:
+                        self._update_average_walltime(executor_label, walltime_seconds)
+
                     cores_per_worker = self.manager_config.executors[executor_label].cores_per_worker
                     self.statistics.total_cpu_hours += walltime_seconds * cores_per_worker / 3600
 
@@ -560,6 +735,32 @@ class ComputeManager:
                     f"Executor {executor_label}: Processed {n_result} tasks: {n_success} success / {n_fail} failed"
                 )
 
+                # If we want new tasks, claim them in the same request that returns the results
+                open_slots = 0
+                if new_tasks and server_up:
+                    open_slots = self._get_open_slots(executor_label, active_tasks[executor_label])
+
+                try:
+                    if open_slots > 0:
+                        return_meta, new_task_info = self._return_finished_and_claim(
+                            executor_label, executor_results, open_slots
+                        )
+                        claimed[executor_label] = (open_slots, new_task_info)
+                    else:
+                        return_meta = self._return_finished(executor_results)
+
+                    status_rows.extend([(task_id, "sent", "") for task_id in return_meta.accepted_ids])
+
+                    status_rows.extend([(task_id, "rejected", reason) for task_id, reason in return_meta.rejected_info])
+                    self.statistics.total_rejected_tasks += return_meta.n_rejected
+
+                except (ConnectionError, Timeout):
+                    self.logger.warning("Returning complete tasks failed. Attempting again on next update.")
+                    self._result_spool.add(self.name_data, executor_results, self._record_id_map)
+
+                    status_rows.extend([(task_id, "deferred", "") for task_id in executor_results.keys()])
+                    server_up = False
+
                 # Update the statistics
                 self.statistics.total_successful_tasks += n_success
                 self.statistics.total_failed_tasks += n_fail
@@ -610,20 +811,23 @@ class ComputeManager:
         self.logger.info(worker_stats_str)
         self.statistics.last_update_time = time.time()
 
+        if not server_up:
+            # Don't try again until the next regular update
+            self._claim_exhausted = {exl: True for exl in self._claim_exhausted}
+
+        # Submit the tasks that were claimed when returning results
+        for executor_label, (open_slots, new_task_info) in claimed.items():
+            self._submit_claimed_tasks(executor_label, new_task_info, open_slots)
+
         if new_tasks and server_up:
             # What do we have for each executor?
             active_tasks = self.n_active_tasks
 
             for executor_label, executor_config in self.manager_config.executors.items():
-                executor = self.dflow_kernel.executors[executor_label]
-
-                # How many slots do we have?
-                # TODO - intelligently figure out the number tasks to claim over the number of slots
-                open_slots = (3 * self._get_max_workers(executor)) - active_tasks[executor_label]
+                if executor_label in claimed:
+                    continue
 
-                self.logger.info(
-                    f"Executor {executor_label} has {active_tasks[executor_label]} active tasks and {open_slots} open slots"
-                )
+                open_slots = self._get_open_slots(executor_label, active_tasks[executor_label])
 
                 if open_slots > 0:
                     try:
@@ -631,13 +835,37 @@ class ComputeManager:
                         new_task_info = self.client.claim(executor_programs, executor_config.queue_tags, open_slots)
                     except (Timeout, ConnectionError) as ex:
                         self.logger.warning(f"Acquisition of new tasks failed: {str(ex).strip()}")
+
+                        # Don't try again until the next regular update
+                        self._claim_exhausted = {exl: True for exl in self._claim_exhausted}
                         return
 
-                    self.logger.info("Acquired {} new tasks.".format(len(new_task_info)))
+                    self._submit_claimed_tasks(executor_label, new_task_info, open_slots)
+
+    def _get_open_slots(self, executor_label: str, n_active: int) -> int:
+        """
+        Determines how many tasks to claim for an executor
+        """
+
+        executor = self.dflow_kernel.executors[executor_label]
+
+        claim_target = calculate_claim_target(
+            self._get_max_workers(executor),
+            self.manager_config.update_frequency,
+            self._average_walltime[executor_label],
+        )
+        open_slots = claim_target - n_active
+
+        self.logger.info(f"Executor {executor_label} has {n_active} active tasks and {open_slots} open slots")
+        return open_slots
+
+    def _submit_claimed_tasks(self, executor_label: str, new_task_info: List[RecordTask], open_slots: int):
+        self.logger.info("Acquired {} new tasks.".format(len(new_task_info)))
+        self._claim_exhausted[executor_label] = len(new_task_info) < open_slots
 
-                    # Add new tasks to queue
-                    self.preprocess_new_tasks(new_task_info)
-                    self._submit_tasks(executor_label, new_task_info)
+        # Add new tasks to queue
+        self.preprocess_new_tasks(new_task_info)
+        self._submit_tasks(executor_label, new_task_info)
 
     def preprocess_new_tasks(self, new_tasks: List[RecordTask]):
         """
@@ -66,6 +66,29 @@ class ExecutorConfig(BaseModel):
 
     environments: PackageEnvironmentSettings = PackageEnvironmentSettings()
 
+    compression_level: Optional[int] = Field(
+        None,
+        description="zstd compression level to use for outputs and native files of results. Lower levels are faster, "
+        "but compress less. If not specified, a level is chosen based on the size of the data",
+        ge=1,
+        le=22,
+    )
+
+    persistent_runners: bool = Field(
+        False,
+        description="Run qcengine tasks in long-lived processes (one per worker and environment) rather than starting "
+        "a new python process for each task",
+    )
+    persistent_runner_max_tasks: int = Field(
+        100, description="Restart a persistent runner after it has run this many tasks", gt=0
+    )
+    persistent_runner_max_memory: Optional[float] = Field(
+        None,
+        description="Restart a persistent runner after its peak memory usage exceeds this amount (in GiB). "
+        "This does not include memory used by programs that qcengine runs as separate processes",
+        gt=0,
+    )
+
     class Config(BaseModel.Config):
         case_insensitive = True
         extra = "forbid"
@@ -204,7 +227,31 @@ class FractalComputeConfig(BaseModel):
         gt=0,
     )
 
+    claim_low_water: float = Field(
+        1.0,
+        description="If the number of unfinished tasks on an executor falls below this fraction of its maximum number "
+        "of workers, the manager will update (and claim new tasks) before the next scheduled update.",
+        ge=0,
+    )
+    queue_check_frequency: float = Field(
+        5,
+        description="Time between checks of the number of unfinished tasks against claim_low_water. These checks do "
+        "not contact the server. Units of seconds",
+        gt=0,
+    )
+
     parsl_run_dir: str = "parsl_run_dir"
+    result_spool_file: Optional[str] = Field(
+        "result_spool.sqlite",
+        description="File used to store finished results that could not be returned to the server. Results in this "
+        "file are returned when the manager is restarted (if the server still accepts them). If None, these results "
+        "are only kept in memory.",
+    )
+    program_cache_file: Optional[str] = Field(
+        "program_cache.json",
+        description="File used to cache the programs found in each environment, so that unchanged environments do "
+        "not need to be queried again when the manager is restarted. If None, the cache is not used.",
+    )
 
     server: FractalServerSettings = Field(...)
     environments: PackageEnvironmentSettings = PackageEnvironmentSettings()
@@ -222,6 +269,14 @@ class FractalComputeConfig(BaseModel):
     def _check_run_dir(cls, v, values):
         return _make_abs_path(v, values["base_folder"], "parsl_run_dir")
 
+    @validator("result_spool_file", always=True)
+    def _check_result_spool_file(cls, v, values):
+        return _make_abs_path(v, values["base_folder"], None)
+
+    @validator("program_cache_file", always=True)
+    def _check_program_cache_file(cls, v, values):
+        return _make_abs_path(v, values["base_folder"], None)
+
 
 def read_configuration(file_paths: List[str], extra_config: Optional[Dict[str, Any]] = None) -> FractalComputeConfig:
     logger = logging.getLogger(__name__)
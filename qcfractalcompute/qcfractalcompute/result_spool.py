@@ -0,0 +1,189 @@
+"""
+Disk-backed storage of finished results that could not be returned to the server
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Iterable
+
+from qcportal.managers import ManagerName
+from .apps.models import AppTaskResult
+
+
+class ResultSpool:
+    """
+    Stores finished results (in an SQLite database) until they can be returned to the server
+
+    Results are stored along with the name of the manager that ran them, so that results left over
+    from a previous run of a manager can be returned after a restart.
+    """
+
+    def __init__(self, file_path: Optional[str]):
+        """
+        Parameters
+        ----------
+        file_path
+            Path to the SQLite database file. If None, results are only stored in memory.
+        """
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file_path or ":memory:", check_same_thread=False)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS result_spool (
+                    task_id INTEGER PRIMARY KEY,
+                    record_id INTEGER NOT NULL,
+                    manager_name TEXT NOT NULL,
+                    manager_name_data TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    next_attempt REAL NOT NULL,
+                    success INTEGER NOT NULL,
+                    walltime REAL NOT NULL,
+                    result_compressed BLOB NOT NULL
+                )
+                """
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def add(self, name_data: ManagerName, results: Dict[int, AppTaskResult], record_ids: Dict[int, int]) -> None:
+        """
+        Adds results to the spool, to be retried as soon as possible
+
+        Parameters
+        ----------
+        name_data
+            Name of the manager that ran the tasks
+        results
+            Results to store, keyed by task id
+        record_ids
+            Mapping of task id to record id
+        """
+
+        now = time.time()
+        manager_name = name_data.fullname
+        name_data_json = name_data.json()
+
+        rows = [
+            (
+                task_id,
+                record_ids[task_id],
+                manager_name,
+                name_data_json,
+                1,
+                now,
+                r.success,
+                r.walltime,
+                r.result_compressed,
+            )
+            for task_id, r in results.items()
+        ]
+
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO result_spool VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def get(self, manager_name: str, limit: int, ready_only: bool = True) -> List[Tuple[int, int, int, AppTaskResult]]:
+        """
+        Obtains results from the spool, without removing them
+
+        Parameters
+        ----------
+        manager_name
+            Only get results run by this manager
+        limit
+            Maximum number of results to return
+        ready_only
+            Only return results whose next attempt time has passed
+
+        Returns
+        -------
+        :
+            List of (task_id, record_id, number of attempts so far, result)
+        """
+
+        stmt = "SELECT task_id, record_id, attempts, success, walltime, result_compressed FROM result_spool "
+        stmt += "WHERE manager_name = ? "
+        params = [manager_name]
+
+        if ready_only:
+            stmt += "AND next_attempt <= ? "
+            params.append(time.time())
+
+        stmt += "ORDER BY task_id LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(stmt, params).fetchall()
+
+        return [
+            (
+                task_id,
+                record_id,
+                attempts,
+                AppTaskResult(success=bool(success), walltime=walltime, result_compressed=result_compressed),
+            )
+            for task_id, record_id, attempts, success, walltime, result_compressed in rows
+        ]
+
+    def postpone(self, task_ids: Iterable[int], base_delay: float, max_delay: float) -> None:
+        """
+        Increments the attempt count of results, and delays their next attempt
+
+        The delay doubles with each failed attempt (starting with `base_delay`), up to `max_delay`
+
+        Parameters
+        ----------
+        task_ids
+            Task ids of the results to postpone
+        base_delay
+            Delay after the second failed attempt (in seconds)
+        max_delay
+            Maximum delay (in seconds)
+        """
+
+        now = time.time()
+
+        with self._lock, self._conn:
+            for task_id in task_ids:
+                row = self._conn.execute("SELECT attempts FROM result_spool WHERE task_id = ?", (task_id,)).fetchone()
+                if row is None:
+                    continue
+
+                attempts = row[0] + 1
+                delay = min(base_delay * 2 ** (attempts - 2), max_delay)
+                self._conn.execute(
+                    "UPDATE result_spool SET attempts = ?, next_attempt = ? WHERE task_id = ?",
+                    (attempts, now + delay, task_id),
+                )
+
+    def remove(self, task_ids: Iterable[int]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM result_spool WHERE task_id = ?", [(x,) for x in task_ids])
+
+    def count(self, manager_name: Optional[str] = None) -> int:
+        with self._lock:
+            if manager_name is None:
+                return self._conn.execute("SELECT COUNT(*) FROM result_spool").fetchone()[0]
+            else:
+                return self._conn.execute(
+                    "SELECT COUNT(*) FROM result_spool WHERE manager_name = ?", (manager_name,)
+                ).fetchone()[0]
+
+    def task_ids(self, manager_name: str) -> List[int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT task_id FROM result_spool WHERE manager_name = ? ORDER BY task_id", (manager_name,)
+            ).fetchall()
+        return [x[0] for x in rows]
+
+    def managers(self) -> List[ManagerName]:
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT manager_name_data FROM result_spool").fetchall()
+        return [ManagerName.parse_raw(x[0]) for x in rows]
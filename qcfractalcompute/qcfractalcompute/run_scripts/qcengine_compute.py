@@ -1,5 +1,8 @@
 import json
+import os
+import resource
 import sys
+import traceback
 
 import qcengine
 
@@ -35,13 +38,8 @@ _qcvar_transitions = {
     "valiron-mayer function couterpoise interaction energy": "vmfc-corrected interaction energy",  # note misspelling
 }
 
-if __name__ == "__main__":
-
-    function_kwargs_file = sys.argv[1]
-
-    with open(function_kwargs_file, "r") as f:
-        function_kwargs = json.load(f)
 
+def compute(function_kwargs):
     if "procedure" in function_kwargs:
         ret = qcengine.compute_procedure(**function_kwargs)
     else:
@@ -61,4 +59,49 @@ if __name__ == "__main__":
             # Replace any names with underscores (and other modifications)
             ret.extras["qcvars"] = {_qcvar_transitions.get(k, k): v for k, v in ret.extras["qcvars"].items()}
 
-    print(json.dumps(ret.dict(encoding="json")))
+    return ret.dict(encoding="json")
+
+
+def run_persistent():
+    """
+    Runs tasks read from stdin (one json-encoded line per task) until stdin is closed
+
+    For each task, a single line is written to the original stdout containing the result and the
+    peak memory usage of this process (in bytes).
+    """
+
+    # Anything else written to stdout (by qcengine, or by programs run by qcengine) is redirected to
+    # stderr, so that it does not get mixed with the results
+    result_out = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        try:
+            ret = compute(json.loads(line))
+        except Exception:
+            msg = "Error running task in persistent runner:\n" + traceback.format_exc()
+            ret = {"success": False, "error": {"error_type": "RuntimeError", "error_message": msg}}
+
+        # ru_maxrss is in kilobytes on linux, bytes on macos
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            max_rss *= 1024
+
+        result_out.write(json.dumps({"result": ret, "max_rss": max_rss}) + "\n")
+        result_out.flush()
+
+
+if __name__ == "__main__":
+
+    if sys.argv[1] == "--persistent":
+        run_persistent()
+    else:
+        function_kwargs_file = sys.argv[1]
+
+        with open(function_kwargs_file, "r") as f:
+            function_kwargs = json.load(f)
+
+        print(json.dumps(compute(function_kwargs)))
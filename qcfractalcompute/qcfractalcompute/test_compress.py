@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING
+
+import pytest
+
+from qcfractal.components.record_db_models import BaseRecordORM
+from qcfractal.components.singlepoint.testing_helpers import submit_test_data
+from qcfractalcompute.compress import compress_result
+from qcportal.compression import CompressionEnum, decompress
+from qcportal.record_models import RecordStatusEnum
+
+if TYPE_CHECKING:
+    from qcfractal.db_socket import SQLAlchemySocket
+    from qcportal.managers import ManagerName
+    from sqlalchemy.orm.session import Session
+
+_text_data = "Some text output that compresses well\n" * 5000
+
+
+def _test_result():
+    return {
+        "schema_name": "qcschema_output",
+        "stdout": _text_data,
+        "extras": {},
+        "native_files": {
+            # Already compressed (random data is not compressible)
+            "random.bin": os.urandom(128 * 1024),
+            # Too small to check, so always compressed
+            "small_random.bin": os.urandom(1024),
+            "output.txt": _text_data,
+        },
+    }
+
+
+@pytest.mark.parametrize("compression_level", [None, 1, 7])
+def test_compress_result(compression_level):
+    result = _test_result()
+    native_files = result["native_files"].copy()
+
+    result_compressed = compress_result(result, compression_level=compression_level)
+    result_dict = decompress(result_compressed, CompressionEnum.zstd)
+
+    assert result_dict["native_files"] == {}
+    assert result_dict["stdout"] is None
+
+    nf = result_dict["extras"]["_qcfractal_compressed_native_files"]
+    assert nf["random.bin"]["compression_type"] == CompressionEnum.none
+    assert nf["random.bin"]["compression_level"] == 0
+    assert len(nf["random.bin"]["data"]) < len(native_files["random.bin"]) + 64
+
+    # Default is chosen based on size
+    expected_level = 16 if compression_level is None else compression_level
+
+    for name in ["small_random.bin", "output.txt"]:
+        assert nf[name]["compression_type"] == CompressionEnum.zstd
+        assert nf[name]["compression_level"] == expected_level
+
+    assert len(nf["output.txt"]["data"]) < len(_text_data) // 10
+
+    stdout = result_dict["extras"]["_qcfractal_compressed_outputs"]["stdout"]
+    assert stdout["compression_type"] == CompressionEnum.zstd
+    assert stdout["compression_level"] == expected_level
+
+    for name, data in native_files.items():
+        assert decompress(nf[name]["data"], nf[name]["compression_type"]) == data
+
+    assert decompress(stdout["data"], stdout["compression_type"]) == _text_data
+
+
+def test_compress_result_server(
+    storage_socket: SQLAlchemySocket, session: Session, activated_manager_name: ManagerName
+):
+    record_id, result = submit_test_data(storage_socket, "sp_psi4_benzene_energy_1")
+
+    random_data = os.urandom(128 * 1024)
+    result_dict = result.dict()
+    result_dict["native_files"] = {"random.bin": random_data, "output.txt": _text_data}
+
+    manager_programs = storage_socket.managers.get([activated_manager_name.fullname])[0]["programs"]
+    tasks = storage_socket.tasks.claim_tasks(activated_manager_name.fullname, manager_programs, ["*"])
+    assert len(tasks) == 1
+
+    result_compressed = compress_result(result_dict, compression_level=5)
+    rmeta = storage_socket.tasks.update_finished(activated_manager_name.fullname, {tasks[0]["id"]: result_compressed})
+    assert rmeta.accepted_ids == [tasks[0]["id"]]
+
+    record = session.get(BaseRecordORM, record_id)
+    assert record.status == RecordStatusEnum.complete
+
+    nf = record.native_files
+    assert nf["random.bin"].compression_type == CompressionEnum.none
+    assert nf["random.bin"].get_file() == random_data
+    assert nf["output.txt"].compression_type == CompressionEnum.zstd
+    assert nf["output.txt"].compression_level == 5
+    assert nf["output.txt"].get_file() == _text_data
@@ -7,7 +7,7 @@ from typing import TYPE_CHECKING
 
 import pytest
 
-from qcfractalcompute.compute_manager import ComputeManager
+from qcfractalcompute.compute_manager import ComputeManager, calculate_claim_target
 from qcfractalcompute.config import FractalComputeConfig, FractalServerSettings, LocalExecutorConfig
 from qcfractalcompute.testing_helpers import QCATestingComputeThread, populate_db
 from qcportal.managers import ManagerStatusEnum, ManagerQueryFilters
@@ -151,7 +151,7 @@ def test_manager_deferred_return(snowflake: QCATestingSnowflake):
     time.sleep(3)  # Mock testing adapter waits for two seconds before returning result
     compute.update(new_tasks=True)
     assert compute.n_deferred_tasks > 0
-    deferred_task_ids = list(compute._deferred_tasks[0].keys())
+    deferred_task_ids = compute._result_spool.task_ids(compute.name)
     deferred_record_ids = [compute._record_id_map[x] for x in deferred_task_ids]
 
     # Now server comes back
@@ -170,6 +170,113 @@ def test_manager_deferred_return(snowflake: QCATestingSnowflake):
     assert all(x["manager_name"] == compute.name for x in r)
 
 
+def test_manager_deferred_return_batches(snowflake: QCATestingSnowflake):
+    storage_socket = snowflake.get_storage_socket()
+    all_id, result_data = populate_db(storage_socket)
+
+    compute_thread = QCATestingComputeThread(snowflake._qcf_config, result_data)
+    compute_thread.start(manual_updates=True)
+    compute = compute_thread._compute
+
+    time.sleep(1)  # wait for manager to register
+    compute.update(new_tasks=True)
+    assert compute.n_total_active_tasks > 1
+
+    # Server goes down, and the manager completes all its tasks
+    snowflake.stop_api()
+    time.sleep(2 * compute.n_total_active_tasks + 1)
+    compute.update(new_tasks=False)
+
+    n_deferred = compute.n_deferred_tasks
+    assert n_deferred > 1
+    deferred_task_ids = compute._result_spool.task_ids(compute.name)
+
+    # Results are returned in batches of at most the server limit
+    compute.client.server_info["api_limits"]["manager_tasks_return"] = 1
+
+    # First batch could not be returned, so it is postponed and not tried again right away.
+    # No other batches are attempted
+    compute._update_deferred_tasks()
+    assert [x[0] for x in compute._result_spool.get(compute.name, 100)] == deferred_task_ids[1:]
+
+    spooled = compute._result_spool.get(compute.name, 100, ready_only=False)
+    assert [(x[0], x[2]) for x in spooled] == [(deferred_task_ids[0], 2)] + [(x, 1) for x in deferred_task_ids[1:]]
+
+    snowflake.start_api()
+
+    batch_sizes = []
+    orig_return_finished = compute._return_finished
+
+    def _return_finished(results):
+        batch_sizes.append(len(results))
+        return orig_return_finished(results)
+
+    compute._return_finished = _return_finished
+
+    # Postponed result is not sent yet
+    ret = compute._update_deferred_tasks()
+    assert batch_sizes == [1] * (n_deferred - 1)
+    assert compute._result_spool.task_ids(compute.name) == deferred_task_ids[:1]
+    assert sorted(ret[1].accepted_ids) == deferred_task_ids[1:]
+
+    # Make it ready again
+    compute._result_spool._conn.execute("UPDATE result_spool SET next_attempt = 0")
+
+    ret = compute._update_deferred_tasks()
+    assert compute.n_deferred_tasks == 0
+    assert ret[2].accepted_ids == deferred_task_ids[:1]
+
+
+def test_manager_restart_spool(snowflake: QCATestingSnowflake, tmp_path):
+    storage_socket = snowflake.get_storage_socket()
+    all_id, result_data = populate_db(storage_socket)
+    spool_file = str(tmp_path / "result_spool.sqlite")
+
+    compute_thread = QCATestingComputeThread(snowflake._qcf_config, result_data, spool_file)
+    compute_thread.start(manual_updates=True)
+    compute = compute_thread._compute
+
+    time.sleep(1)  # wait for manager to register
+    compute.update(new_tasks=True)
+    assert compute.n_total_active_tasks > 0
+
+    # Server goes down, and the manager completes some tasks
+    snowflake.stop_api()
+    time.sleep(3)
+    compute.update(new_tasks=False)
+
+    old_name = compute.name
+    deferred_task_ids = compute._result_spool.task_ids(old_name)
+    assert deferred_task_ids
+    deferred_record_ids = [compute._record_id_map[x] for x in deferred_task_ids]
+
+    # Manager stops while the server is down, so it is not deactivated
+    compute_thread.stop()
+    assert storage_socket.managers.get([old_name])[0]["status"] == ManagerStatusEnum.active
+
+    # Server comes back, and a new manager is started using the same spool file
+    snowflake.start_api()
+
+    compute_thread_2 = QCATestingComputeThread(snowflake._qcf_config, result_data, spool_file)
+    compute_thread_2.start(manual_updates=True)
+    compute_2 = compute_thread_2._compute
+    assert compute_2.name != old_name
+
+    for i in range(30):
+        time.sleep(1)
+        if compute_2._result_spool.count() == 0:
+            break
+    else:
+        raise RuntimeError("Left over results were not returned in 30 seconds")
+
+    # Results from the old manager were accepted on its behalf
+    r = storage_socket.records.get(deferred_record_ids)
+    assert all(x["status"] == "complete" for x in r)
+    assert all(x["manager_name"] == old_name for x in r)
+
+    compute_thread_2.stop()
+
+
 def test_manager_missed_heartbeats_shutdown(snowflake: QCATestingSnowflake):
 
     compute_thread = QCATestingComputeThread(snowflake._qcf_config)
@@ -187,3 +294,18 @@ def test_manager_missed_heartbeats_shutdown(snowflake: QCATestingSnowflake):
 
     compute_thread._compute_thread.join(5)
     assert compute_thread.is_alive() is False
+
+
+@pytest.mark.parametrize(
+    "max_workers, update_frequency, average_walltime, expected",
+    [
+        (4, 30, None, 12),  # Nothing known yet
+        (4, 30, 3600.0, 5),  # Long tasks - only one task expected to finish before the next update
+        (4, 30, 60.0, 6),
+        (4, 30, 30.0, 8),
+        (4, 30, 1.0, 12),  # Short tasks - limited to 3x workers
+        (4, 30, 0.0, 12),
+    ],
+)
+def test_manager_claim_target(max_workers, update_frequency, average_walltime, expected):
+    assert calculate_claim_target(max_workers, update_frequency, average_walltime) == expected
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import os
+import sys
+
+import pytest
+
+from qcfractalcompute.apps import helpers
+from qcfractalcompute.apps.helpers import run_persistent
+from qcportal.compression import CompressionEnum, decompress
+
+_run_scripts_dir = os.path.join(os.path.dirname(__file__), "run_scripts")
+
+# Runs the actual persistent loop of qcengine_compute.py, but with a stand-in for the qcengine computation
+_stub_script = f"""
+import os
+import sys
+
+sys.path.insert(0, {_run_scripts_dir!r})
+import qcengine_compute
+
+_buffers = []
+
+
+def _compute(function_kwargs):
+    if function_kwargs.get("crash", False):
+        os._exit(3)
+    if function_kwargs.get("raise", False):
+        raise RuntimeError("task failed")
+
+    # Write to every page, so that it counts towards the memory usage
+    n_pages = function_kwargs.get("allocate", 0) // 4096
+    buffer = bytearray(n_pages * 4096)
+    buffer[::4096] = b"x" * n_pages
+    _buffers.append(buffer)
+
+    # Should not end up mixed in with the results
+    print("Some output on stdout")
+    os.system("echo Some output from a subprocess")
+
+    return {{"success": True, "pid": os.getpid(), "value": function_kwargs["value"]}}
+
+
+qcengine_compute.compute = _compute
+qcengine_compute.run_persistent()
+"""
+
+
+@pytest.fixture(scope="function")
+def runner_cmd(tmp_path):
+    script_path = tmp_path / "stub_runner.py"
+    script_path.write_text(_stub_script)
+
+    yield [sys.executable, str(script_path)]
+
+    # Stop any runners started by the test
+    for runner in getattr(helpers._persistent_runners, "runners", {}).values():
+        runner.close()
+    helpers._persistent_runners.runners = {}
+
+
+def _run(runner_cmd, function_kwargs, max_tasks=100, max_memory=None, runner_key="test_runner"):
+    r = run_persistent(runner_key, runner_cmd, None, {}, function_kwargs, max_tasks, max_memory)
+    return r.success, decompress(r.result_compressed, CompressionEnum.zstd)
+
+
+def test_persistent_runner_tasks(runner_cmd):
+    results = [_run(runner_cmd, {"value": i}) for i in range(4)]
+
+    assert all(success for success, _ in results)
+    assert [x["value"] for _, x in results] == [0, 1, 2, 3]
+
+    # All in the same process
+    assert len({x["pid"] for _, x in results}) == 1
+    assert helpers._persistent_runners.runners["test_runner"].n_tasks == 4
+
+    # Different keys use different runners
+    _, ret = _run(runner_cmd, {"value": 4}, runner_key="other_runner")
+    assert ret["pid"] != results[0][1]["pid"]
+
+
+def test_persistent_runner_recycle_tasks(runner_cmd):
+    pids = [_run(runner_cmd, {"value": i}, max_tasks=2)[1]["pid"] for i in range(5)]
+
+    assert pids[0] == pids[1]
+    assert pids[2] == pids[3]
+    assert len(set(pids)) == 3
+
+    # Runner was recycled after the 4th task, and a new one was started for the 5th
+    assert helpers._persistent_runners.runners["test_runner"].n_tasks == 1
+
+
+def test_persistent_runner_recycle_memory(runner_cmd):
+    _, ret = _run(runner_cmd, {"value": 0})
+    pid_1 = ret["pid"]
+
+    # Allow for another 64MiB over the current usage
+    max_rss = helpers._persistent_runners.runners["test_runner"].max_rss
+    max_memory = (max_rss + 64 * 1024**2) / 1024**3
+
+    _, ret = _run(runner_cmd, {"value": 1}, max_memory=max_memory)
+    assert ret["pid"] == pid_1
+
+    # Goes over the limit. The task completes, but the runner is then recycled
+    # (max_rss is the peak usage, which may be well above the current usage)
+    allocate = max_rss + 128 * 1024**2
+    success, ret = _run(runner_cmd, {"value": 2, "allocate": allocate}, max_memory=max_memory)
+    assert success
+    assert ret["pid"] == pid_1
+    assert "test_runner" not in helpers._persistent_runners.runners
+
+    _, ret = _run(runner_cmd, {"value": 3}, max_memory=max_memory)
+    assert ret["pid"] != pid_1
+
+
+def test_persistent_runner_task_error(runner_cmd):
+    _, ret = _run(runner_cmd, {"value": 0})
+    pid_1 = ret["pid"]
+
+    # Task raises an exception. The runner keeps going
+    success, ret = _run(runner_cmd, {"value": 1, "raise": True})
+    assert success is False
+    assert "task failed" in ret["error"]["error_message"]
+
+    _, ret = _run(runner_cmd, {"value": 2})
+    assert ret["pid"] == pid_1
+
+
+def test_persistent_runner_crash(runner_cmd):
+    _, ret = _run(runner_cmd, {"value": 0})
+    pid_1 = ret["pid"]
+
+    # The runner dies while running a task
+    success, ret = _run(runner_cmd, {"value": 1, "crash": True})
+    assert success is False
+    assert ret["error"]["error_type"] == "RuntimeError"
+    assert "exited unexpectedly with error code 3" in ret["error"]["error_message"]
+    assert "test_runner" not in helpers._persistent_runners.runners
+
+    # A new runner is started for the next task
+    success, ret = _run(runner_cmd, {"value": 2})
+    assert success
+    assert ret["value"] == 2
+    assert ret["pid"] != pid_1
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import json
+import os
+
+import pytest
+
+from qcfractalcompute.apps import app_manager
+from qcfractalcompute.apps.app_manager import discover_programs
+
+
+@pytest.fixture(scope="function")
+def query_stub(monkeypatch):
+    """
+    Replaces the querying of environments, and the environment stamps
+    """
+
+    queried = []
+    stamps = {}
+
+    def _query_programs(env):
+        queried.append(env)
+        return {"psi4": "v1.8", "env_name": env[1]}
+
+    monkeypatch.setattr(app_manager, "_query_programs", _query_programs)
+    monkeypatch.setattr(app_manager, "_environment_stamp", lambda env: stamps.get(env, None))
+
+    return queried, stamps
+
+
+def test_program_discovery_cache(tmp_path, query_stub):
+    queried, stamps = query_stub
+    cache_file = str(tmp_path / "program_cache.json")
+
+    envs = [("conda", "env_1"), ("conda", "env_2"), ("apptainer", "/path/to/image.sif")]
+    stamps.update({env: ["stamp", 1] for env in envs})
+
+    ret = discover_programs(envs, cache_file)
+    assert set(queried) == set(envs)
+    assert ret[("conda", "env_1")] == {"psi4": "v1.8", "env_name": "env_1"}
+    assert os.path.isfile(cache_file)
+
+    # Now all from the cache
+    queried.clear()
+    ret2 = discover_programs(envs, cache_file)
+    assert queried == []
+    assert ret2 == ret
+
+    # Stamp of one environment changes
+    stamps[("conda", "env_2")] = ["stamp", 2]
+    ret3 = discover_programs(envs, cache_file)
+    assert queried == [("conda", "env_2")]
+    assert ret3 == ret
+
+    # Environments without a stamp are always queried
+    queried.clear()
+    stamps[("conda", "env_1")] = None
+    discover_programs(envs, cache_file)
+    assert queried == [("conda", "env_1")]
+
+    # No cache file - everything is queried
+    queried.clear()
+    discover_programs(envs, None)
+    assert set(queried) == set(envs)
+
+
+@pytest.mark.parametrize("contents", ["this is not json {", "[1, 2, 3]", '{"conda:env_1": {"stamp": ["stamp", 1]}}'])
+def test_program_discovery_cache_corrupt(tmp_path, query_stub, contents: str):
+    queried, stamps = query_stub
+    cache_file = tmp_path / "program_cache.json"
+    cache_file.write_text(contents)
+
+    envs = [("conda", "env_1")]
+    stamps[envs[0]] = ["stamp", 1]
+
+    ret = discover_programs(envs, str(cache_file))
+    assert queried == envs
+    assert ret[envs[0]]["env_name"] == "env_1"
+
+    # Cache file is replaced with a good one
+    queried.clear()
+    assert "conda:env_1" in json.loads(cache_file.read_text())
+    discover_programs(envs, str(cache_file))
+    assert queried == []
+
+
+def test_program_discovery_conda_stamp(tmp_path, monkeypatch):
+    prefix = tmp_path / "myenv"
+    site_packages = prefix / "lib" / "python3.10" / "site-packages"
+    site_packages.mkdir(parents=True)
+    (prefix / "conda-meta").mkdir()
+    (prefix / "conda-meta" / "history").write_text("==> 2023-10-01 <==\n")
+
+    monkeypatch.setattr(app_manager, "_conda_env_prefixes", lambda: {"myenv": str(prefix)})
+
+    # Make sure any change results in a different modification time
+    os.utime(site_packages, (1000000, 1000000))
+
+    env = ("conda", "myenv")
+    stamp_1 = app_manager._environment_stamp(env)
+    assert stamp_1 is not None
+    assert stamp_1 == app_manager._environment_stamp(env)
+
+    # Installing with pip does not touch the conda history
+    (site_packages / "some_harness-1.0.dist-info").mkdir()
+    stamp_2 = app_manager._environment_stamp(env)
+    assert stamp_2 != stamp_1
+
+    # Installing with conda does
+    with open(prefix / "conda-meta" / "history", "a") as f:
+        f.write("+conda-forge/linux-64::psi4-1.8\n")
+    assert app_manager._environment_stamp(env) != stamp_2
+
+    # Unknown environment
+    assert app_manager._environment_stamp(("conda", "not_an_env")) is None
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+
+from qcfractalcompute.apps.models import AppTaskResult
+from qcfractalcompute.result_spool import ResultSpool
+from qcportal.managers import ManagerName
+
+_mname_1 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-5678")
+_mname_2 = ManagerName(cluster="test_cluster", hostname="a_host", uuid="1234-5678-1234-0000")
+
+
+def _make_results(task_ids):
+    results = {x: AppTaskResult(success=x % 2 == 0, walltime=float(x), result_compressed=bytes([x])) for x in task_ids}
+    record_ids = {x: x + 100 for x in task_ids}
+    return results, record_ids
+
+
+def _next_attempts(spool: ResultSpool):
+    rows = spool._conn.execute("SELECT task_id, attempts, next_attempt FROM result_spool ORDER BY task_id").fetchall()
+    return {task_id: (attempts, next_attempt) for task_id, attempts, next_attempt in rows}
+
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_result_spool_add_get_remove(tmp_path, in_memory: bool):
+    spool = ResultSpool(None if in_memory else str(tmp_path / "spool.sqlite"))
+
+    spool.add(_mname_1, *_make_results([1, 2, 3, 4, 5]))
+    spool.add(_mname_2, *_make_results([10, 11]))
+
+    assert spool.count() == 7
+    assert spool.count(_mname_1.fullname) == 5
+    assert spool.task_ids(_mname_1.fullname) == [1, 2, 3, 4, 5]
+    assert {x.fullname for x in spool.managers()} == {_mname_1.fullname, _mname_2.fullname}
+
+    # Limited, and in order of task id
+    spooled = spool.get(_mname_1.fullname, 3)
+    assert [x[0] for x in spooled] == [1, 2, 3]
+
+    task_id, record_id, attempts, result = spooled[1]
+    assert (task_id, record_id, attempts) == (2, 102, 1)
+    assert result == AppTaskResult(success=True, walltime=2.0, result_compressed=bytes([2]))
+
+    # Adding again replaces
+    spool.add(_mname_1, *_make_results([1]))
+    assert spool.count(_mname_1.fullname) == 5
+
+    spool.remove([1, 2, 10])
+    assert spool.task_ids(_mname_1.fullname) == [3, 4, 5]
+    assert spool.task_ids(_mname_2.fullname) == [11]
+
+    spool.remove([3, 4, 5, 11])
+    assert spool.count() == 0
+    assert spool.managers() == []
+
+
+def test_result_spool_postpone(tmp_path):
+    spool = ResultSpool(str(tmp_path / "spool.sqlite"))
+    spool.add(_mname_1, *_make_results([1, 2, 3]))
+
+    # All ready to be sent right away
+    assert [x[0] for x in spool.get(_mname_1.fullname, 10)] == [1, 2, 3]
+
+    base_delay = 10.0
+    max_delay = 50.0
+
+    # Delay doubles with each failed attempt, up to the maximum
+    for expected_attempts, expected_delay in [(2, 10.0), (3, 20.0), (4, 40.0), (5, 50.0), (6, 50.0)]:
+        time_0 = time.time()
+        spool.postpone([1, 2], base_delay, max_delay)
+        time_1 = time.time()
+
+        info = _next_attempts(spool)
+        for task_id in [1, 2]:
+            attempts, next_attempt = info[task_id]
+            assert attempts == expected_attempts
+            assert time_0 + expected_delay <= next_attempt <= time_1 + expected_delay
+
+    # Not touched
+    assert info[3][0] == 1
+
+    # Postponed results are not ready, unless requested
+    spooled = spool.get(_mname_1.fullname, 10)
+    assert [x[0] for x in spooled] == [3]
+
+    spooled = spool.get(_mname_1.fullname, 10, ready_only=False)
+    assert [(x[0], x[2]) for x in spooled] == [(1, 6), (2, 6), (3, 1)]
+
+    # Postponing something that isn't there is fine
+    spool.postpone([99], base_delay, max_delay)
+    assert spool.count() == 3
+
+
+def test_result_spool_persist(tmp_path):
+    spool_file = str(tmp_path / "spool.sqlite")
+
+    spool = ResultSpool(spool_file)
+    spool.add(_mname_1, *_make_results([1, 2]))
+    spool.postpone([2], 10.0, 10.0)
+    spool.close()
+
+    # Opening the same file again has the same results
+    spool = ResultSpool(spool_file)
+    assert [x.fullname for x in spool.managers()] == [_mname_1.fullname]
+    assert spool.managers()[0] == _mname_1
+
+    spooled = spool.get(_mname_1.fullname, 10, ready_only=False)
+    assert [(x[0], x[1], x[2]) for x in spooled] == [(1, 101, 1), (2, 102, 2)]
+    assert spooled[1][3].result_compressed == bytes([2])
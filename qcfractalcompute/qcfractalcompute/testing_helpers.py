@@ -22,7 +22,12 @@ from qcportal.record_models import PriorityEnum, RecordTask
 
 
 class MockTestingComputeManager(ComputeManager):
-    def __init__(self, qcf_config: FractalConfig, result_data: Dict[int, AllResultTypes]):
+    def __init__(
+        self,
+        qcf_config: FractalConfig,
+        result_data: Dict[int, AllResultTypes],
+        result_spool_file: Optional[str] = None,
+    ):
 
         self._qcf_config = qcf_config
 
@@ -39,11 +44,16 @@ class MockTestingComputeManager(ComputeManager):
         os.makedirs(parsl_run_dir, exist_ok=True)
         os.makedirs(compute_scratch_dir, exist_ok=True)
 
+        # Spool file can be given so that a new manager can pick up results left over by another
+        if result_spool_file is None:
+            result_spool_file = os.path.join(tmpdir.name, "result_spool.sqlite")
+
         self._compute_config = FractalComputeConfig(
             base_folder=tmpdir.name,
             parsl_run_dir=parsl_run_dir,
             cluster="mock_compute",
             update_frequency=1,
+            result_spool_file=result_spool_file,
             server=FractalServerSettings(
                 fractal_uri=uri,
                 verify=False,
@@ -95,9 +105,15 @@ class QCATestingComputeThread:
     Runs a compute manager in a separate process
     """
 
-    def __init__(self, qcf_config: FractalConfig, result_data: Dict[int, AllResultTypes] = None):
+    def __init__(
+        self,
+        qcf_config: FractalConfig,
+        result_data: Dict[int, AllResultTypes] = None,
+        result_spool_file: Optional[str] = None,
+    ):
         self._qcf_config = qcf_config
         self._result_data = result_data
+        self._result_spool_file = result_spool_file
 
         self._compute: Optional[MockTestingComputeManager] = None
         self._compute_thread = None
@@ -114,7 +130,7 @@ class QCATestingComputeThread:
     def start(self, manual_updates) -> None:
         if self._compute is not None:
             raise RuntimeError("Compute manager already started")
-        self._compute = MockTestingComputeManager(self._qcf_config, self._result_data)
+        self._compute = MockTestingComputeManager(self._qcf_config, self._result_data, self._result_spool_file)
         self._compute_thread = threading.Thread(
             target=self._compute.start, kwargs={"manual_updates": manual_updates}, daemon=True
         )
@@ -2,200 +2,479 @@
 
 """
 
-import dbm
-import json
-import lzma
+from __future__ import annotations
+
+import functools
 import os
+import re
+import sqlite3
+import threading
 import time
-from typing import List, Dict, Any
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Optional, Dict, Any, Iterable, List, Sequence, Tuple, Generator
 
-from qcelemental.models import Molecule
+import pydantic
+import zstandard
+from pydantic import BaseModel, Extra
 
+from qcportal.molecules import Molecule
+from qcportal.record_models import BaseRecord, record_from_dict
+from qcportal.serialization import serialize, deserialize
 
-# from .records_ddotson import record_factory
-# from .collections.collection_utils import collection_factory
 
+def compute_server_fingerprint(address: str, server_name: str) -> str:
+    """
+    Computes a fingerprint for a server, suitable for use as a directory name
 
-class PortalCache:
-    def __init__(self, client, cachedir, max_memcache_size):
-        self.client = client
-
-        # TODO: need server fingerprint of some kind to use for cachedir
-        # must resolve to same value for same server on each use, but to different value for different server
-        self.server_fingerprint = self.client.server_name.replace(" ", "_")
-        if cachedir:
-            self.cachedir = os.path.join(os.path.abspath(cachedir), self.server_fingerprint)
-            self.metafile = os.path.join(self.cachedir, "meta.json")
-            self.cachefile = os.path.join(self.cachedir, "cache.db")
-            os.makedirs(self.cachedir, exist_ok=True)
-
-            # initialize db if it doesn't exist
-            with dbm.open(self.cachefile, "c") as db:
-                pass
-
-            # writeout metadata for reload later, exception handling if server/cache mismatch
-            if not os.path.exists(self.metafile):
-                self.stamp_cache()
-            else:
-                self.check_cache()
+    The fingerprint will resolve to the same value for the same server (address + name),
+    but to a different value for a different server.
+    """
 
-        else:
-            self.cachedir = None
-            self.metafile = None
-            self.cachefile = None
+    # Normalize the address a little bit (protocol/trailing slashes shouldn't matter)
+    norm_address = address.lower().rstrip("/")
+    norm_address = re.sub(r"^https?://", "", norm_address)
 
-        self.memcache = MemCache(maxsize=max_memcache_size)
+    address_hash = sha256(norm_address.encode("utf-8")).hexdigest()[:16]
+    safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", server_name)
 
-    def put(self, items: List[Any], entity_type: str):
-        """Put a list of items into the cache.
+    return f"{safe_name}_{address_hash}"
 
-        See `entity_type` for allowed values.
 
-        Parameters
-        ----------
-        items : List[Any]
-            List of objects to cache.
-        entity_type : str
-            Type of entity; one of `molecule`, `record`.
+def _synchronized(func):
+    """
+    Decorator for PortalCache methods that must hold the cache lock
+    """
 
-        """
-        if entity_type not in ("molecule", "record"):
-            raise ValueError("`entity_type` must be one of `molecule`, `record`")
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+class CacheStatistics(BaseModel):
+    """
+    Usage statistics of a PortalCache
+    """
+
+    class Config:
+        extra = Extra.forbid
 
-        if self.cachefile:
-            with dbm.open(self.cachefile, "c") as db:
-                self._put(items, entity_type, db)
+    memory_hits: int
+    memory_misses: int
+    memory_evictions: int
+    memory_items: int
+    memory_bytes: int
+    disk_hits: int
+    disk_misses: int
+
+
+class PortalCache:
+    """
+    A two-level (memory + on-disk) cache of records and molecules obtained from a single server
+
+    The on-disk cache is a sqlite database stored in a subdirectory (named after the
+    server fingerprint) of the given cache directory. Records are stored along with their
+    `modified_on` timestamp, which is used by the client to determine if a cached record is stale.
+    """
+
+    def __init__(
+        self,
+        server_address: str,
+        server_name: str,
+        cache_dir: Optional[str],
+        max_memcache_size: Optional[int],
+        max_memcache_bytes: Optional[int] = None,
+    ):
+        self._lock = threading.RLock()
+
+        self.server_address = server_address
+        self.server_fingerprint = compute_server_fingerprint(server_address, server_name)
+
+        if cache_dir:
+            self.cache_dir = os.path.join(os.path.abspath(cache_dir), self.server_fingerprint)
+            self.cache_file = os.path.join(self.cache_dir, "cache.sqlite")
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            # The cache may be used from several threads (for example, when prefetching dataset records)
+            self._db = sqlite3.connect(self.cache_file, check_same_thread=False)
+            self._create_tables()
+            self._check_metadata()
         else:
-            self._put(items, entity_type)
+            self.cache_dir = None
+            self.cache_file = None
+            self._db = None
+
+        self.memcache = MemCache(maxsize=max_memcache_size, max_bytes=max_memcache_bytes)
+
+        self.disk_hits = 0
+        self.disk_misses = 0
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, "_db", None) is not None:
+            self._db.close()
+            self._db = None
+
+    @property
+    def is_disk_cache(self) -> bool:
+        return self._db is not None
+
+    def _create_tables(self):
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache_metadata (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS records (
+                     id INTEGER PRIMARY KEY,
+                     record_type TEXT NOT NULL,
+                     modified_on TEXT NOT NULL,
+                     data BLOB NOT NULL)"""
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS molecules (id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+
+    def _check_metadata(self):
+        """Stamps a new cache with the server it belongs to, or checks that an existing cache belongs to this server"""
+
+        r = self._db.execute("SELECT value FROM cache_metadata WHERE key = 'server_address'").fetchone()
+
+        if r is None:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO cache_metadata (key, value) VALUES ('server_address', ?), ('created_on', ?)",
+                    (self.server_address, str(time.time())),
+                )
+        elif r[0] != self.server_address:
+            raise RuntimeError(
+                f"Existing cache directory {self.cache_dir} corresponds to a different server: {r[0]} "
+                f"(expected {self.server_address})"
+            )
+
+    @staticmethod
+    def _serialize(data: Dict[str, Any]) -> bytes:
+        return serialize(data, "application/msgpack")
+
+    @staticmethod
+    def _deserialize(data_bytes: bytes) -> Dict[str, Any]:
+        return deserialize(data_bytes, "application/msgpack")
+
+    def _prepare_items(self, items: Iterable[Any]) -> List[Tuple[Any, int, Optional[bytes]]]:
+        """
+        Computes the (uncompressed) size and serialized form of items to be stored in the cache
+
+        Serialization is only done if needed (either to write to disk, or to track the size of the memory cache)
+
+        Returns
+        -------
+        :
+            List of (item, size in bytes, compressed data for the disk cache)
+        """
+
+        need_serialization = self._db is not None or self.memcache.max_bytes is not None
 
-    def _put(self, items, entity_type, db=None):
+        ret = []
         for item in items:
-            self._put_single(item, entity_type, db)
+            if item is None:
+                continue
 
-    def _put_single(self, item, entity_type, db=None):
-        key = f"{entity_type}-{item.id}"
+            if need_serialization:
+                serialized = self._serialize(item.dict())
+                compressed = zstandard.compress(serialized) if self._db is not None else None
+                ret.append((item, len(serialized), compressed))
+            else:
+                ret.append((item, 0, None))
 
-        # if we already have this in memcache, no further action
-        if key in self.memcache:
-            return
+        return ret
 
-        # add to memcache
-        self.memcache[key] = item
+    def _get_from_disk(self, table: str, ids: List[int]) -> Generator[Tuple[int, Dict[str, Any], int], None, None]:
+        """
+        Reads items from the on-disk cache
 
-        # add to fs cache
-        if db is not None:
-            db[key] = lzma.compress(item.json().encode("utf-8"))
+        Returns
+        -------
+        :
+            Generator of (id, deserialized data, uncompressed size in bytes)
+        """
 
-    def get(self, ids: List[str], entity_type: str) -> Dict[str, Any]:
-        """Get a list of items out of the cache.
+        # sqlite limits the number of parameters in a single statement, so go in chunks
+        n_found = 0
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            stmt = f"SELECT id, data FROM {table} WHERE id IN ({','.join('?' * len(chunk))})"
+
+            for item_id, data in self._db.execute(stmt, chunk):
+                n_found += 1
+                decompressed = zstandard.decompress(data)
+                yield item_id, self._deserialize(decompressed), len(decompressed)
+
+        self.disk_hits += n_found
+        self.disk_misses += len(ids) - n_found
+
+    ##############################################
+    # Records
+    ##############################################
+    @_synchronized
+    def get_records(self, record_ids: Iterable[int], client: Any) -> Dict[int, BaseRecord]:
+        """
+        Obtains records from the cache
 
-        See `entity_type` for allowed values.
+        No checking is done as to whether the records are up-to-date with the server.
 
         Parameters
         ----------
-        ids: List[str]
-            List of objects to retrieve from cache.
-        entity_type : str
-            Type of entity; one of `molecule`, `record`.
+        record_ids
+            IDs of the records to obtain
+        client
+            The client to attach to records loaded from disk
 
         Returns
         -------
+        :
+            Dictionary of record id to record. Records not found in the cache are not included
+        """
+
+        ret: Dict[int, BaseRecord] = {}
+        not_in_mem: List[int] = []
+
+        for rid in record_ids:
+            r = self.memcache.get(("record", rid))
+            if r is not None:
+                ret[rid] = r
+            else:
+                not_in_mem.append(rid)
 
+        if self._db is None or not not_in_mem:
+            return ret
+
+        for rid, data, size in self._get_from_disk("records", not_in_mem):
+            r = record_from_dict(data, client)
+            self.memcache.set(("record", rid), r, size)
+            ret[rid] = r
+
+        return ret
+
+    @_synchronized
+    def update_records(self, records: Iterable[Optional[BaseRecord]]):
+        """
+        Adds records to the cache, replacing any existing record with the same id
         """
-        if entity_type not in ("molecule", "record"):
-            raise ValueError("`entity_type` must be one of `molecule`, `record`")
 
-        if self.cachefile:
-            with dbm.open(self.cachefile, "r") as db:
-                return self._get(ids, entity_type, db)
-        else:
-            return self._get(ids, entity_type)
-
-    def _get(self, ids, entity_type, db=None):
-        items = {}
-        for i in ids:
-            item = self._get_single(str(i), entity_type, db)
-            if item is not None:
-                items[i] = item
-        return items
-
-    def _get_single(self, id, entity_type, db=None):
-        key = f"{entity_type}-{id}"
-
-        # first check memcache (fast)
-        # if found, return
-        item = self.memcache.get(key, None)
-        if item is not None:
-            return item
-
-        # check fs cache (slower)
-        # return if found, otherwise return None
-        if db is not None:
-            item = db.get(key, None)
-            if item is not None:
-                if entity_type == "molecule":
-                    item = Molecule.from_data(json.loads(lzma.decompress(item).decode()))
-
-                elif entity_type == "record":
-                    item = record_factory(json.loads(lzma.decompress(item).decode()), client=self.client)
-
-                # add to memcache
-                self.memcache[key] = item
-
-                return item
+        to_write = []
+        for r, size, compressed in self._prepare_items(records):
+            self.memcache.set(("record", r.id), r, size)
+
+            if compressed is not None:
+                to_write.append((r.id, r.record_type, r.modified_on.isoformat(), compressed))
+
+        if to_write:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO records (id, record_type, modified_on, data) VALUES (?, ?, ?, ?)",
+                    to_write,
+                )
+
+    @_synchronized
+    def remove_records(self, record_ids: Iterable[int]):
+        record_ids = list(record_ids)
+
+        for rid in record_ids:
+            self.memcache.pop(("record", rid))
+
+        if self._db is not None and record_ids:
+            with self._db:
+                self._db.executemany("DELETE FROM records WHERE id = ?", [(x,) for x in record_ids])
+
+    ##############################################
+    # Molecules
+    ##############################################
+    @_synchronized
+    def get_molecules(self, molecule_ids: Iterable[int]) -> Dict[int, Molecule]:
+        """
+        Obtains molecules from the cache
+
+        Returns
+        -------
+        :
+            Dictionary of molecule id to molecule. Molecules not found in the cache are not included
+        """
+
+        ret: Dict[int, Molecule] = {}
+        not_in_mem: List[int] = []
+
+        for mid in molecule_ids:
+            m = self.memcache.get(("molecule", mid))
+            if m is not None:
+                ret[mid] = m
             else:
-                return
+                not_in_mem.append(mid)
+
+        if self._db is None or not not_in_mem:
+            return ret
+
+        for mid, data, size in self._get_from_disk("molecules", not_in_mem):
+            m = pydantic.parse_obj_as(Molecule, data)
+            self.memcache.set(("molecule", mid), m, size)
+            ret[mid] = m
+
+        return ret
 
-    def stamp_cache(self):
-        """Place metadata indicating which server this cache belongs to."""
-        meta = {"purpose": "QCFractal PortalClient cache", "server": self.client.address}
+    @_synchronized
+    def update_molecules(self, molecules: Sequence[Optional[Molecule]]):
+        """
+        Adds molecules to the cache, replacing any existing molecule with the same id
+        """
+
+        to_write = []
+        for m, size, compressed in self._prepare_items(molecules):
+            self.memcache.set(("molecule", m.id), m, size)
+
+            if compressed is not None:
+                to_write.append((m.id, compressed))
+
+        if to_write:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO molecules (id, data) VALUES (?, ?)", to_write)
+
+    @_synchronized
+    def remove_molecules(self, molecule_ids: Iterable[int]):
+        molecule_ids = list(molecule_ids)
+
+        for mid in molecule_ids:
+            self.memcache.pop(("molecule", mid))
+
+        if self._db is not None and molecule_ids:
+            with self._db:
+                self._db.executemany("DELETE FROM molecules WHERE id = ?", [(x,) for x in molecule_ids])
+
+    @property
+    def statistics(self) -> CacheStatistics:
+        """
+        Statistics about the usage of this cache (hits, misses, evictions, etc)
+        """
 
-        with open(self.metafile, "w") as f:
-            json.dump(meta, f)
+        return CacheStatistics(
+            memory_hits=self.memcache.hits,
+            memory_misses=self.memcache.misses,
+            memory_evictions=self.memcache.evictions,
+            memory_items=len(self.memcache),
+            memory_bytes=self.memcache.current_bytes,
+            disk_hits=self.disk_hits,
+            disk_misses=self.disk_misses,
+        )
+
+    @_synchronized
+    def reset_statistics(self):
+        self.memcache.hits = 0
+        self.memcache.misses = 0
+        self.memcache.evictions = 0
+        self.disk_hits = 0
+        self.disk_misses = 0
+
+    @_synchronized
+    def clear(self):
+        """
+        Removes everything from the cache (both memory and disk)
+        """
 
-    def check_cache(self):
-        with open(self.metafile, "r") as f:
-            meta = json.load(f)
+        self.memcache.clear()
 
-            # TODO: consider other ways to verify same server besides URI
-            # is there some kind of fingerprint the server keeps for itself?
-            if meta["server"] != self.client.address:
-                raise Exception("Existing cache directory corresponds to a different QCFractal Server")
+        if self._db is not None:
+            with self._db:
+                self._db.execute("DELETE FROM records")
+                self._db.execute("DELETE FROM molecules")
+            self._db.execute("VACUUM")
 
 
-# TODO: consider making this a dict subclass for performance instead of composition
 class MemCache:
-    def __init__(self, maxsize):
-        self.data = {}
+    """
+    An in-memory least-recently-used (LRU) cache
+
+    The cache can be limited by number of items, by (approximate) size in bytes, or both.
+    All operations are O(1). A maximum size of zero means the cache is disabled.
+    """
+
+    def __init__(self, maxsize: Optional[int], max_bytes: Optional[int] = None):
+        self.data: OrderedDict[Any, Tuple[Any, int]] = OrderedDict()
         self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
 
-    def __setitem__(self, key, value):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-        # check size; if we're beyond, chop least-recently-used value
-        self.garbage_collect()
-        self.data[key] = {"value": value, "last_used": time.time()}
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
 
     def __getitem__(self, key):
-        # update last_used, then return
-        # TODO: perhaps a more performant way to do this
-        result = self.data[key]
-        result["last_used"] = time.time()
-
-        return result["value"]
-
-    def __contains__(self, item):
-        return item in self.data
-
-    def garbage_collect(self):
-        # if cache is beyond max size, whittle it down by dropping
-        # the 3/4 of it; a bit aggressive but avoids constaint thrashing
-        # TODO: efficiency gains perhaps achievable here
-        if (self.maxsize is not None) and len(self.data) > self.maxsize:
-            newsize = self.maxsize // 4
-            items = sorted(self.data.items(), key=lambda x: x[1]["last_used"])
-            remove = items[:-newsize]
-            for (key, value) in remove:
-                self.data.pop(key)
+        value, _ = self.data[key]
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, size: int = 0):
+        """
+        Adds an item to the cache, with an (approximate) size in bytes
+        """
+
+        if self.maxsize == 0 or self.max_bytes == 0:
+            return
+
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would evict everything, and still not fit
+            self.pop(key)
+            return
+
+        old = self.data.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old[1]
+
+        self.data[key] = (value, size)
+        self.current_bytes += size
+        self._evict()
 
     def get(self, key, default=None):
-        return self[key] if key in self else default
+        """
+        Obtain an item from the cache, marking it as recently used
+        """
+
+        try:
+            value, _ = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def pop(self, key, default=None):
+        v = self.data.pop(key, None)
+        if v is None:
+            return default
+
+        self.current_bytes -= v[1]
+        return v[0]
+
+    def clear(self):
+        self.data.clear()
+        self.current_bytes = 0
+
+    def _evict(self):
+        # Remove least-recently-used items (at the beginning of the ordered dict)
+        # until we are within both limits
+        while self.data and (
+            (self.maxsize is not None and len(self.data) > self.maxsize)
+            or (self.max_bytes is not None and self.current_bytes > self.max_bytes)
+        ):
+            _, (_, size) = self.data.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
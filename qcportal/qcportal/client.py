@@ -3,6 +3,7 @@ from __future__ import annotations
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Tuple, Union, Sequence, Iterable, TypeVar, Type
 
+import pydantic
 from tabulate import tabulate
 
 from qcportal.gridoptimization import (
@@ -63,6 +64,7 @@ from .auth import (
     is_valid_groupname,
 )
 from .base_models import CommonBulkGetNamesBody, CommonBulkGetBody
+from .cache import PortalCache
 from .client_base import PortalClientBase
 from .dataset_models import (
     BaseDataset,
@@ -86,6 +88,7 @@ from .record_models import (
     BaseRecord,
     RecordQueryIterator,
     records_from_dicts,
+    split_record_includes,
 )
 from .serverinfo import (
     AccessLogQueryFilters,
@@ -116,6 +119,10 @@ class PortalClient(PortalClientBase):
         password: Optional[str] = None,
         verify: bool = True,
         show_motd: bool = True,
+        *,
+        cache_dir: Optional[str] = None,
+        memory_cache_size: Optional[int] = 0,
+        memory_cache_max_bytes: Optional[int] = None,
     ) -> None:
         """
         Parameters
@@ -133,10 +140,36 @@ class PortalClient(PortalClientBase):
             SSL keys.
         show_motd
             If a Message-of-the-Day is available, display it
-        """
+        cache_dir
+            Directory in which to store a persistent cache of records and molecules. Records in the cache are
+            checked against the server, and are only downloaded again if they have been modified.
+            If None, no on-disk cache is used.
+        memory_cache_size
+            Maximum number of records/molecules to keep in an in-memory (least-recently-used) cache.
+            If None, the number of items is not limited. If 0 (and `cache_dir` is None),
+            then caching is disabled completely.
+        memory_cache_max_bytes
+            Approximate maximum size (in bytes) of the in-memory cache. If None, the size is not limited.
+            If given with `memory_cache_size` of 0 (the default), the in-memory cache is enabled and is only
+            limited by size, not by the number of items.
+        """
+
+        # A size limit on its own enables the memory cache
+        if memory_cache_size == 0 and memory_cache_max_bytes is not None:
+            memory_cache_size = None
 
         PortalClientBase.__init__(self, address, username, password, verify, show_motd)
-        # self._cache = PortalCache(self, cachedir=cache, max_memcache_size=max_memcache_size)
+
+        if cache_dir is not None or memory_cache_size != 0:
+            self._cache = PortalCache(
+                self.address,
+                self.server_name,
+                cache_dir=cache_dir,
+                max_memcache_size=memory_cache_size,
+                max_memcache_bytes=memory_cache_max_bytes,
+            )
+        else:
+            self._cache = None
 
     def __repr__(self) -> str:
         """A short representation of the current PortalClient.
@@ -165,73 +198,31 @@ class PortalClient(PortalClientBase):
         # postprocess due to raw spacing above
         return "\n".join([substr.strip() for substr in output.split("\n")])
 
-    # @property
-    # def cache(self):
-    #    if self._cache.cachedir is not None:
-    #        return os.path.relpath(self._cache.cachedir)
-    #    else:
-    #        return None
-
-    # TODO - reimplement
-    # def _get_with_cache(self, func, id, missing_ok, entity_type, include=None):
-    #    str_id = make_str(id)
-    #    ids = make_list(str_id)
-
-    #    # pass through the cache first
-    #    # remove any ids that were found in cache
-    #    # if `include` filters passed, don't use cache, just query DB, as it's often faster
-    #    # for a few fields
-    #    if include is None:
-    #        cached = self._cache.get(ids, entity_type=entity_type)
-    #    else:
-    #        cached = {}
-
-    #    for i in cached:
-    #        ids.remove(i)
-
-    #    # if all ids found in cache, no need to go further
-    #    if len(ids) == 0:
-    #        if isinstance(id, list):
-    #            return [cached[i] for i in str_id]
-    #        else:
-    #            return cached[str_id]
-
-    #    # molecule getting does *not* support "include"
-    #    if include is None:
-    #        payload = {
-    #            "data": {"ids": ids},
-    #        }
-    #    else:
-    #        if "ids" not in include:
-    #            include.append("ids")
-
-    #        payload = {
-    #            "meta": {"includes": include},
-    #            "data": {"ids": ids},
-    #        }
-
-    #    results, to_cache = func(payload)
-
-    #    # we only cache if no field filtering was done
-    #    if include is None:
-    #        self._cache.put(to_cache, entity_type=entity_type)
-
-    #    # combine cached records with queried results
-    #    results.update(cached)
-
-    #    # check that we have results for all ids asked for
-    #    missing = set(make_list(str_id)) - set(results.keys())
-
-    #    if missing and not missing_ok:
-    #        raise KeyError(f"No objects found for `id`: {missing}")
-
-    #    # order the results by input id list
-    #    if isinstance(id, list):
-    #        ordered = [results.get(i, None) for i in str_id]
-    #    else:
-    #        ordered = results.get(str_id, None)
-
-    #    return ordered
+    @property
+    def cache(self) -> Optional[PortalCache]:
+        """
+        The record/molecule cache used by this client, or None if caching is disabled
+        """
+
+        return self._cache
+
+    @property
+    def cache_dir(self) -> Optional[str]:
+        """
+        Directory containing the on-disk cache for this server, or None if there is no on-disk cache
+        """
+
+        if self._cache is None:
+            return None
+        return self._cache.cache_dir
+
+    def clear_cache(self) -> None:
+        """
+        Removes all records and molecules from the cache (both in memory and on disk)
+        """
+
+        if self._cache is not None:
+            self._cache.clear()
 
     def get_server_information(self) -> Dict[str, Any]:
         """Request general information about the server
@@ -393,13 +384,27 @@ class PortalClient(PortalClientBase):
         if not molecule_ids:
             return []
 
+        # Molecules are not modified often, and any modification through this client
+        # removes them from the cache
+        cached_molecules: Dict[int, Molecule] = {}
+        if self._cache is not None:
+            cached_molecules = self._cache.get_molecules(set(molecule_ids))
+
+        # Only request molecules that we don't already have
+        molecule_ids_tofetch = [x for x in dict.fromkeys(molecule_ids) if x not in cached_molecules]
+
         batch_size = self.api_limits["get_molecules"] // 4
-        all_molecules = []
+        fetched_molecules: Dict[int, Optional[Molecule]] = {}
 
-        for mol_id_batch in chunk_iterable(molecule_ids, batch_size):
+        for mol_id_batch in chunk_iterable(molecule_ids_tofetch, batch_size):
             body = CommonBulkGetBody(ids=mol_id_batch, missing_ok=missing_ok)
             mol_batch = self.make_request("post", "api/v1/molecules/bulkGet", List[Optional[Molecule]], body=body)
-            all_molecules.extend(mol_batch)
+            fetched_molecules.update(zip(mol_id_batch, mol_batch))
+
+            if self._cache is not None:
+                self._cache.update_molecules(mol_batch)
+
+        all_molecules = [cached_molecules.get(x, fetched_molecules.get(x)) for x in molecule_ids]
 
         if is_single:
             return all_molecules[0]
@@ -521,6 +526,9 @@ class PortalClient(PortalClientBase):
             name=name, comment=comment, identifiers=identifiers, overwrite_identifiers=overwrite_identifiers
         )
 
+        if self._cache is not None:
+            self._cache.remove_molecules([molecule_id])
+
         return self.make_request("patch", f"api/v1/molecules/{molecule_id}", UpdateMetadata, body=body)
 
     def delete_molecules(self, molecule_ids: Union[int, Sequence[int]]) -> DeleteMetadata:
@@ -543,12 +551,71 @@ class PortalClient(PortalClientBase):
         if not molecule_ids:
             return DeleteMetadata()
 
+        if self._cache is not None:
+            self._cache.remove_molecules(molecule_ids)
+
         return self.make_request("post", "api/v1/molecules/bulkDelete", DeleteMetadata, body=molecule_ids)
 
     ##############################################################
     # General record functions
     ##############################################################
 
+    def _get_cached_records(
+        self, record_ids: Sequence[int], record_type: Optional[str] = None
+    ) -> Dict[int, BaseRecord]:
+        """
+        Obtain records from the cache that are still up-to-date with the server
+
+        The `modified_on` field of all the cached records is checked against the server (in a single,
+        lightweight request per batch). Any cached records that are out of date (or no longer exist on the server)
+        are removed from the cache and not returned.
+
+        Parameters
+        ----------
+        record_ids
+            IDs of the records to look for in the cache
+        record_type
+            If specified, only return cached records of this type
+
+        Returns
+        -------
+        :
+            A dictionary of record id to record, for all records in the cache that are up-to-date
+        """
+
+        if self._cache is None:
+            return {}
+
+        cached_records = self._cache.get_records(set(record_ids), self)
+
+        if record_type is not None:
+            cached_records = {k: v for k, v in cached_records.items() if v.record_type == record_type}
+
+        if not cached_records:
+            return {}
+
+        # Do a raw call to the records/bulkGet endpoint to only get the 'modified_on' field
+        batch_size = self.api_limits["get_records"] // 4
+        server_mtimes: Dict[int, datetime] = {}
+
+        for record_id_batch in chunk_iterable(list(cached_records.keys()), batch_size):
+            body = CommonBulkGetBody(ids=record_id_batch, include=["modified_on"], missing_ok=True)
+            modified_info = self.make_request(
+                "post", "api/v1/records/bulkGet", List[Optional[Dict[str, Any]]], body=body
+            )
+
+            for m in modified_info:
+                if m is not None:
+                    server_mtimes[m["id"]] = pydantic.parse_obj_as(datetime, m["modified_on"])
+
+        stale_ids = [rid for rid, r in cached_records.items() if server_mtimes.get(rid) != r.modified_on]
+        self._cache.remove_records(stale_ids)
+
+        for rid in stale_ids:
+            del cached_records[rid]
+
+        return cached_records
+
     def get_records(
         self,
         record_ids: Union[int, Sequence[int]],
@@ -589,19 +656,31 @@ class PortalClient(PortalClientBase):
         if not record_ids:
             return []
 
+        # Some includes are returned inline by the server. Cached records do not have these,
+        # so all records must be fetched in that case
+        include_inline, include_other = split_record_includes(include)
+
+        cached_records = self._get_cached_records(record_ids) if include_inline is None else {}
+        record_ids_tofetch = [x for x in dict.fromkeys(record_ids) if x not in cached_records]
+
         batch_size = self.api_limits["get_records"] // 4
-        all_records = []
+        fetched_records: Dict[int, Optional[BaseRecord]] = {}
 
-        for record_id_batch in chunk_iterable(record_ids, batch_size):
-            body = CommonBulkGetBody(ids=record_id_batch, missing_ok=missing_ok)
+        for record_id_batch in chunk_iterable(record_ids_tofetch, batch_size):
+            body = CommonBulkGetBody(ids=record_id_batch, include=include_inline, missing_ok=missing_ok)
             record_data = self.make_request("post", "api/v1/records/bulkGet", List[Optional[Dict[str, Any]]], body=body)
             record_batch = records_from_dicts(record_data, self)
+            fetched_records.update(zip(record_id_batch, record_batch))
+
+            if self._cache is not None:
+                self._cache.update_records(record_batch)
 
-            if include:
-                for r in record_batch:
-                    r._handle_includes(include)
+        all_records = [cached_records.get(x, fetched_records.get(x)) for x in record_ids]
 
-            all_records.extend(record_batch)
+        if include_other:
+            for r in all_records:
+                if r is not None:
+                    r._handle_includes(include_other)
 
         if is_single:
             return all_records[0]
@@ -647,11 +726,16 @@ class PortalClient(PortalClientBase):
         # A little hacky
         record_type_str = record_type.__fields__["record_type"].default
 
+        include_inline, include_other = split_record_includes(include)
+
+        cached_records = self._get_cached_records(record_ids, record_type_str) if include_inline is None else {}
+        record_ids_tofetch = [x for x in dict.fromkeys(record_ids) if x not in cached_records]
+
         batch_size = self.api_limits["get_records"] // 4
-        all_records = []
+        fetched_records: Dict[int, Optional[_T]] = {}
 
-        for record_id_batch in chunk_iterable(record_ids, batch_size):
-            body = CommonBulkGetBody(ids=record_id_batch, missing_ok=missing_ok)
+        for record_id_batch in chunk_iterable(record_ids_tofetch, batch_size):
+            body = CommonBulkGetBody(ids=record_id_batch, include=include_inline, missing_ok=missing_ok)
 
             record_data = self.make_request(
                 "post",
@@ -661,12 +745,17 @@ class PortalClient(PortalClientBase):
             )
 
             record_batch = [record_type(self, **r) if r is not None else None for r in record_data]
+            fetched_records.update(zip(record_id_batch, record_batch))
+
+            if self._cache is not None:
+                self._cache.update_records(record_batch)
 
-            if include:
-                for r in record_batch:
-                    r._handle_includes(include)
+        all_records = [cached_records.get(x, fetched_records.get(x)) for x in record_ids]
 
-            all_records.extend(record_batch)
+        if include_other:
+            for r in all_records:
+                if r is not None:
+                    r._handle_includes(include_other)
 
         if is_single:
             return all_records[0]
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, Dict, Any, List, Iterable, Type, Tuple, Union, Callable, ClassVar, Sequence
 
+import numpy as np
 import pandas as pd
 import pydantic
 from pydantic import BaseModel, Extra, validator, PrivateAttr, Field
@@ -14,9 +18,18 @@ from qcportal.base_models import RestModelBase, validate_list_to_single, CommonB
 from qcportal.dataset_view import DatasetViewWrapper
 from qcportal.metadata_models import DeleteMetadata
 from qcportal.metadata_models import InsertMetadata
-from qcportal.record_models import PriorityEnum, RecordStatusEnum, BaseRecord
+from qcportal.record_models import (
+    PriorityEnum,
+    RecordStatusEnum,
+    BaseRecord,
+    records_from_dicts,
+    split_record_includes,
+)
 from qcportal.utils import make_list, chunk_iterable
 
+# iterate_records adjusts its batch size so that fetching a batch takes about this long (in seconds)
+_iterate_records_target_time = 2.0
+
 
 class Citation(BaseModel):
     """A literature citation."""
@@ -116,6 +129,8 @@ class BaseDataset(BaseModel):
     def __init__(self, client=None, view_data=None, **kwargs):
         BaseModel.__init__(self, **kwargs)
 
+        self._view_data = view_data
+
         # Calls derived class propagate_client
         # which should filter down to the ones in this (BaseDataset) class
         self.propagate_client(client)
@@ -582,9 +597,14 @@ class BaseDataset(BaseModel):
         # we want to yield in the middle
         #########################################################
 
+        if self.is_view:
+            # Nothing to fetch. If entry_names is None, this walks the whole entry table
+            for _, entry in self._view_data.iterate_entries(self._entry_type, make_list(entry_names)):
+                yield entry
+            return
+
         # Reload entry names if we are forcing refetching
-        # Nothing to fetch if this is a view
-        if force_refetch and not self.is_view:
+        if force_refetch:
             self.fetch_entry_names()
 
         # if not specified, do all entries
@@ -593,35 +613,28 @@ class BaseDataset(BaseModel):
         else:
             entry_names = make_list(entry_names)
 
-        if self.is_view:
-            # Go one at a time. No need to "fetch"
-            for entry_name in entry_names:
-                entry = self.get_entry(entry_name)
-                if entry is not None:
-                    yield entry
-        else:
-            # Fetch from server
-            batch_size: int = self._client.api_limits["get_dataset_entries"] // 4
+        # Fetch from server
+        batch_size: int = self._client.api_limits["get_dataset_entries"] // 4
 
-            if self.entries_ is None:
-                self.entries_ = {}
+        if self.entries_ is None:
+            self.entries_ = {}
 
-            for entry_names_batch in chunk_iterable(entry_names, batch_size):
-                # If forcing refetching, then use the whole batch. Otherwise, strip out
-                # any existing entries
-                if force_refetch:
-                    names_tofetch = entry_names_batch
-                else:
-                    names_tofetch = [x for x in entry_names_batch if x not in self.entries_]
+        for entry_names_batch in chunk_iterable(entry_names, batch_size):
+            # If forcing refetching, then use the whole batch. Otherwise, strip out
+            # any existing entries
+            if force_refetch:
+                names_tofetch = entry_names_batch
+            else:
+                names_tofetch = [x for x in entry_names_batch if x not in self.entries_]
 
-                self._internal_fetch_entries(names_tofetch)
+            self._internal_fetch_entries(names_tofetch)
 
-                # Loop over the whole batch (not just what we fetched)
-                for entry_name in entry_names_batch:
-                    entry = self.entries_.get(entry_name, None)
+            # Loop over the whole batch (not just what we fetched)
+            for entry_name in entry_names_batch:
+                entry = self.entries_.get(entry_name, None)
 
-                    if entry is not None:
-                        yield entry
+                if entry is not None:
+                    yield entry
 
     @property
     def entry_names(self) -> List[str]:
@@ -706,21 +719,57 @@ class BaseDataset(BaseModel):
         if not (entry_names and specification_names):
             return
 
-        body = DatasetFetchRecordsBody(entry_names=entry_names, specification_names=specification_names, status=status)
+        include_inline, include_other = split_record_includes(include)
 
+        # If there is a cache, only get the modification time of the records, and then only download
+        # the full records that are not in the cache (or are out of date).
+        # Cached records do not have inline includes, so all records must be fetched in that case
+        cache = self._client.cache
+        use_cache = cache is not None and include_inline is None
+
+        body = DatasetFetchRecordDataBody(
+            entry_names=entry_names,
+            specification_names=specification_names,
+            status=status,
+            include=["modified_on"] if use_cache else include_inline,
+        )
+
+        # Obtains the record items and the records themselves in one request
         record_info = self._client.make_request(
             "post",
-            f"api/v1/datasets/{self.dataset_type}/{self.id}/records/bulkFetch",
-            List[Tuple[str, str, int]],  # (entry_name, spec_name, record_id)
+            f"api/v1/datasets/{self.dataset_type}/{self.id}/records/bulkFetchData",
+            List[Tuple[str, str, Dict[str, Any]]],  # (entry_name, spec_name, record data)
             body=body,
         )
 
-        record_ids = [x[2] for x in record_info]
-        records = self._client.get_records(record_ids, include=include)
+        if use_cache:
+            server_mtimes = {x[2]["id"]: pydantic.parse_obj_as(datetime, x[2]["modified_on"]) for x in record_info}
+
+            cached_records = cache.get_records(set(server_mtimes.keys()), self._client)
+            stale_ids = [rid for rid, r in cached_records.items() if server_mtimes[rid] != r.modified_on]
+            cache.remove_records(stale_ids)
+
+            for rid in stale_ids:
+                del cached_records[rid]
+
+            # get_records also stores the fetched records in the cache
+            record_ids_tofetch = [x for x in server_mtimes.keys() if x not in cached_records]
+            fetched_records = self._client.get_records(record_ids_tofetch)
+            cached_records.update(zip(record_ids_tofetch, fetched_records))
+
+            records = [cached_records[x[2]["id"]] for x in record_info]
+        else:
+            records = records_from_dicts([x[2] for x in record_info], self._client)
+
+            if cache is not None:
+                cache.update_records(records)
+
+        if include_other:
+            for r in records:
+                r._handle_includes(include_other)
 
         # Update the locally-stored records
         for rec_item, rec in zip(record_info, records):
-            assert rec_item[2] == rec.id
             self.record_map_[(rec_item[0], rec_item[1])] = rec
 
     def _internal_update_records(
@@ -752,9 +801,13 @@ class BaseDataset(BaseModel):
             return
 
         # Get all the record ids that we store that correspond to the entries/specs
-        existing_record_info = [
-            (e, s, r) for (e, s), r in self.record_map_.items() if e in entry_names and s in specification_names
-        ]
+        # (look up by key rather than walking the record map, which may be being modified in another thread)
+        existing_record_info = []
+        for e in entry_names:
+            for s in specification_names:
+                r = self.record_map_.get((e, s), None)
+                if r is not None:
+                    existing_record_info.append((e, s, r))
 
         # Subset that we should check for updated records on the server
         # (completed and invalid rarely change)
@@ -900,6 +953,43 @@ class BaseDataset(BaseModel):
             self.fetch_records(entry_name, specification_name, include=include, force_refetch=force_refetch)
             return self._lookup_record(entry_name, specification_name)
 
+    def _fetch_record_batch(
+        self,
+        entry_names: List[str],
+        specification_name: str,
+        status: Optional[Iterable[RecordStatusEnum]],
+        include: Optional[Iterable[str]],
+        fetch_updated: bool,
+        force_refetch: bool,
+    ) -> float:
+        """
+        Fetches (or updates) the records for a batch of entries for a single specification
+
+        This is used by iterate_records, and may be run in a separate thread.
+
+        Returns
+        -------
+        :
+            The time taken (in seconds)
+        """
+
+        start_time = time.monotonic()
+
+        # Handle existing records that need to be updated
+        if fetch_updated and not force_refetch:
+            existing_batch = [x for x in entry_names if (x, specification_name) in self.record_map_]
+            self._internal_update_records(existing_batch, [specification_name], status, include)
+
+        if force_refetch:
+            batch_tofetch = entry_names
+        else:
+            # Filter if they already exist
+            batch_tofetch = [x for x in entry_names if (x, specification_name) not in self.record_map_]
+
+        self._internal_fetch_records(batch_tofetch, [specification_name], status, include)
+
+        return time.monotonic() - start_time
+
     def iterate_records(
         self,
         entry_names: Optional[Union[str, Iterable[str]]] = None,
@@ -908,7 +998,34 @@ class BaseDataset(BaseModel):
         include: Optional[Iterable[str]] = None,
         fetch_updated: bool = True,
         force_refetch: bool = False,
+        prefetch_batches: int = 2,
     ):
+        """
+        Iterate over records of this dataset, yielding (entry_name, specification_name, record) tuples
+
+        Records are fetched from the server in batches. While the caller is processing one batch,
+        up to `prefetch_batches` further batches are fetched in background threads. The size
+        of the batches is adjusted based on how long previous batches took to fetch.
+
+        Parameters
+        ----------
+        entry_names
+            Names of the entries whose records to iterate over. If None, iterate over all entries
+        specification_names
+            Names of the specifications whose records to iterate over. If None, iterate over all specifications
+        status
+            Only iterate over records with these statuses
+        include
+            Additional fields to include in the returned record
+        fetch_updated
+            Fetch any records that exist locally but have been updated on the server
+        force_refetch
+            If true, fetch data from the server even if it already exists locally
+        prefetch_batches
+            Number of batches to fetch ahead of the one being processed. If 0, batches are fetched
+            one at a time, only when needed.
+        """
+
         #########################################################
         # We duplicate a little bit of fetch_records here, since
         # we want to yield in the middle
@@ -943,37 +1060,80 @@ class BaseDataset(BaseModel):
 
                     if status is None or rec.status in status:
                         yield entry_name, spec_name, rec
-        else:
-            # Smaller fetch limit for iteration (than in fetch_records)
-            fetch_limit: int = self._client.api_limits["get_records"] // 10
+            return
 
-            n_entries = len(entry_names)
+        # Smaller fetch limit for iteration (than in fetch_records), at least to start
+        max_batch_size: int = self._client.api_limits["get_records"]
+        batch_size: int = max(1, max_batch_size // 10)
 
-            for spec_name in specification_names:
-                for start_idx in range(0, n_entries, fetch_limit):
-                    entries_batch = entry_names[start_idx : start_idx + fetch_limit]
+        n_entries = len(entry_names)
 
-                    # Handle existing records that need to be updated
-                    if fetch_updated and not force_refetch:
-                        existing_batch = [x for x in entries_batch if (x, spec_name) in self.record_map_]
-                        self._internal_update_records(existing_batch, [spec_name], status, include)
+        # Position of the next batch to be submitted (index into specification_names, index into entry_names)
+        next_spec_idx = 0
+        next_entry_idx = 0
 
-                    if force_refetch:
-                        batch_tofetch = entries_batch
-                    else:
-                        # Filter if they already exist
-                        batch_tofetch = [x for x in entries_batch if (x, spec_name) not in self.record_map_]
+        def _next_batch() -> Optional[Tuple[str, List[str], int]]:
+            nonlocal next_spec_idx, next_entry_idx
+
+            if next_entry_idx >= n_entries:
+                next_spec_idx += 1
+                next_entry_idx = 0
 
-                    self._internal_fetch_records(batch_tofetch, [spec_name], status, include)
+            if next_spec_idx >= len(specification_names) or n_entries == 0:
+                return None
 
-                    # Now lookup the just-fetched records and yield them
-                    for entry_name in entries_batch:
-                        rec = self._lookup_record(entry_name, spec_name)
-                        if rec is None:
-                            continue
+            batch = entry_names[next_entry_idx : next_entry_idx + batch_size]
+            next_entry_idx += batch_size
+            return specification_names[next_spec_idx], batch, batch_size
+
+        executor = ThreadPoolExecutor(max_workers=prefetch_batches) if prefetch_batches > 0 else None
+        pending = deque()  # (spec name, entry names, requested batch size, future or None, fetch args)
+
+        def _submit():
+            # Fill up the queue of batches being fetched
+            while len(pending) < max(1, prefetch_batches):
+                b = _next_batch()
+                if b is None:
+                    return
+
+                args = (b[1], b[0], status, include, fetch_updated, force_refetch)
+                fut = executor.submit(self._fetch_record_batch, *args) if executor is not None else None
+                pending.append((*b, fut, args))
+
+        try:
+            _submit()
+
+            while pending:
+                spec_name, entries_batch, requested_size, fut, args = pending.popleft()
+                elapsed = fut.result() if fut is not None else self._fetch_record_batch(*args)
+
+                # Adjust the batch size so that each batch takes about the target time,
+                # but don't change too drastically from one batch to the next. Partial batches
+                # (at the end of a specification) aren't a good measure
+                if len(entries_batch) == requested_size:
+                    rate = len(entries_batch) / max(elapsed, 1e-3)
+                    new_size = int(rate * _iterate_records_target_time)
+                    batch_size = min(max(new_size, batch_size // 2, 1), batch_size * 2, max_batch_size)
+
+                # Start fetching the next batches before handing this batch to the caller
+                _submit()
+
+                # Now lookup the just-fetched records and yield them
+                for entry_name in entries_batch:
+                    rec = self._lookup_record(entry_name, spec_name)
+                    if rec is None:
+                        continue
 
-                        if status is None or rec.status in status:
-                            yield entry_name, spec_name, rec
+                    if status is None or rec.status in status:
+                        yield entry_name, spec_name, rec
+        finally:
+            # If the caller stops iterating early, don't wait around for batches that aren't needed
+            # (cancelled manually, since shutdown(cancel_futures=True) requires python 3.9)
+            if executor is not None:
+                for *_, fut, _ in pending:
+                    if fut is not None:
+                        fut.cancel()
+                executor.shutdown(wait=False)
 
     def remove_records(
         self,
@@ -1179,7 +1339,7 @@ class BaseDataset(BaseModel):
 
     def compile_values(
         self,
-        value_call: Callable,
+        value_call: Union[Callable, Sequence[Callable]],
         value_names: Union[Sequence[str], str] = "value",
         entry_names: Optional[Union[str, Iterable[str]]] = None,
         specification_names: Optional[Union[str, Iterable[str]]] = None,
@@ -1188,17 +1348,21 @@ class BaseDataset(BaseModel):
         """
         Compile values from records into a pandas DataFrame.
 
+        Records are iterated over only once. Values are stored directly into one array per
+        (specification, value) column, which are then used to construct the DataFrame.
+
         Parameters
         -----------
         value_call
             Function to call on each record to extract the desired value. Must return a scalar value or
-            a sequence of values if 'unpack' is set to True.
+            a sequence of values if 'unpack' is set to True. May also be a sequence of functions, in
+            which case each function is called on each record, and each produces a separate column.
 
         value_names
             Column name(s) for the extracted value(s). If a string is provided and multiple values are
-            returned by 'value_call', columns are named by appending an index to this string. If a list
-            of strings is provided, it must match the length of the sequence returned by 'value_call'.
-            Default is "value".
+            returned by 'value_call' (or multiple functions are given), columns are named by appending an
+            index to this string. If a list of strings is provided, it must match the length of the sequence
+            returned by 'value_call' (or the number of functions given). Default is "value".
 
         entry_names
             Entry names to filter records. If not provided, considers all entries.
@@ -1208,7 +1372,7 @@ class BaseDataset(BaseModel):
 
         unpack
             If True, unpack the sequence of values returned by 'value_call' into separate columns.
-            Default is False.
+            Default is False. Cannot be used with multiple functions.
 
         Returns
         --------
@@ -1221,7 +1385,7 @@ class BaseDataset(BaseModel):
         -------
         ValueError
             If the length of 'value_names' does not match the number of values returned by 'value_call' when
-            'unpack' is set to True.
+            'unpack' is set to True, or the number of functions given in 'value_call'.
 
         Notes
         ------
@@ -1231,47 +1395,97 @@ class BaseDataset(BaseModel):
         same number of values for each record if unpack is True.
         """
 
-        def _data_generator(unpack=False):
-            for entry_name, spec_name, record in self.iterate_records(
-                entry_names=entry_names,
-                specification_names=specification_names,
-                status=RecordStatusEnum.complete,
-                fetch_updated=True,
-                force_refetch=False,
-            ):
-                if unpack:
-                    yield entry_name, spec_name, *value_call(record)
-                else:
-                    yield entry_name, spec_name, value_call(record)
+        if callable(value_call):
+            value_calls = None
+        else:
+            value_calls = list(value_call)
+            if unpack:
+                raise ValueError("Cannot unpack values when multiple functions are given")
 
-        def _check_first():
-            gen = _data_generator()
-            _, _, first_value = next(gen)
+            if isinstance(value_names, str):
+                value_names = [value_names + str(i) for i in range(len(value_calls))]
+            elif len(value_names) != len(value_calls):
+                raise ValueError("Number of column names must match number of functions provided.")
 
-            return first_value
+        def _get_values(record) -> Tuple[List[Any], bool]:
+            # Returns the values, and whether the value was unpacked
+            if value_calls is not None:
+                return [f(record) for f in value_calls], False
 
-        first_value = _check_first()
+            v = value_call(record)
+            if unpack and isinstance(v, Sequence) and not isinstance(v, str):
+                return list(v), True
+            return [v], False
 
-        if unpack and isinstance(first_value, Sequence) and not isinstance(first_value, str):
-            if isinstance(value_names, str):
-                column_names = [value_names + str(i) for i in range(len(first_value))]
-            else:
-                if len(first_value) != len(value_names):
-                    raise ValueError(
-                        "Number of column names must match number of values returned by provided function."
-                    )
-                column_names = value_names
+        if entry_names is None:
+            entry_names = self.entry_names
+        else:
+            entry_names = make_list(entry_names)
+
+        # Row of the arrays for each entry. Entries with no (complete) records are removed at the end
+        row_map = {name: idx for idx, name in enumerate(dict.fromkeys(entry_names))}
+        row_filled = np.zeros(len(row_map), dtype=bool)
+
+        # specification name -> list of arrays (one for each column)
+        spec_arrays: Dict[str, List[np.ndarray]] = {}
+        column_names: Optional[List[str]] = None
+
+        for entry_name, spec_name, record in self.iterate_records(
+            entry_names=entry_names,
+            specification_names=specification_names,
+            status=RecordStatusEnum.complete,
+            fetch_updated=True,
+            force_refetch=False,
+        ):
+            values, unpacked = _get_values(record)
+
+            # Determine the columns from the first record
+            if column_names is None:
+                if value_calls is not None:
+                    column_names = list(value_names)
+                elif unpacked:
+                    if isinstance(value_names, str):
+                        column_names = [value_names + str(i) for i in range(len(values))]
+                    elif len(values) != len(value_names):
+                        raise ValueError(
+                            "Number of column names must match number of values returned by provided function."
+                        )
+                    else:
+                        column_names = list(value_names)
+                else:
+                    column_names = [value_names]
+
+            if len(values) != len(column_names):
+                raise ValueError(
+                    f"Function returned {len(values)} values for entry {entry_name}, specification {spec_name}, "
+                    f"but expected {len(column_names)}"
+                )
 
-            df = pd.DataFrame(_data_generator(unpack=True), columns=("entry", "specification", *column_names))
+            arrays = spec_arrays.get(spec_name)
+            if arrays is None:
+                arrays = [np.full(len(row_map), np.nan, dtype=object) for _ in column_names]
+                spec_arrays[spec_name] = arrays
 
-        else:
-            column_names = [value_names]
-            df = pd.DataFrame(_data_generator(), columns=("entry", "specification", value_names))
+            row = row_map[entry_name]
+            row_filled[row] = True
+            for arr, v in zip(arrays, values):
+                arr[row] = v
+
+        # Only entries that had records, sorted by name
+        row_names = np.array(list(row_map.keys()), dtype=object)[row_filled]
+        row_order = np.argsort(row_names, kind="stable")
+        row_idx = np.flatnonzero(row_filled)[row_order]
 
-        return_val = df.pivot(index="entry", columns="specification", values=column_names)
+        columns = {}
+        for col_idx, col_name in enumerate(column_names or []):
+            for spec_name in sorted(spec_arrays):
+                columns[(spec_name, col_name)] = spec_arrays[spec_name][col_idx][row_idx].tolist()
 
-        # Make specification top level index.
-        return return_val.swaplevel(axis=1)
+        df = pd.DataFrame(columns, index=pd.Index(row_names[row_order], name="entry"))
+        if columns:
+            df.columns.names = ["specification", None]
+
+        return df
 
     def get_properties_df(self, properties_list: Sequence[str]) -> pd.DataFrame:
         """
@@ -1294,11 +1508,17 @@ class BaseDataset(BaseModel):
             A DataFrame populated with the specified properties for each record.
         """
 
-        # create lambda function to get all properties at once
-        extract_properties = lambda x: [x.properties.get(property_name) for property_name in properties_list]
+        if self.is_view and self._view_data.has_record_properties():
+            # Views store the properties separately, so we don't need to parse the full records
+            df = self._view_data.get_record_properties(properties_list)
+            result = df.pivot(index="entry", columns="specification", values=list(properties_list))
+            result = result.swaplevel(axis=1).infer_objects()
+        else:
+            # create lambda function to get all properties at once
+            extract_properties = lambda x: [x.properties.get(property_name) for property_name in properties_list]
 
-        # retrieve values.
-        result = self.compile_values(extract_properties, value_names=properties_list, unpack=True)
+            # retrieve values.
+            result = self.compile_values(extract_properties, value_names=properties_list, unpack=True)
 
         # Drop columns with all nan  values. This will occur if a property that is not part of a
         # specification is requested.
@@ -1393,6 +1613,11 @@ class DatasetFetchRecordsBody(RestModelBase):
     status: Optional[List[RecordStatusEnum]] = None
 
 
+class DatasetFetchRecordDataBody(DatasetFetchRecordsBody):
+    include: Optional[List[str]] = None
+    exclude: Optional[List[str]] = None
+
+
 class DatasetSubmitBody(RestModelBase):
     entry_names: Optional[List[str]] = None
     specification_names: Optional[List[str]] = None
@@ -2,12 +2,20 @@ from __future__ import annotations
 
 import os
 import sqlite3
-from typing import Optional, Dict, Any, List, Iterable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Iterable, Tuple, Generator, Sequence
 
+import pandas as pd
 import zstandard
 from pydantic import BaseModel, validator, PrivateAttr, parse_obj_as, Extra
 
+from qcportal.record_models import RecordStatusEnum
 from qcportal.serialization import deserialize
+from qcportal.utils import chunk_iterable
+
+# Older versions of sqlite limit the number of parameters in a statement to 999
+_max_sqlite_params = 900
 
 
 class DatasetViewWrapper(BaseModel):
@@ -15,7 +23,13 @@ class DatasetViewWrapper(BaseModel):
         extra = Extra.forbid
 
     view_path: str
+
+    # Rows are decompressed and parsed in chunks of this size, using this many worker threads
+    deserialize_chunk_size: int = 250
+    max_deserialize_workers: int = 2
+
     _sqlite_con = PrivateAttr()
+    _executor: Optional[ThreadPoolExecutor] = PrivateAttr(None)
 
     def __init__(self, **data):
         BaseModel.__init__(self, **data)
@@ -59,25 +73,75 @@ class DatasetViewWrapper(BaseModel):
 
         return ret
 
-    def get_entries(self, entry_type, entry_names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    def _deserialize_rows(self, rows: Iterable[Tuple[Any, ...]], model) -> Generator[Tuple[Any, ...], None, None]:
+        """
+        Deserializes rows from the view file in a background thread pool
+
+        The last element of each row is expected to be the serialized data. Rows are yielded
+        in the same order they are given, with the serialized data replaced by the parsed model.
+
+        Decompression and parsing of chunks of rows are done in worker threads, while the calling
+        thread continues to read rows from sqlite.
+        """
+
+        def _process_chunk(chunk):
+            return [(*row[:-1], self.deserialize_model(row[-1], model)) for row in chunk]
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_deserialize_workers)
+
+        pending = deque()
+        for chunk in chunk_iterable(rows, self.deserialize_chunk_size):
+            pending.append(self._executor.submit(_process_chunk, chunk))
+
+            # Bound the number of chunks in flight
+            if len(pending) > 2 * self.max_deserialize_workers:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+    def _select_by_names(self, stmt: str, names: Sequence[str]) -> Generator[Tuple[Any, ...], None, None]:
+        """
+        Runs a select statement that filters by a set of names, in batches
+
+        The given statement must contain a single `{names}` placeholder, which will be replaced by
+        the appropriate number of parameters for an IN clause.
+        """
+
         cur = self._sqlite_con.cursor()
 
-        ret = {}
-        if entry_names is None:
-            entry_info = cur.execute("SELECT name, data FROM dataset_entry")
+        for names_batch in chunk_iterable(names, _max_sqlite_params):
+            batch_stmt = stmt.format(names=",".join("?" * len(names_batch)))
+            yield from cur.execute(batch_stmt, names_batch)
 
-            for entry_name, entry_bytes in entry_info:
-                ret[entry_name] = self.deserialize_model(entry_bytes, entry_type)
-        else:
-            # Doing a query with IN is kind of a pain. Just go one by one
-            entry_names = set(entry_names)
-            stmt = "SELECT name, data FROM dataset_entry WHERE name = (:entry_name)"
+    def get_entries(self, entry_type, entry_names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        return {name: entry for name, entry in self.iterate_entries(entry_type, entry_names)}
 
-            for entry_name in entry_names:
-                entry_name, entry_bytes = cur.execute(stmt, {"entry_name": entry_name}).fetchone()
-                ret[entry_name] = self.deserialize_model(entry_bytes, entry_type)
+    def iterate_entries(
+        self, entry_type, entry_names: Optional[Iterable[str]] = None
+    ) -> Generator[Tuple[str, Any], None, None]:
+        """
+        Iterates over entries in the view, yielding (entry_name, entry) tuples
 
-        return ret
+        If entry_names is None, then the entire entry table is walked with a single cursor.
+        Otherwise, entries are looked up in batches and yielded in the order of entry_names. Entries
+        that do not exist in the view are skipped.
+        """
+
+        if entry_names is None:
+            cur = self._sqlite_con.cursor()
+            rows = cur.execute("SELECT name, data FROM dataset_entry")
+            yield from self._deserialize_rows(rows, entry_type)
+        else:
+            entry_names = list(dict.fromkeys(entry_names))
+            stmt = "SELECT name, data FROM dataset_entry WHERE name IN ({names})"
+
+            # Look up in batches, but keep the requested order within each batch
+            for names_batch in chunk_iterable(entry_names, self.deserialize_chunk_size * 4):
+                rows = dict(self._select_by_names(stmt, names_batch))
+                ordered_rows = [(x, rows[x]) for x in names_batch if x in rows]
+                yield from self._deserialize_rows(ordered_rows, entry_type)
 
     def get_record_item(self, record_item_type, entry_name: str, specification_name: str):
         cur = self._sqlite_con.cursor()
@@ -92,13 +156,59 @@ class DatasetViewWrapper(BaseModel):
 
     def iterate_records(self, record_item_type):
         cur = self._sqlite_con.cursor()
-        r = cur.execute("SELECT entry_name, specification_name, data FROM dataset_record")
+        rows = cur.execute("SELECT entry_name, specification_name, data FROM dataset_record")
+
+        for entry_name, spec_name, record_item in self._deserialize_rows(rows, record_item_type):
+            yield entry_name, spec_name, record_item.record
+
+    def has_record_properties(self) -> bool:
+        """
+        Returns True if this view contains the record info/property tables
+
+        Views created with older versions do not contain these tables
+        """
+
+        cur = self._sqlite_con.cursor()
+        stmt = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN (?, ?)"
+        return cur.execute(stmt, ("dataset_record_info", "dataset_record_property")).fetchone()[0] == 2
+
+    def get_record_properties(
+        self, property_names: Sequence[str], status: Optional[RecordStatusEnum] = RecordStatusEnum.complete
+    ) -> pd.DataFrame:
+        """
+        Read properties of records directly from the property table of the view
+
+        The returned DataFrame has one row for each record (with the given status), with columns
+        'entry', 'specification', and then one column per property. Properties that are missing
+        for a record are NaN.
+        """
+
+        cur = self._sqlite_con.cursor()
+
+        stmt = "SELECT entry_name, specification_name FROM dataset_record_info"
+        if status is not None:
+            rows = cur.execute(stmt + " WHERE status = ?", (RecordStatusEnum(status).value,))
+        else:
+            rows = cur.execute(stmt)
+
+        index = pd.MultiIndex.from_tuples(list(rows), names=["entry", "specification"])
+
+        stmt = """SELECT property_name, entry_name, specification_name, value FROM dataset_record_property
+                  WHERE property_name IN ({names})"""
+        props = pd.DataFrame(
+            self._select_by_names(stmt, list(dict.fromkeys(property_names))),
+            columns=["property_name", "entry", "specification", "value"],
+        )
+
+        # Non-scalar values are stored serialized
+        is_bytes = props["value"].map(lambda x: isinstance(x, bytes))
+        if is_bytes.any():
+            props.loc[is_bytes, "value"] = props.loc[is_bytes, "value"].map(
+                lambda x: deserialize(x, "application/msgpack")
+            )
 
-        for row in r:
-            if row is None:
-                break
+        df = props.pivot(index=["entry", "specification"], columns="property_name", values="value")
+        df = df.reindex(index=index, columns=list(property_names))
+        df.columns.name = None
 
-            entry_name, spec_name, record_item_data = row
-            record_item = self.deserialize_model(record_item_data, record_item_type)
-            record = record_item.record
-            yield entry_name, spec_name, record
+        return df.infer_objects().reset_index()
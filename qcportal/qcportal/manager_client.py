@@ -1,7 +1,8 @@
-from typing import Optional, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Tuple
 
 from qcportal.record_models import RecordTask
-from .client_base import PortalClientBase
+from .client_base import PortalClientBase, PortalRequestError
 from .managers import (
     ManagerName,
     ManagerActivationBody,
@@ -9,7 +10,7 @@ from .managers import (
     ManagerStatusEnum,
 )
 from .metadata_models import TaskReturnMetadata
-from .tasks import TaskClaimBody, TaskReturnBody
+from .tasks import TaskClaimBody, TaskReturnBody, TaskReturnClaimBody, TaskReturnClaimResult
 
 
 class ManagerClient(PortalClientBase):
@@ -48,6 +49,12 @@ class ManagerClient(PortalClientBase):
 
         self.manager_name_data = name_data
 
+        # Maximum number of requests to send at once when returning results
+        self._max_concurrent_requests = 4
+
+        # Set to False if the server does not support returning & claiming in one request
+        self._server_has_return_claim = True
+
     def _update_on_server(self, manager_update: ManagerUpdateBody) -> None:
         # Don't allow retries - we handle that elsewhere in the manager (by trying again later)
         return self.make_request(
@@ -125,27 +132,96 @@ class ManagerClient(PortalClientBase):
 
         return self.make_request("post", "compute/v1/tasks/claim", List[RecordTask], body=body)
 
-    def return_finished(self, results_compressed: Dict[int, bytes]) -> TaskReturnMetadata:
-
+    def _chunk_results(self, results_compressed: Dict[int, bytes]) -> List[Dict[int, bytes]]:
         # Chunk based on the server limit
         results_flat = list(results_compressed.items())
-        n_results = len(results_flat)
         limit = self.server_info["api_limits"]["manager_tasks_return"]
+        return [dict(results_flat[i : i + limit]) for i in range(0, len(results_flat), limit)]
 
-        task_return_meta = TaskReturnMetadata()
-        for chunk in range(0, n_results, limit):
-            body = TaskReturnBody(
-                name_data=self.manager_name_data,
-                results_compressed={k: v for k, v in results_flat[chunk : chunk + limit]},
-            )
+    def _return_chunk(self, results_compressed: Dict[int, bytes]) -> TaskReturnMetadata:
+        body = TaskReturnBody(name_data=self.manager_name_data, results_compressed=results_compressed)
+        return self.make_request("post", "compute/v1/tasks/return", TaskReturnMetadata, body=body)
 
-            meta = self.make_request("post", "compute/v1/tasks/return", TaskReturnMetadata, body=body)
+    def _return_claim_chunk(
+        self, results_compressed: Dict[int, bytes], programs: Dict[str, List[str]], tags: List[str], limit: int
+    ) -> TaskReturnClaimResult:
+        body = TaskReturnClaimBody(
+            name_data=self.manager_name_data,
+            results_compressed=results_compressed,
+            programs=programs,
+            tags=tags,
+            limit=limit,
+        )
+        return self.make_request("post", "compute/v1/tasks/return_claim", TaskReturnClaimResult, body=body)
 
-            task_return_meta.error_description = meta.error_description
+    @staticmethod
+    def _merge_return_meta(all_meta: List[TaskReturnMetadata]) -> TaskReturnMetadata:
+        task_return_meta = TaskReturnMetadata()
+        for meta in all_meta:
             task_return_meta.rejected_info.extend(meta.rejected_info)
             task_return_meta.accepted_ids.extend(meta.accepted_ids)
 
             if not meta.success:
-                return task_return_meta
+                task_return_meta.error_description = meta.error_description
 
         return task_return_meta
+
+    def return_finished(self, results_compressed: Dict[int, bytes]) -> TaskReturnMetadata:
+        """
+        Returns finished results to the server
+
+        Results are sent in chunks (based on the server limit), with several chunks sent concurrently.
+        If any chunk could not be sent, the exception is raised after all chunks have been attempted.
+        """
+
+        chunks = self._chunk_results(results_compressed)
+
+        if len(chunks) <= 1:
+            return self._merge_return_meta([self._return_chunk(x) for x in chunks])
+
+        with ThreadPoolExecutor(max_workers=min(len(chunks), self._max_concurrent_requests)) as pool:
+            futures = [pool.submit(self._return_chunk, x) for x in chunks]
+            all_meta = [f.result() for f in futures]
+
+        return self._merge_return_meta(all_meta)
+
+    def return_and_claim(
+        self, results_compressed: Dict[int, bytes], programs: Dict[str, List[str]], tags: List[str], limit: int
+    ) -> Tuple[TaskReturnMetadata, List[RecordTask]]:
+        """
+        Returns finished results and claims new tasks
+
+        The last chunk of results is returned in the same request that claims new tasks. The other chunks
+        are sent concurrently beforehand, and new tasks are only claimed if they were all sent successfully.
+        Otherwise, the exception is raised without claiming any tasks (which would not be run by the caller).
+
+        If the server does not support returning and claiming in one request, results are returned and then
+        tasks are claimed separately.
+        """
+
+        if not self._server_has_return_claim:
+            return self.return_finished(results_compressed), self.claim(programs, tags, limit)
+
+        chunks = self._chunk_results(results_compressed)
+        last_chunk = chunks.pop() if chunks else {}
+
+        all_meta: List[TaskReturnMetadata] = []
+
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(len(chunks), self._max_concurrent_requests)) as pool:
+                futures = [pool.submit(self._return_chunk, x) for x in chunks]
+                all_meta.extend(f.result() for f in futures)
+
+        try:
+            return_claim = self._return_claim_chunk(last_chunk, programs, tags, limit)
+        except PortalRequestError as e:
+            if e.status_code != 404:
+                raise
+
+            # Older server - endpoint doesn't exist
+            self._server_has_return_claim = False
+            return_meta = self._return_chunk(last_chunk) if last_chunk else TaskReturnMetadata()
+            return_claim = TaskReturnClaimResult(return_meta=return_meta, tasks=self.claim(programs, tags, limit))
+
+        all_meta.append(return_claim.return_meta)
+        return self._merge_return_meta(all_meta), return_claim.tasks
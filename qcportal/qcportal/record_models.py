@@ -507,15 +507,16 @@ class BaseRecord(BaseModel):
         if includes is None:
             return
 
-        if "task" in includes:
+        # Some of these may have already been returned inline by the server
+        if "task" in includes and self.task_ is None:
             self._fetch_task()
-        if "service" in includes:
-            self._fetch_task()
-        if "compute_history" in includes:
+        if "service" in includes and self.service_ is None:
+            self._fetch_service()
+        if "compute_history" in includes and self.compute_history_ is None:
             self._fetch_compute_history()
-        if "comments" in includes:
+        if "comments" in includes and self.comments_ is None:
             self._fetch_comments()
-        if "native_files" in includes:
+        if "native_files" in includes and self.native_files_ is None:
             self._fetch_native_files()
 
     @property
@@ -577,6 +578,33 @@ class BaseRecord(BaseModel):
 
 ServiceDependency.update_forward_refs()
 
+# Fields of a record that the server can return inline when fetching records (rather
+# than being fetched separately for each record)
+inline_record_includes = ("compute_history", "comments", "task", "service", "native_files")
+
+
+def split_record_includes(include: Optional[Iterable[str]]) -> Tuple[Optional[List[str]], List[str]]:
+    """
+    Splits includes into those that are returned inline by the server and those that are fetched separately
+
+    The first element of the returned tuple can be used directly as the include for bulk record requests
+    (and is None if no fields need to be included inline). The second element contains includes that
+    should be passed to the records' _handle_includes.
+    """
+
+    if not include:
+        return None, []
+
+    include = list(include)
+    inline = [x for x in include if x in inline_record_includes]
+    other = [x for x in include if x not in inline_record_includes]
+
+    if inline:
+        return ["*"] + inline, other
+    else:
+        return None, other
+
+
 _Record_T = TypeVar("_Record_T", bound=BaseRecord)
 
 
@@ -678,13 +706,7 @@ class RecordQueryIterator(QueryIteratorBase[_Record_T]):
                 body=self._query_filters,
             )
 
-        records: List[_Record_T] = self._client.get_records(record_ids)
-
-        if self.include:
-            for r in records:
-                r._handle_includes(self.include)
-
-        return records
+        return self._client.get_records(record_ids, include=self.include)
 
 
 def record_from_dict(data: Dict[str, Any], client: Any = None) -> BaseRecord:
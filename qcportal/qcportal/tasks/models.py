@@ -1,9 +1,11 @@
 from typing import Dict, List
 
-from pydantic import Field, constr
+from pydantic import BaseModel, Field, constr
 
 from qcportal.base_models import RestModelBase
 from qcportal.managers import ManagerName
+from qcportal.metadata_models import TaskReturnMetadata
+from qcportal.record_models import RecordTask
 
 
 class TaskClaimBody(RestModelBase):
@@ -16,3 +18,16 @@ class TaskClaimBody(RestModelBase):
 class TaskReturnBody(RestModelBase):
     name_data: ManagerName = Field(..., description="Name information about this manager")
     results_compressed: Dict[int, bytes]
+
+
+class TaskReturnClaimBody(RestModelBase):
+    name_data: ManagerName = Field(..., description="Name information about this manager")
+    results_compressed: Dict[int, bytes] = Field({}, description="Finished results to return, keyed by task id")
+    programs: Dict[constr(to_lower=True), List[str]] = Field(..., description="Subset of programs to claim tasks for")
+    tags: List[str] = Field(..., description="Subset of tags to claim tasks from")
+    limit: int = Field(..., description="Limit on the number of tasks to claim")
+
+
+class TaskReturnClaimResult(BaseModel):
+    return_meta: TaskReturnMetadata
+    tasks: List[RecordTask]
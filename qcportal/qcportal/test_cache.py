@@ -0,0 +1,55 @@
+from qcportal.cache import MemCache
+
+
+def test_memcache_lru_items():
+    cache = MemCache(maxsize=3)
+
+    for i in range(3):
+        cache[i] = str(i)
+
+    # Use 0, so 1 is now the least recently used
+    assert cache.get(0) == "0"
+
+    cache[3] = "3"
+    assert len(cache) == 3
+    assert 1 not in cache
+    assert 0 in cache and 2 in cache and 3 in cache
+    assert cache.evictions == 1
+
+    assert cache.get(1) is None
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_memcache_lru_bytes():
+    cache = MemCache(maxsize=None, max_bytes=100)
+
+    cache.set("a", 1, 40)
+    cache.set("b", 2, 40)
+    assert cache.current_bytes == 80
+
+    cache.set("c", 3, 40)
+    assert "a" not in cache
+    assert cache.current_bytes == 80
+
+    # Replacing an item updates the size
+    cache.set("b", 2, 10)
+    assert cache.current_bytes == 50
+
+    # Too large to ever fit
+    cache.set("d", 4, 101)
+    assert "d" not in cache
+
+    assert cache.pop("c") == 3
+    assert cache.current_bytes == 10
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.current_bytes == 0
+
+
+def test_memcache_disabled():
+    cache = MemCache(maxsize=0)
+    cache["a"] = 1
+    assert "a" not in cache
+    assert cache.get("a") is None